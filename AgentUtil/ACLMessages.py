@@ -10,11 +10,81 @@ Created on 08/02/2014
 """
 __author__ = 'javier'
 
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
 from rdflib import Graph
 import requests
+from requests.adapters import HTTPAdapter
 from rdflib.namespace import RDF
 
-from AgentUtil.OntoNamespaces import ACL
+from AgentUtil.OntoNamespaces import ACL, DSO, ECSDI
+from AgentUtil.CircuitBreaker import CircuitOpenError, get_breaker
+from AgentUtil.Compression import accept_encoding_header, choose_encoding, maybe_compress
+from AgentUtil.WireFormats import (DEFAULT_FORMAT, BINARY, BATCH, accept_header, mimetype,
+                                   serialize_graph, parse_graph, encode_batch, decode_batch, GraphTemplate,
+                                   TemplateMessage)
+
+# Numero maximo de conexiones abiertas que se guardan para cada agente
+POOL_SIZE = int(os.environ.get('ACL_POOL_SIZE', 10))
+
+# Sesiones HTTP (keep-alive) del proceso, una por direccion de agente
+_sessions = {}
+_sessions_pid = os.getpid()
+_sessions_lock = threading.Lock()
+
+# Threads para los envios asincronos (ver send_message_async)
+_executor = None
+_executor_pid = None
+
+# Metodo HTTP con el que se envian los mensajes a cada agente. Por defecto se
+# usa un POST con el mensaje en el cuerpo; los agentes que no lo aceptan se
+# apuntan aqui y se les envia con un GET como antes
+DEFAULT_METHOD = 'POST'
+_methods = {}
+
+# Formato en el que se quieren intercambiar los mensajes (ver WireFormats).
+# El primer mensaje a un agente se envia en RDF/XML pidiendo este formato en la
+# cabecera Accept; si el agente responde en el, se usa para los siguientes
+WIRE_FORMAT = os.environ.get('ACL_WIRE_FORMAT', BINARY)
+_formats = {}
+
+# Codificacion con la que se comprimen los mensajes a cada agente, segun lo
+# que anuncia en sus respuestas (ver Compression)
+_encodings = {}
+
+# Direcciones de agentes que no entienden los sobres de mensajes (ver send_batch)
+_no_batch = set()
+
+# Segundos maximos para conectar con un agente y para recibir su respuesta
+CONNECT_TIMEOUT = float(os.environ.get('ACL_CONNECT_TIMEOUT', 3.05))
+READ_TIMEOUT = float(os.environ.get('ACL_READ_TIMEOUT', 30))
+
+# Reintentos de los mensajes idempotentes y espera entre ellos (backoff
+# exponencial con jitter: una espera aleatoria entre 0 y base * 2^intento)
+MAX_RETRIES = int(os.environ.get('ACL_MAX_RETRIES', 2))
+BACKOFF_BASE = 0.1
+BACKOFF_MAX = 2.0
+
+# Mensajes que se pueden repetir sin efectos secundarios: las performativas de
+# consulta y los request de estas acciones
+IDEMPOTENT_PERFORMATIVES = {ACL['query-if'], ACL['query-ref']}
+IDEMPOTENT_ACTIONS = {DSO.Search, DSO.Register, ECSDI.Transport, ECSDI.Buscar_productos}
+
+# Funciones a las que se avisa cuando falla una llamada a un agente (ver
+# add_failure_listener)
+_failure_listeners = []
+
+# Plantillas de las respuestas sin contenido (ver canned_message), por
+# performativa, emisor y si llevan receptor
+_canned = {}
+_canned_lock = threading.Lock()
 
 
 def build_message(gmess, perf, sender=None, receiver=None,  content=None, msgcnt= 0):
@@ -32,8 +102,7 @@ def build_message(gmess, perf, sender=None, receiver=None,  content=None, msgcnt
     :return:
     """
     # Añade los elementos del speech act al grafo del mensaje
-    mssid = f'message-{sender.__hash__()}-{msgcnt:04}'
-    ms = ACL[mssid]
+    ms = message_id(sender, msgcnt)
     gmess.bind('acl', ACL)
     gmess.add((ms, RDF.type, ACL.FipaAclMessage))
     gmess.add((ms, ACL.performative, perf))
@@ -45,41 +114,541 @@ def build_message(gmess, perf, sender=None, receiver=None,  content=None, msgcnt
     return gmess
 
 
-def send_message(gmess, address):
+def canned_message(perf, sender=None, receiver=None, msgcnt=0):
+    """
+    Construye un mensaje sin contenido (not-understood, inform-done, inform, ...)
+    a partir de una plantilla ya serializada del emisor. Solo se sustituyen el
+    id del mensaje y el receptor, sin construir ni serializar el grafo
+
+    El resultado se responde con reply_message/serve_message o se serializa con
+    serialize_graph como un grafo; to_graph() construye el grafo si hace falta
+
+    :param perf: performativa del mensaje
+    :param sender: URI del sender
+    :param receiver: URI del receiver
+    :param msgcnt: numero de mensaje
+    :return:
+    """
+    key = (perf, sender, receiver is not None)
+    template = _canned.get(key)
+    if template is None:
+        with _canned_lock:
+            template = _canned.get(key)
+            if template is None:
+                gmess = Graph()
+                gmess.bind('acl', ACL)
+                ms = GraphTemplate.placeholder('message')
+                gmess.add((ms, RDF.type, ACL.FipaAclMessage))
+                gmess.add((ms, ACL.performative, perf))
+                gmess.add((ms, ACL.sender, sender))
+                variables = ['message']
+                if receiver is not None:
+                    gmess.add((ms, ACL.receiver, GraphTemplate.placeholder('receiver')))
+                    variables.append('receiver')
+                template = _canned[key] = GraphTemplate(gmess, variables)
+
+    if receiver is not None:
+        return template.bind(message=message_id(sender, msgcnt), receiver=receiver)
+    return template.bind(message=message_id(sender, msgcnt))
+
+
+def message_template(gmess, perf, sender=None, receiver=None, content=None):
+    """
+    Plantilla de un mensaje con contenido en la que solo varia el id del
+    mensaje, para respuestas que se repiten sin cambios (ver canned_message).
+    Se usa con template_message
+
+    :param gmess: grafo RDF con el contenido del mensaje
+    :return: GraphTemplate
+    """
+    ms = GraphTemplate.placeholder('message')
+    gmess.bind('acl', ACL)
+    gmess.add((ms, RDF.type, ACL.FipaAclMessage))
+    gmess.add((ms, ACL.performative, perf))
+    gmess.add((ms, ACL.sender, sender))
+    if receiver is not None:
+        gmess.add((ms, ACL.receiver, receiver))
+    if content is not None:
+        gmess.add((ms, ACL.content, content))
+    return GraphTemplate(gmess, ['message'])
+
+
+def template_message(template, sender=None, msgcnt=0):
+    """
+    Mensaje concreto de una plantilla de message_template
+    """
+    return template.bind(message=message_id(sender, msgcnt))
+
+
+def message_id(sender, msgcnt):
+    """
+    URI que identifica un mensaje
+    """
+    return ACL[f'message-{sender.__hash__()}-{msgcnt:04}']
+
+
+def configure_pool(pool_size=POOL_SIZE):
     """
-    Envia un mensaje usando un GET y retorna la respuesta como
-    un grafo RDF
+    Cambia el numero de conexiones que se mantienen abiertas para cada agente.
+    Cierra las sesiones existentes, las nuevas se crean al enviar mensajes
+
+    :param pool_size: conexiones persistentes por direccion de agente
+    """
+    global POOL_SIZE
+
+    POOL_SIZE = pool_size
+    close_sessions()
+
+
+def close_sessions():
     """
-    msg = gmess.serialize(format='xml')
-    r = requests.get(address, params={'content': msg})
+    Cierra todas las conexiones persistentes del proceso
+    """
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def get_session(address):
+    """
+    Retorna la sesion HTTP asociada a la direccion de un agente.
+    Todos los mensajes a un mismo agente reutilizan las conexiones de la sesion
+
+    Los agentes arrancan sus behaviours con multiprocessing, por eso las
+    sesiones heredadas de otro proceso se descartan
+
+    :param address: direccion del agente
+    :return:
+    """
+    global _sessions_pid
+
+    url = urlsplit(address)
+    key = (url.scheme, url.netloc)
+    with _sessions_lock:
+        if _sessions_pid != os.getpid():
+            _sessions.clear()
+            _sessions_pid = os.getpid()
+        session = _sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _sessions[key] = session
+    return session
+
+
+def _post(address, body, content_type, timeout=None):
+    """
+    Envia el cuerpo de un mensaje con un POST, comprimido si el agente lo acepta
+
+    :return: respuesta HTTP
+    """
+    body, encoding = maybe_compress(body, _encodings.get(address))
+    headers = {'Content-Type': content_type,
+               'Accept': accept_header(WIRE_FORMAT),
+               'Accept-Encoding': accept_encoding_header()}
+    if encoding is not None:
+        headers['Content-Encoding'] = encoding
+    r = get_session(address).post(address, data=body, headers=headers, timeout=timeout)
+    _encodings[address] = choose_encoding(r.headers.get('Accept-Encoding'))
+    return r
+
+
+def is_idempotent(gmess):
+    """
+    Indica si un mensaje se puede reenviar sin efectos secundarios
+    (ver IDEMPOTENT_PERFORMATIVES y IDEMPOTENT_ACTIONS)
+
+    :param gmess: grafo con el mensaje
+    :return:
+    """
+    if isinstance(gmess, TemplateMessage):
+        gmess = gmess.to_graph()
+    msgdic = get_message_properties(gmess)
+    perf = msgdic.get('performative')
+    if perf in IDEMPOTENT_PERFORMATIVES:
+        return True
+    if perf == ACL.request and 'content' in msgdic:
+        return gmess.value(subject=msgdic['content'], predicate=RDF.type) in IDEMPOTENT_ACTIONS
+    return False
+
+
+def backoff(attempt):
+    """
+    Segundos a esperar antes del reintento numero attempt (desde 0)
+    """
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+
+def call_agent(address, func, retries=0):
+    """
+    Hace una llamada a un agente pasando por su circuit breaker y la reintenta
+    si falla la conexion, se pasa el timeout o el agente responde con un error 5xx
+
+    :param address: direccion del agente
+    :param func: funcion sin parametros que hace la llamada
+    :param retries: numero maximo de reintentos
+    :return: lo que retorna func
+    :raise CircuitOpenError: si el agente tiene el circuito abierto
+    """
+    breaker = get_breaker(address)
+    attempt = 0
+    while True:
+        try:
+            breaker.before_call()
+        except CircuitOpenError:
+            _notify_failure(address)
+            raise
+        try:
+            result = func()
+        except (requests.ConnectionError, requests.Timeout, requests.HTTPError):
+            breaker.record_failure()
+            if attempt >= retries:
+                _notify_failure(address)
+                raise
+            time.sleep(backoff(attempt))
+            attempt += 1
+        except Exception:
+            # Cualquier otro error (p.e. una respuesta que no se puede leer)
+            # tambien cuenta, si no el circuito se quedaria medio abierto. Las
+            # interrupciones (KeyboardInterrupt, SystemExit) no son culpa del
+            # agente y no cuentan
+            breaker.record_failure()
+            raise
+        else:
+            breaker.record_success()
+            return result
+
+
+def add_failure_listener(func):
+    """
+    Registra una funcion a la que se llama con la direccion de un agente cada
+    vez que falla una llamada a ese agente (despues de los reintentos, o
+    porque tiene el circuito abierto)
+
+    :param func: funcion que recibe la direccion
+    """
+    _failure_listeners.append(func)
+
+
+def _notify_failure(address):
+    for func in _failure_listeners:
+        func(address)
+
+
+def _check_status(r):
+    if r.status_code >= 500:
+        r.raise_for_status()
+    return r
+
+
+def send_message(gmess, address, method=None, timeout=None, idempotent=None):
+    """
+    Envia un mensaje y retorna la respuesta como un grafo RDF
+
+    El mensaje va en el cuerpo de un POST. Si el agente no acepta POST (responde
+    405) se vuelve a enviar con un GET en el parametro 'content' y se recuerda
+    para los siguientes mensajes a esa direccion
+
+    El formato del mensaje se negocia con el agente (ver WIRE_FORMAT), y si los
+    dos agentes tienen activada la compresion el mensaje y la respuesta se
+    comprimen (ver Compression)
+
+    La conexion con el agente se reutiliza entre mensajes (ver get_session)
+
+    Los mensajes idempotentes se reintentan con backoff si fallan, y si un
+    agente falla repetidamente se deja de esperarlo (ver CircuitBreaker)
+
+    :param gmess: grafo con el mensaje
+    :param address: direccion del agente
+    :param method: fuerza el metodo HTTP ('POST' o 'GET')
+    :param timeout: segundos maximos de espera de la respuesta, o una tupla
+        (conexion, respuesta). Por defecto CONNECT_TIMEOUT y READ_TIMEOUT
+    :param idempotent: indica si el mensaje se puede reintentar, por defecto
+        se decide con is_idempotent
+    :return:
+    """
+    if timeout is None:
+        timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+    if idempotent is None:
+        idempotent = is_idempotent(gmess)
+    return call_agent(address, partial(_send_once, gmess, address, method, timeout),
+                      MAX_RETRIES if idempotent else 0)
+
+
+def _send_once(gmess, address, method, timeout):
+    if method is None:
+        method = _methods.get(address, DEFAULT_METHOD)
+
+    if method == 'POST':
+        fmt = _formats.get(address, DEFAULT_FORMAT)
+        r = _post(address, serialize_graph(gmess, fmt), fmt, timeout)
+        if r.status_code == 405:
+            _methods[address] = method = 'GET'
+    if method == 'GET':
+        # Los agentes que solo aceptan GET solo entienden RDF/XML
+        r = get_session(address).get(address, params={'content': serialize_graph(gmess).decode('utf-8')},
+                                     headers={'Accept': accept_header(WIRE_FORMAT)},
+                                     timeout=timeout)
+    _check_status(r)
 
     # Procesa la respuesta y la retorna como resultado como grafo
-    gr = Graph()
-    gr.parse(data=r.text)
+    fmt = mimetype(r.headers.get('Content-Type'))
+    if fmt == WIRE_FORMAT and method == 'POST':
+        _formats[address] = fmt
+    return parse_graph(r.content, fmt)
 
-    return gr
 
+def _get_executor():
+    """
+    Retorna el pool de threads del proceso donde se hacen los envios asincronos
+    """
+    global _executor, _executor_pid
 
-def get_message_properties(msg):
+    with _sessions_lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(max_workers=POOL_SIZE)
+            _executor_pid = os.getpid()
+    return _executor
+
+
+async def send_message_async(gmess, address, method=None, timeout=None):
+    """
+    Version asincrona de send_message para usar desde asyncio
+
+    El envio se hace en un thread del pool del proceso, asi se pueden tener
+    varios mensajes en vuelo a la vez
+
+    :param gmess: grafo con el mensaje
+    :param address: direccion del agente
+    :param method: fuerza el metodo HTTP ('POST' o 'GET')
+    :param timeout: segundos maximos de espera de la respuesta
+    :return: grafo de la respuesta, o asyncio.TimeoutError si se pasa el tiempo
+    """
+    loop = asyncio.get_running_loop()
+    call = partial(send_message, gmess, address, method=method, timeout=timeout)
+    future = loop.run_in_executor(_get_executor(), call)
+    if timeout is None:
+        return await future
+    if isinstance(timeout, tuple):
+        timeout = sum(timeout)
+    return await asyncio.wait_for(future, timeout)
+
+
+async def gather_messages(messages, timeout=None):
+    """
+    Envia varios mensajes a la vez y espera todas las respuestas
+
+    :param messages: lista de (grafo, direccion) o (grafo, direccion, timeout)
+    :param timeout: timeout por defecto de cada mensaje
+    :return: lista con la respuesta de cada mensaje en el mismo orden. Si un
+        envio falla en su lugar esta la excepcion
+    """
+    calls = []
+    for msg in messages:
+        gmess, address = msg[0], msg[1]
+        calls.append(send_message_async(gmess, address,
+                                        timeout=msg[2] if len(msg) > 2 else timeout))
+    return await asyncio.gather(*calls, return_exceptions=True)
+
+
+def send_messages(messages, timeout=None):
     """
-    Extrae las propiedades de un mensaje ACL como un diccionario.
-    Del contenido solo saca el primer objeto al que apunta la propiedad
+    Envia varios mensajes en paralelo desde codigo no asincrono (p.e. un
+    handler de flask). El tiempo total es el del agente que mas tarda en
+    responder, no la suma de todos
 
-    Los elementos que no estan, no aparecen en el diccionario
+    :param messages: lista de (grafo, direccion) o (grafo, direccion, timeout)
+    :param timeout: timeout por defecto de cada mensaje
+    :return: lista de respuestas (o excepciones) en el mismo orden
     """
-    props = {'performative': ACL.performative, 'sender': ACL.sender,
-             'receiver': ACL.receiver, 'ontology': ACL.ontology,
-             'conversation-id': ACL['conversation-id'],
-             'in-reply-to': ACL['in-reply-to'], 'content': ACL.content}
-    msgdic = {} # Diccionario donde se guardan los elementos del mensaje
+    return asyncio.run(gather_messages(messages, timeout))
+
+
+def send_envelope(messages, address, timeout=None):
+    """
+    Envia varios mensajes a un mismo agente en un solo sobre (una sola
+    peticion HTTP). El agente procesa cada mensaje por separado y responde con
+    otro sobre con las respuestas en el mismo orden
+
+    Si el agente no entiende los sobres se le envian los mensajes uno a uno y
+    se recuerda para la proxima vez
 
-    # Extraemos la parte del FipaAclMessage del mensaje
-    valid = msg.value(predicate=RDF.type, object=ACL.FipaAclMessage)
+    :param messages: lista de grafos con los mensajes
+    :param address: direccion del agente
+    :param timeout: segundos maximos de espera de la respuesta
+    :return: lista con el grafo de respuesta de cada mensaje
+    """
+    if timeout is None:
+        timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+    if address not in _no_batch and _methods.get(address, DEFAULT_METHOD) == 'POST':
+        fmt = _formats.get(address, DEFAULT_FORMAT)
+        body = encode_batch([(fmt, serialize_graph(gmess, fmt)) for gmess in messages])
+        retries = MAX_RETRIES if all(is_idempotent(gmess) for gmess in messages) else 0
+        r = call_agent(address, partial(_post, address, body, BATCH, timeout), retries)
+        if r.status_code == 200 and mimetype(r.headers.get('Content-Type')) == BATCH:
+            return [parse_graph(data, rfmt) for rfmt, data in decode_batch(r.content)]
+        _no_batch.add(address)
+    return [send_message(gmess, address, timeout=timeout) for gmess in messages]
+
+
+def send_batch(messages, timeout=None):
+    """
+    Envia una lista de mensajes agrupando en un sobre los que van a un mismo
+    agente. Los sobres a agentes distintos se envian en paralelo
+
+    :param messages: lista de (grafo, direccion)
+    :param timeout: segundos maximos de espera de cada sobre
+    :return: lista de respuestas en el mismo orden que los mensajes. Si el
+        envio de un sobre falla, sus mensajes tienen la excepcion como respuesta
+    """
+    groups = {}
+    for pos, (gmess, address) in enumerate(messages):
+        groups.setdefault(address, []).append(pos)
+
+    async def send_groups():
+        loop = asyncio.get_running_loop()
+        calls = [loop.run_in_executor(_get_executor(), partial(
+                     send_envelope, [messages[pos][0] for pos in positions], address, timeout))
+                 for address, positions in groups.items()]
+        return await asyncio.gather(*calls, return_exceptions=True)
+
+    answers = [None] * len(messages)
+    for positions, result in zip(groups.values(), asyncio.run(send_groups())):
+        for i, pos in enumerate(positions):
+            answers[pos] = result if isinstance(result, Exception) else result[i]
+    return answers
+
+
+# Propiedades de un mensaje ACL, indexadas por el predicado que las representa.
+# Para cada una, el nombre con el que se consulta y el atributo de MessageHeader
+_MESSAGE_PROPS = {ACL.performative: ('performative', 'performative'),
+                  ACL.sender: ('sender', 'sender'),
+                  ACL.receiver: ('receiver', 'receiver'),
+                  ACL.ontology: ('ontology', 'ontology'),
+                  ACL['conversation-id']: ('conversation-id', 'conversation_id'),
+                  ACL['in-reply-to']: ('in-reply-to', 'in_reply_to'),
+                  ACL.content: ('content', 'content')}
+
+# Atributo de MessageHeader de cada propiedad
+_HEADER_ATTRS = dict(_MESSAGE_PROPS.values())
+
+
+class MessageHeader():
+    """
+    Propiedades de un mensaje ACL (ver get_message_properties). Se consultan
+    como un diccionario, header['sender'], header.get('content') o
+    'content' in header; las que el mensaje no tiene no estan
+    """
+    __slots__ = tuple(_HEADER_ATTRS.values())
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, _HEADER_ATTRS[key])
+        except AttributeError:
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, _HEADER_ATTRS.get(key, ''), default)
+
+    def __contains__(self, key):
+        return hasattr(self, _HEADER_ATTRS.get(key, ''))
+
+    def keys(self):
+        return [key for key, attr in _HEADER_ATTRS.items() if hasattr(self, attr)]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __repr__(self):
+        return 'MessageHeader(%r)' % {key: self[key] for key in self.keys()}
+
+
+class NotUnderstood(Exception):
+    """
+    Mensaje que se ha dejado de leer porque el agente no lo entiende
+    (ver read_message). Lleva el grafo con lo que se ha leido hasta entonces
+    """
+    def __init__(self, graph):
+        super().__init__('Mensaje no entendido')
+        self.graph = graph
+
+
+def read_message(triples, graph=None, performatives=None, actions=None):
+    """
+    Construye el grafo de un mensaje a medida que llegan sus triples (ver
+    WireFormats.iter_triples)
+
+    Si se indican las performativas o las acciones que entiende el agente, se
+    deja de leer en cuanto se sabe que el mensaje no tiene una de ellas. Para
+    que el agente pueda responder, antes se espera a tener el emisor del
+    mensaje. Los mensajes en binario llevan la cabecera y el tipo del
+    contenido al principio, asi se rechazan sin leer el resto
+
+    :param triples: iterable con los triples del mensaje
+    :param graph: grafo donde se dejan los triples
+    :param performatives: performativas aceptadas (None acepta todas)
+    :param actions: tipos de contenido aceptados (None acepta todos)
+    :return: el grafo
+    :raise NotUnderstood: si el mensaje no se entiende
+    """
+    if graph is None:
+        graph = Graph()
+    if performatives is None and actions is None:
+        for triple in triples:
+            graph.add(triple)
+        return graph
+
+    message = content = None
+    has_sender = rejected = False
+    types = {}
+    for s, p, o in triples:
+        graph.add((s, p, o))
+        if p == RDF.type:
+            if o == ACL.FipaAclMessage:
+                message = s
+            elif s == content:
+                rejected = rejected or (actions is not None and o not in actions)
+            elif actions is not None:
+                types.setdefault(s, []).append(o)
+        elif p == ACL.performative:
+            rejected = rejected or (performatives is not None and o not in performatives)
+        elif p == ACL.sender:
+            has_sender = True
+        elif p == ACL.content and actions is not None:
+            content = o
+            rejected = rejected or any(t not in actions for t in types.pop(o, ()))
+        if rejected and has_sender and message is not None:
+            raise NotUnderstood(graph)
+    if rejected:
+        raise NotUnderstood(graph)
+    return graph
+
+
+def get_message_properties(msg):
+    """
+    Extrae las propiedades de un mensaje ACL como un MessageHeader, que se
+    consulta como un diccionario. Del contenido solo saca el primer objeto al
+    que apunta la propiedad
+
+    Los elementos que no estan, no aparecen en el resultado
+
+    Recorre una sola vez los triples del nodo del mensaje, que se encuentra con
+    el indice del grafo por su tipo, en lugar de hacer una busqueda en el grafo
+    por cada propiedad
+    """
+    msgdic = MessageHeader()
 
-    # Extraemos las propiedades del mensaje
-    if valid is not None:
-        for key in props:
-            val = msg.value(subject=valid, predicate=props[key])
-            if val is not None:
-                msgdic[key] = val
+    # Nodo FipaAclMessage del mensaje y sus propiedades
+    for node in msg.subjects(RDF.type, ACL.FipaAclMessage):
+        for pred, val in msg.predicate_objects(node):
+            prop = _MESSAGE_PROPS.get(pred)
+            if prop is not None and not hasattr(msgdic, prop[1]):
+                setattr(msgdic, prop[1], val)
+        break
     return msgdic
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+filename: CircuitBreaker
+
+Circuit breaker por direccion de agente
+
+Cuando un agente falla varias veces seguidas se deja de intentar enviarle
+mensajes durante un tiempo: send_message falla inmediatamente con
+CircuitOpenError en lugar de esperar el timeout de cada peticion. Pasado ese
+tiempo se deja pasar un mensaje de prueba; si va bien el agente vuelve a
+estar disponible y si falla se vuelve a esperar
+
+"""
+
+import os
+import threading
+import time
+
+from requests.exceptions import ConnectionError
+
+__author__ = 'javier'
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+# Fallos seguidos que abren el circuito
+FAILURE_THRESHOLD = int(os.environ.get('ACL_BREAKER_FAILURES', 5))
+
+# Segundos que el circuito esta abierto antes de probar otra vez
+RESET_TIMEOUT = float(os.environ.get('ACL_BREAKER_RESET', 30))
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+class CircuitOpenError(ConnectionError):
+    """
+    El circuito del agente esta abierto y no se le envia el mensaje
+    """
+    def __init__(self, address):
+        super().__init__('Circuito abierto para ' + address)
+        self.address = address
+
+
+class CircuitBreaker():
+    def __init__(self, address, failure_threshold=None, reset_timeout=None):
+        self.address = address
+        self.failure_threshold = failure_threshold or FAILURE_THRESHOLD
+        self.reset_timeout = reset_timeout or RESET_TIMEOUT
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        """
+        Comprueba si se puede enviar un mensaje al agente
+
+        :raise CircuitOpenError: si el circuito esta abierto
+        """
+        with self.lock:
+            if self.state == CLOSED:
+                return
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Dejamos pasar un solo mensaje de prueba
+                self.state = HALF_OPEN
+                return
+            raise CircuitOpenError(self.address)
+
+    def record_success(self):
+        with self.lock:
+            self.state = CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+
+def get_breaker(address):
+    """
+    Retorna el circuit breaker de una direccion de agente
+
+    :param address: direccion del agente
+    :return:
+    """
+    with _breakers_lock:
+        breaker = _breakers.get(address)
+        if breaker is None:
+            breaker = _breakers[address] = CircuitBreaker(address)
+    return breaker
+
+
+def reset_breakers():
+    """
+    Olvida el estado de todos los circuitos
+    """
+    with _breakers_lock:
+        _breakers.clear()
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+filename: Compression
+
+Compresion de los mensajes ACL entre agentes
+
+La compresion es opcional y se activa con la variable de entorno
+ACL_COMPRESSION ('gzip' o 'zstd'). Solo se comprimen los mensajes de mas de
+ACL_COMPRESSION_MIN bytes, los pequeños no compensan el coste de comprimir.
+
+La compresion se negocia con las cabeceras HTTP estandar:
+
+    - La respuesta se comprime si el emisor la acepta en su Accept-Encoding
+    - Los agentes anuncian en sus respuestas (cabecera Accept-Encoding) que
+      codificaciones entienden; a partir de entonces el emisor les puede
+      enviar los mensajes comprimidos (Content-Encoding)
+
+zstd necesita el paquete zstandard, si no esta instalado solo se usa gzip
+
+"""
+
+import gzip
+import os
+import threading
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+__author__ = 'javier'
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+
+# Codificacion con la que comprime este agente (None no comprime)
+COMPRESSION = os.environ.get('ACL_COMPRESSION') or None
+if COMPRESSION == ZSTD and zstandard is None:
+    COMPRESSION = GZIP
+
+# Tamaño minimo en bytes de un mensaje para comprimirlo
+COMPRESSION_THRESHOLD = int(os.environ.get('ACL_COMPRESSION_MIN', 4096))
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# Estadisticas de compresion por codificacion (ver compression_stats)
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def available_encodings():
+    """
+    Codificaciones que este agente sabe descomprimir
+
+    :return: lista por orden de preferencia
+    """
+    if zstandard is not None:
+        return [ZSTD, GZIP]
+    return [GZIP]
+
+
+def accept_encoding_header():
+    """
+    Valor de la cabecera Accept-Encoding que anuncia el agente
+    """
+    return ', '.join(available_encodings())
+
+
+def choose_encoding(accept_encoding):
+    """
+    Decide con que codificacion se comprime un mensaje para un agente
+
+    :param accept_encoding: cabecera Accept-Encoding del otro agente
+    :return: la codificacion, o None si no se tiene que comprimir
+    """
+    if COMPRESSION is None or not accept_encoding:
+        return None
+    accepted = [enc.split(';')[0].strip().lower() for enc in accept_encoding.split(',')]
+    if COMPRESSION in accepted:
+        return COMPRESSION
+    return None
+
+
+def _record(encoding, operation, size_in, size_out, cpu):
+    with _stats_lock:
+        stats = _stats.setdefault(encoding, {'compress': [0, 0, 0, 0.0],
+                                             'decompress': [0, 0, 0, 0.0]})[operation]
+        stats[0] += 1
+        stats[1] += size_in
+        stats[2] += size_out
+        stats[3] += cpu
+
+
+def compress(data, encoding):
+    """
+    Comprime un mensaje
+
+    :param data: bytes
+    :param encoding: 'gzip' o 'zstd'
+    :return: bytes comprimidos
+    """
+    t0 = time.thread_time()
+    if encoding == ZSTD:
+        out = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    else:
+        out = gzip.compress(data, compresslevel=GZIP_LEVEL)
+    _record(encoding, 'compress', len(data), len(out), time.thread_time() - t0)
+    return out
+
+
+def decompress(data, encoding):
+    """
+    Descomprime un mensaje
+
+    :param data: bytes comprimidos
+    :param encoding: valor de la cabecera Content-Encoding
+    :return: bytes
+    """
+    encoding = encoding.strip().lower()
+    t0 = time.thread_time()
+    if encoding == ZSTD:
+        if zstandard is None:
+            raise ValueError('Mensaje comprimido con zstd y el paquete zstandard no esta instalado')
+        out = zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    elif encoding in (GZIP, 'x-gzip'):
+        out = gzip.decompress(data)
+    elif encoding == 'identity':
+        return data
+    else:
+        raise ValueError('Codificacion desconocida: ' + encoding)
+    _record(encoding, 'decompress', len(data), len(out), time.thread_time() - t0)
+    return out
+
+
+def decompress_stream(stream, encoding):
+    """
+    Descomprime un mensaje a medida que se lee de un stream
+
+    Los bytes leidos y el tiempo de CPU se cuentan en las estadisticas de
+    compresion al cerrar el stream descomprimido
+
+    :param stream: objeto con el metodo read
+    :param encoding: valor de la cabecera Content-Encoding
+    :return: objeto con los metodos read y close que retorna los bytes
+        descomprimidos
+    """
+    encoding = encoding.strip().lower()
+    if encoding == 'identity':
+        return stream
+    if encoding == ZSTD:
+        if zstandard is None:
+            raise ValueError('Mensaje comprimido con zstd y el paquete zstandard no esta instalado')
+    elif encoding not in (GZIP, 'x-gzip'):
+        raise ValueError('Codificacion desconocida: ' + encoding)
+    return DecompressingReader(stream, encoding)
+
+
+class _CountingStream():
+    """
+    Stream que cuenta los bytes que se leen
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.size += len(data)
+        return data
+
+
+class DecompressingReader():
+    """
+    Stream descomprimido de decompress_stream. Cuenta los bytes comprimidos
+    que lee, los descomprimidos que retorna y el tiempo de CPU, y los guarda
+    en las estadisticas al cerrarlo. No cierra el stream comprimido
+    """
+    def __init__(self, stream, encoding):
+        self.encoding = encoding
+        self.source = _CountingStream(stream)
+        if encoding == ZSTD:
+            self.reader = zstandard.ZstdDecompressor().stream_reader(self.source, closefd=False)
+        else:
+            self.reader = gzip.GzipFile(fileobj=self.source, mode='rb')
+        self.size = 0
+        self.cpu = 0.0
+        self.closed = False
+
+    def read(self, size=-1):
+        t0 = time.thread_time()
+        data = self.reader.read(size)
+        self.cpu += time.thread_time() - t0
+        self.size += len(data)
+        return data
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.reader.close()
+        _record(self.encoding, 'decompress', self.source.size, self.size, self.cpu)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def maybe_compress(data, encoding):
+    """
+    Comprime un mensaje si hay codificacion y supera el tamaño minimo
+
+    :param data: bytes
+    :param encoding: codificacion negociada (puede ser None)
+    :return: (bytes, codificacion usada o None)
+    """
+    if encoding is None or len(data) < COMPRESSION_THRESHOLD:
+        return data, None
+    return compress(data, encoding), encoding
+
+
+def compression_stats():
+    """
+    Estadisticas de compresion del proceso
+
+    :return: diccionario por codificacion y operacion con el numero de
+        mensajes, bytes sin comprimir, bytes comprimidos, ratio de compresion
+        y tiempo de CPU en milisegundos
+    """
+    result = {}
+    with _stats_lock:
+        for encoding, ops in _stats.items():
+            for operation, (count, size_in, size_out, cpu) in ops.items():
+                if count == 0:
+                    continue
+                raw, packed = (size_in, size_out) if operation == 'compress' else (size_out, size_in)
+                result.setdefault(encoding, {})[operation] = {
+                    'messages': count,
+                    'bytes': raw,
+                    'compressed_bytes': packed,
+                    'ratio': raw / packed if packed else 0.0,
+                    'cpu_ms': cpu * 1000}
+    return result
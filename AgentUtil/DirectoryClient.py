@@ -0,0 +1,549 @@
+# -*- coding: utf-8 -*-
+"""
+filename: DirectoryClient
+
+Busqueda de agentes en el servicio de directorio desde los otros agentes
+
+Las respuestas del directorio se guardan en una cache en memoria durante
+DIRECTORY_TTL segundos, asi la mayoria de mensajes a otro agente no necesitan
+preguntar antes al directorio. Tambien se guarda que un tipo de agente no
+esta registrado (durante DIRECTORY_NEGATIVE_TTL segundos), para no preguntar
+por el en cada mensaje.
+
+Para los tipos de agente de los que se necesitan todos los agentes (ver
+agents) el agente se suscribe al directorio, que le avisa de las altas y
+bajas en su entrypoint de comunicacion. El agente tiene que pasar estos avisos
+a process_event
+
+Los tipos de agente que un agente necesita juntos (related) se buscan en un
+solo mensaje (accion MultiSearch): cuando falta uno en la cache se piden
+tambien los demas que falten. resolve_many busca varios tipos a la vez
+
+Si hay varias instancias de un tipo de agente, resolve las reparte entre las
+peticiones segun DIRECTORY_BALANCE: por turnos ('round-robin'), al azar
+('random') o la que tiene menos carga ('least-loaded', con la carga que
+comunican los agentes al directorio y las peticiones que se les han enviado
+desde entonces)
+
+El registro en el directorio caduca si no se renueva (lease de LEASE_TTL
+segundos). Los agentes llaman a keep_registered desde su agentbehavior1, que
+lo renueva periodicamente y vuelve a registrar el agente si el directorio lo
+ha olvidado (p.e. porque se ha reiniciado). El lease del resolver (lease) se
+pide al registrarse y se vuelve a pedir en cada renovacion
+
+Si hay replicas de solo lectura del directorio (DIRECTORY_REPLICAS, lista de
+direcciones separadas por comas) las busquedas se reparten entre el
+directorio y las replicas, y si uno no responde se pregunta al siguiente. Los
+registros, bajas y suscripciones siempre van al directorio principal
+
+Cuando falla una llamada a un agente (ver ACLMessages.add_failure_listener) se
+olvida su entrada y la siguiente busqueda vuelve a preguntar al directorio. Si
+el directorio no responde se usa la ultima respuesta aunque este caducada
+
+"""
+
+import itertools
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+from rdflib import Graph, Literal, RDF
+import requests
+from rdflib.namespace import FOAF
+
+from AgentUtil.ACLMessages import build_message, send_message, get_message_properties, add_failure_listener
+from AgentUtil.Agent import Agent
+from AgentUtil.OntoNamespaces import ACL, DSO
+
+__author__ = 'javier'
+
+# Segundos que se guarda la direccion de un agente
+DIRECTORY_TTL = float(os.environ.get('DIRECTORY_TTL', 60))
+
+# Segundos que se guarda que no hay ningun agente de un tipo
+DIRECTORY_NEGATIVE_TTL = float(os.environ.get('DIRECTORY_NEGATIVE_TTL', 5))
+
+# Como se reparten las peticiones entre las instancias de un tipo de agente
+DIRECTORY_BALANCE = os.environ.get('DIRECTORY_BALANCE', 'round-robin')
+
+# Segundos entre los informes de carga al directorio (ver LoadReporter)
+LOAD_REPORT_INTERVAL = float(os.environ.get('DIRECTORY_LOAD_INTERVAL', 10))
+
+# Segundos tras los que se renueva una suscripcion (por si el directorio se
+# ha reiniciado y la ha perdido)
+SUBSCRIPTION_TTL = float(os.environ.get('DIRECTORY_SUBSCRIPTION_TTL', 300))
+
+# Segundos que dura el registro en el directorio si no se renueva (tiene que
+# coincidir con el del directorio, 0 no caduca)
+LEASE_TTL = float(os.environ.get('DIRECTORY_LEASE', 30))
+
+# Direcciones de las replicas del directorio, separadas por comas
+DIRECTORY_REPLICAS = [address.strip() for address in os.environ.get('DIRECTORY_REPLICAS', '').split(',')
+                      if address.strip()]
+
+# Logger que configuran los agentes con config_logger
+logger = logging.getLogger('log')
+
+
+class _Instances():
+    """
+    Agentes de un tipo guardados en la cache, con su carga
+    """
+    __slots__ = ('expires', 'agents', 'loads')
+
+    def __init__(self, expires, agents, loads):
+        self.expires = expires
+        self.agents = agents
+        self.loads = loads
+
+
+class DirectoryResolver():
+    def __init__(self, agent, directory, ttl=None, negative_ttl=None, balance=None, replicas=None, related=None):
+        """
+        :param agent: agente que hace las busquedas
+        :param directory: agente del servicio de directorio
+        :param ttl: segundos que se guarda la direccion de un agente
+        :param negative_ttl: segundos que se guarda que no hay un tipo de agente
+        :param balance: como se reparten las peticiones entre instancias
+        :param replicas: direcciones de las replicas del directorio, por
+            defecto DIRECTORY_REPLICAS
+        :param related: tipos de agente que se buscan juntos cuando falta
+            alguno en la cache
+        """
+        self.agent = agent
+        self.directory = directory
+        if replicas is None:
+            replicas = DIRECTORY_REPLICAS
+        # Directorios que responden busquedas, el principal y sus replicas
+        self.readers = [directory] + [Agent(directory.name, directory.uri, address, None) for address in replicas]
+        self.next_reader = itertools.count()
+        self.related = list(related or ())
+        self.ttl = DIRECTORY_TTL if ttl is None else ttl
+        self.negative_ttl = DIRECTORY_NEGATIVE_TTL if negative_ttl is None else negative_ttl
+        self.balance = balance or DIRECTORY_BALANCE
+        self.cache = {}
+        self.turns = {}
+        self.subscriptions = {}
+        self.lock = threading.Lock()
+        self.msgcnt = itertools.count()
+        # Segundos de lease con los que se registra el agente, se vuelven a
+        # pedir en cada renovacion
+        self.lease = LEASE_TTL
+        add_failure_listener(self.invalidate_address)
+
+    def resolve(self, agent_type):
+        """
+        Busca un agente de un tipo, en la cache o preguntando al directorio.
+        Si hay varios se elige uno segun el reparto de carga
+
+        :param agent_type: tipo de agente
+        :return: Agent con el nombre, URI y direccion, o None si no hay
+            ninguno registrado
+        """
+        cached = self.cache.get(agent_type)
+        if cached is None or cached.expires <= time.monotonic():
+            missing = [agent_type]
+            if agent_type in self.related:
+                missing += [t for t in self.related if t != agent_type and self._stale(t)]
+            try:
+                if len(missing) == 1:
+                    self._store(agent_type, self.search(agent_type))
+                else:
+                    for t, found in self.search_many(missing).items():
+                        self._store(t, found)
+            except requests.RequestException:
+                if cached is None or not cached.agents:
+                    raise
+                logger.info('El directorio no responde, usamos la ultima direccion de ' + str(agent_type))
+            else:
+                cached = self.cache[agent_type]
+
+        agents = cached.agents
+        if not agents:
+            return None
+        if len(agents) == 1:
+            return agents[0]
+        return self._select(agent_type, cached)
+
+    def resolve_many(self, agent_types):
+        """
+        Busca un agente de cada uno de unos tipos. Los que no estan en la
+        cache se piden al directorio en un solo mensaje
+
+        :param agent_types: tipos de agente
+        :return: diccionario de tipo de agente a Agent (o None si no hay
+            ninguno registrado)
+        """
+        missing = [t for t in agent_types if self._stale(t)]
+        if len(missing) > 1:
+            try:
+                for t, found in self.search_many(missing).items():
+                    self._store(t, found)
+            except requests.RequestException:
+                # resolve usara las entradas caducadas si las hay
+                logger.info('El directorio no responde a la busqueda de varios tipos')
+        return {t: self.resolve(t) for t in agent_types}
+
+    def _stale(self, agent_type):
+        cached = self.cache.get(agent_type)
+        return cached is None or cached.expires <= time.monotonic()
+
+    def _store(self, agent_type, found):
+        """
+        Guarda en la cache los agentes de un tipo que ha retornado el directorio
+        """
+        ttl = self.ttl if found else self.negative_ttl
+        cached = _Instances(time.monotonic() + ttl,
+                            [agent for agent, _ in found],
+                            [load for _, load in found])
+        with self.lock:
+            self.cache[agent_type] = cached
+
+    def _select(self, agent_type, cached):
+        with self.lock:
+            agents = cached.agents
+            if self.balance == 'random':
+                return random.choice(agents)
+            if self.balance == 'least-loaded':
+                pos = min(range(len(agents)), key=cached.loads.__getitem__)
+                # Contamos la peticion que le enviamos hasta que comunique su carga
+                cached.loads[pos] += 1
+                return agents[pos]
+            turn = self.turns.get(agent_type)
+            if turn is None:
+                turn = self.turns[agent_type] = itertools.count()
+            return agents[next(turn) % len(agents)]
+
+    def agents(self, agent_type):
+        """
+        Todos los agentes registrados de un tipo. La primera vez el agente se
+        suscribe al tipo en el directorio y despues la lista se mantiene con
+        los avisos que envia el directorio (ver process_event)
+
+        :param agent_type: tipo de agente
+        :return: lista de Agent
+        """
+        sub = self.subscriptions.get(agent_type)
+        if sub is not None and sub[0] > time.monotonic():
+            return list(sub[1].values())
+
+        try:
+            members = self.subscribe(agent_type)
+        except requests.RequestException:
+            if sub is not None:
+                logger.info('El directorio no responde, usamos la ultima lista de ' + str(agent_type))
+                return list(sub[1].values())
+            raise
+
+        with self.lock:
+            self.subscriptions[agent_type] = (time.monotonic() + SUBSCRIPTION_TTL, members)
+        return list(members.values())
+
+    def subscribe(self, agent_type):
+        """
+        Suscribe el agente a las altas y bajas de un tipo de agente
+
+        :param agent_type: tipo de agente
+        :return: diccionario URI -> Agent con los agentes registrados del tipo
+        """
+        logger.info('Nos suscribimos en el servicio de registro')
+
+        gmess = Graph()
+        gmess.bind('foaf', FOAF)
+        gmess.bind('dso', DSO)
+        sub_obj = self.agent.uri + '-subscribe'
+        gmess.add((sub_obj, RDF.type, DSO.Subscribe))
+        gmess.add((sub_obj, DSO.Uri, self.agent.uri))
+        gmess.add((sub_obj, DSO.Address, Literal(self.agent.address)))
+        gmess.add((sub_obj, DSO.AgentType, agent_type))
+
+        gr = self._request(gmess, sub_obj)
+        content = get_message_properties(gr).get('content')
+        members = {}
+        if content is not None:
+            for agent, _ in agent_list(gr, content):
+                members[agent.uri] = agent
+        return members
+
+    def deregister(self):
+        """
+        Da de baja el agente en el directorio
+        """
+        gmess = Graph()
+        gmess.bind('dso', DSO)
+        dereg_obj = self.agent.uri + '-deregister'
+        gmess.add((dereg_obj, RDF.type, DSO.Deregister))
+        gmess.add((dereg_obj, DSO.Uri, self.agent.uri))
+        return self._request(gmess, dereg_obj)
+
+    def process_event(self, gm, content):
+        """
+        Aplica un aviso de alta o baja del directorio
+
+        :param gm: grafo con el mensaje
+        :param content: contenido del mensaje
+        :return: True si el mensaje era un aviso del directorio
+        """
+        event = gm.value(subject=content, predicate=RDF.type)
+        if event not in (DSO.Register, DSO.Deregister):
+            return False
+
+        agent_type = gm.value(subject=content, predicate=DSO.AgentType)
+        agent = Agent(gm.value(subject=content, predicate=FOAF.name),
+                      gm.value(subject=content, predicate=DSO.Uri),
+                      gm.value(subject=content, predicate=DSO.Address),
+                      None)
+        logger.info('Aviso del directorio: ' + str(event) + ' ' + str(agent.uri))
+
+        with self.lock:
+            sub = self.subscriptions.get(agent_type)
+            if sub is not None:
+                if event == DSO.Register:
+                    sub[1][agent.uri] = agent
+                else:
+                    sub[1].pop(agent.uri, None)
+            cached = self.cache.get(agent_type)
+            if cached is not None:
+                self._remove(cached, lambda a: a.uri == agent.uri)
+                if event == DSO.Register:
+                    cached.agents = cached.agents + [agent]
+                    cached.loads = cached.loads + [0.0]
+                    cached.expires = max(cached.expires, time.monotonic() + self.negative_ttl)
+        return True
+
+    @staticmethod
+    def _remove(cached, match):
+        keep = [i for i, a in enumerate(cached.agents) if not match(a)]
+        if len(keep) != len(cached.agents):
+            # Se sustituyen las listas para no cambiarlas mientras se usan
+            cached.agents = [cached.agents[i] for i in keep]
+            cached.loads = [cached.loads[i] for i in keep]
+
+    def _request(self, gmess, content):
+        msg = build_message(gmess, perf=ACL.request,
+                            sender=self.agent.uri,
+                            receiver=self.directory.uri,
+                            content=content,
+                            msgcnt=next(self.msgcnt))
+        return send_message(msg, self.directory.address)
+
+    def _read(self, gmess, content):
+        """
+        Envia una busqueda a uno de los directorios, por turnos. Si no
+        responde se prueba el siguiente
+        """
+        start = next(self.next_reader)
+        for i in range(len(self.readers)):
+            reader = self.readers[(start + i) % len(self.readers)]
+            msg = build_message(gmess, perf=ACL.request,
+                                sender=self.agent.uri,
+                                receiver=reader.uri,
+                                content=content,
+                                msgcnt=next(self.msgcnt))
+            try:
+                return send_message(msg, reader.address)
+            except requests.RequestException:
+                if i == len(self.readers) - 1:
+                    raise
+                logger.info('El directorio ' + str(reader.address) + ' no responde, probamos otro')
+
+    def search(self, agent_type):
+        """
+        Pregunta al directorio por los agentes de un tipo, sin usar la cache
+
+        :param agent_type: tipo de agente
+        :return: lista de (Agent, carga)
+        """
+        logger.info('Buscamos en el servicio de registro')
+
+        gmess = Graph()
+        gmess.bind('foaf', FOAF)
+        gmess.bind('dso', DSO)
+        reg_obj = self.agent.uri + '-search'
+        gmess.add((reg_obj, RDF.type, DSO.Search))
+        gmess.add((reg_obj, DSO.AgentType, agent_type))
+        gmess.add((reg_obj, DSO.SearchMode, Literal('all')))
+
+        gr = self._read(gmess, reg_obj)
+        logger.info('Recibimos informacion del agente')
+
+        content = get_message_properties(gr).get('content')
+        if content is None:
+            return []
+        return agent_list(gr, content)
+
+    def search_many(self, agent_types=None):
+        """
+        Pregunta al directorio por los agentes de varios tipos en un solo
+        mensaje, sin usar la cache
+
+        :param agent_types: tipos de agente, None para todos los registrados
+        :return: diccionario de tipo de agente a lista de (Agent, carga)
+        """
+        logger.info('Buscamos varios tipos en el servicio de registro')
+
+        gmess = Graph()
+        gmess.bind('dso', DSO)
+        reg_obj = self.agent.uri + '-multisearch'
+        gmess.add((reg_obj, RDF.type, DSO.MultiSearch))
+        for agent_type in agent_types or ():
+            gmess.add((reg_obj, DSO.AgentType, agent_type))
+
+        gr = self._read(gmess, reg_obj)
+        content = get_message_properties(gr).get('content')
+        found = {agent_type: [] for agent_type in agent_types or ()}
+        if content is None:
+            return found
+        for bag in gr.objects(subject=content, predicate=DSO.Result):
+            found[gr.value(subject=bag, predicate=DSO.AgentType)] = agent_list(gr, bag)
+        return found
+
+    def report_load(self, load):
+        """
+        Comunica al directorio la carga del agente
+
+        :param load: carga (p.e. peticiones por segundo)
+        """
+        gmess = Graph()
+        gmess.bind('dso', DSO)
+        load_obj = self.agent.uri + '-load'
+        gmess.add((load_obj, RDF.type, DSO.UpdateLoad))
+        gmess.add((load_obj, DSO.Uri, self.agent.uri))
+        gmess.add((load_obj, DSO.Load, Literal(float(load))))
+        # Comunicar la carga tambien renueva el lease
+        gmess.add((load_obj, DSO.Lease, Literal(float(self.lease))))
+        return self._request(gmess, load_obj)
+
+    def renew(self):
+        """
+        Renueva el lease del registro del agente en el directorio
+
+        :return: False si el directorio ya no tiene registrado el agente
+        """
+        gmess = Graph()
+        gmess.bind('dso', DSO)
+        renew_obj = self.agent.uri + '-renew'
+        gmess.add((renew_obj, RDF.type, DSO.Renew))
+        gmess.add((renew_obj, DSO.Uri, self.agent.uri))
+        gmess.add((renew_obj, DSO.Lease, Literal(float(self.lease))))
+        gr = self._request(gmess, renew_obj)
+        return get_message_properties(gr).get('performative') == ACL.confirm
+
+    def invalidate(self, agent_type=None):
+        """
+        Olvida la entrada de un tipo de agente, o todas
+        """
+        with self.lock:
+            if agent_type is None:
+                self.cache.clear()
+            else:
+                self.cache.pop(agent_type, None)
+
+    def invalidate_address(self, address):
+        """
+        Olvida las entradas que apuntan a una direccion
+        """
+        with self.lock:
+            for agent_type, cached in list(self.cache.items()):
+                self._remove(cached, lambda a: str(a.address) == str(address))
+                if not cached.agents:
+                    del self.cache[agent_type]
+
+
+class LoadReporter():
+    """
+    Mide la carga del agente (peticiones por segundo) y la comunica al
+    directorio cada LOAD_REPORT_INTERVAL segundos. Se usa alrededor de cada
+    peticion que atiende el agente:
+
+        with carga:
+            return serve_message(request, procesar_mensaje)
+    """
+    def __init__(self, resolver, interval=None):
+        self.resolver = resolver
+        self.interval = LOAD_REPORT_INTERVAL if interval is None else interval
+        self.count = 0
+        self.since = time.monotonic()
+        self.reporting = False
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        with self.lock:
+            self.count += 1
+            now = time.monotonic()
+            if self.reporting or now - self.since < self.interval:
+                return self
+            load = self.count / (now - self.since)
+            self.count = 0
+            self.since = now
+            self.reporting = True
+        # El informe se envia aparte para no retrasar la peticion
+        threading.Thread(target=self._report, args=(load,), daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def _report(self, load):
+        try:
+            self.resolver.report_load(load)
+        except requests.RequestException:
+            logger.info('No se ha podido comunicar la carga al directorio')
+        finally:
+            self.reporting = False
+
+
+def keep_registered(register, resolver, cola=None, interval=None):
+    """
+    Mantiene el registro del agente en el directorio renovando su lease. No
+    retorna hasta que llega un 0 a la cola (si no hay cola no retorna)
+
+    :param register: funcion que registra el agente (register_message), con
+        el lease del resolver
+    :param resolver: DirectoryResolver del agente
+    :param cola: cola del agentbehavior1 por la que se indica que pare
+    :param interval: segundos entre renovaciones, por defecto un tercio del lease
+    """
+    if not resolver.lease:
+        return
+    if interval is None:
+        interval = resolver.lease / 3
+    while True:
+        if cola is None:
+            time.sleep(interval)
+        else:
+            try:
+                if cola.get(timeout=interval) == 0:
+                    return
+            except queue.Empty:
+                pass
+        try:
+            if not resolver.renew():
+                logger.info('El directorio no tiene nuestro registro, nos volvemos a registrar')
+                register()
+        except requests.RequestException:
+            logger.info('No se ha podido renovar el registro en el directorio')
+
+
+def agent_list(gr, bag):
+    """
+    Agentes de una lista (Bag) de una respuesta del directorio
+
+    :param gr: grafo con la respuesta
+    :param bag: nodo de la lista
+    :return: lista de (Agent, carga)
+    """
+    prefix = 'http://www.w3.org/1999/02/22-rdf-syntax-ns#_'
+    members = sorted((int(p[len(prefix):]), o) for p, o in gr.predicate_objects(bag) if p.startswith(prefix))
+    agents = []
+    for _, o in members:
+        load = gr.value(subject=o, predicate=DSO.Load)
+        agents.append((Agent(gr.value(subject=o, predicate=FOAF.name),
+                             gr.value(subject=o, predicate=DSO.Uri),
+                             gr.value(subject=o, predicate=DSO.Address),
+                             None),
+                       float(load) if load is not None else 0.0))
+    return agents
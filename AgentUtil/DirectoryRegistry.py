@@ -0,0 +1,451 @@
+# -*- coding: utf-8 -*-
+"""
+filename: DirectoryRegistry
+
+Registro de agentes del servicio de directorio
+
+Los agentes registrados se guardan en diccionarios indexados por URI, nombre
+y tipo de agente, de manera que las busquedas del directorio son un acceso a
+un diccionario. El registro mantiene ademas el grafo RDF con los mismos datos
+(la vista que se muestra en /Info)
+
+Si hay varios agentes de un tipo, select elige uno por turnos (round-robin),
+al azar o el que tiene menos carga segun la que comunican los agentes
+
+Tambien guarda las suscripciones de los agentes que quieren recibir avisos
+de las altas y bajas de un tipo de agente
+
+Los registros pueden tener un lease: si el agente no lo renueva antes de que
+caduque, sweep lo da de baja. Asi las busquedas no retornan agentes que han
+caido sin darse de baja
+
+Si tiene un store (ver AgentUtil.DirectoryStore) le pasa cada alta, baja y
+suscripcion para que el registro se pueda recuperar al reiniciar
+
+Cada tipo de agente tiene una version que cambia con cualquier cambio de sus
+agentes (altas, bajas y carga), para saber cuando hay que volver a construir
+una respuesta guardada del directorio (version)
+
+Los ultimos CHANGES_KEPT cambios se guardan tambien en memoria numerados, para
+que las replicas del directorio pidan los que les faltan (changes_since). Entre
+ellos estan las renovaciones de leases y los cambios de carga, que no se pasan
+al store, para que las replicas no den de baja agentes que renuevan y elijan
+por carga con la misma carga que el principal
+
+Las tuplas de agentes de cada tipo no se modifican nunca, al registrar o dar
+de baja un agente se sustituyen por una nueva. Asi las busquedas no necesitan
+el lock ni copiar nada
+
+"""
+
+import collections
+import itertools
+import os
+import random
+import threading
+import time
+
+from rdflib import RDF
+from rdflib.namespace import FOAF
+
+from AgentUtil.DirectoryStore import entry_record, registry_state
+from AgentUtil.OntoNamespaces import DSO
+
+__author__ = 'javier'
+
+# Modo de busqueda que retorna todos los agentes de un tipo
+ALL = 'all'
+
+# Formas de elegir un agente entre los de un tipo (ver AgentRegistry.select)
+FIRST = 'first'
+ROUND_ROBIN = 'round-robin'
+RANDOM = 'random'
+LEAST_LOADED = 'least-loaded'
+SELECTION_MODES = (FIRST, ROUND_ROBIN, RANDOM, LEAST_LOADED)
+
+# Cambios que se guardan en memoria para las replicas
+CHANGES_KEPT = int(os.environ.get('DIRECTORY_CHANGES_KEPT', 10000))
+
+# Numeros de version de los tipos de agente, compartidos por todos los
+# registros para que no se repitan si se sustituye el registro
+_versions = itertools.count(1)
+
+
+class AgentEntry():
+    """
+    Datos de un agente registrado
+    """
+    __slots__ = ('uri', 'name', 'address', 'agent_type', 'load', 'lease', 'expires')
+
+    def __init__(self, uri, name, address, agent_type, load=0.0, lease=None):
+        self.uri = uri
+        self.name = name
+        self.address = address
+        self.agent_type = agent_type
+        self.load = load
+        # Segundos del lease, y instante (time.monotonic) en que caduca. None
+        # si no caduca
+        self.lease = lease or None
+        self.expires = _expires(lease)
+
+
+class AgentRegistry():
+    def __init__(self, graph=None):
+        """
+        :param graph: grafo RDF que se mantiene con los agentes registrados
+        """
+        self.graph = graph
+        self.by_uri = {}
+        self.by_name = {}
+        self.by_type = {}
+        self.subscriptions = {}
+        self.turns = {}
+        self.versions = {}
+        self.store = None
+        # Numero del ultimo cambio y los ultimos cambios (numero, cambio)
+        self.seq = 0
+        self.changes = collections.deque(maxlen=CHANGES_KEPT)
+        self.lock = threading.Lock()
+
+    def register(self, uri, name, address, agent_type, lease=None):
+        """
+        Registra un agente. Si ya estaba registrado se sustituyen sus datos
+
+        :param lease: segundos que dura el registro si no se renueva, None o 0
+            si no caduca
+        :return: la entrada del agente
+        """
+        entry = AgentEntry(uri, name, address, agent_type, lease=lease)
+        with self.lock:
+            old, pos = self._remove(uri)
+            self.by_uri[uri] = entry
+            if name is not None:
+                self.by_name[name] = entry
+            entries = self.by_type.get(agent_type, ())
+            if old is not None and old.agent_type == agent_type:
+                # Si se vuelve a registrar mantiene su posicion
+                entries = entries[:pos] + (entry,) + entries[pos:]
+            else:
+                entries = entries + (entry,)
+            self.by_type[agent_type] = entries
+            self.versions[agent_type] = next(_versions)
+            if self.graph is not None:
+                self.graph.add((uri, RDF.type, FOAF.Agent))
+                self.graph.add((uri, FOAF.name, name))
+                self.graph.add((uri, DSO.Address, address))
+                self.graph.add((uri, DSO.AgentType, agent_type))
+            self._log(entry_record(entry))
+        return entry
+
+    def deregister(self, uri):
+        """
+        Da de baja un agente
+
+        :return: la entrada que tenia el agente, o None si no estaba
+        """
+        with self.lock:
+            self._unsubscribe(uri)
+            entry = self._remove(uri)[0]
+            if entry is not None:
+                self._log({'op': 'deregister', 'uri': str(uri)})
+            return entry
+
+    def renew(self, uri, lease=None):
+        """
+        Renueva el lease de un agente
+
+        :param lease: segundos que dura el registro a partir de ahora, None o 0
+            si deja de caducar
+        :return: False si el agente no esta registrado (su lease ya habia
+            caducado y se tiene que volver a registrar)
+        """
+        with self.lock:
+            entry = self.by_uri.get(uri)
+            if entry is None:
+                return False
+            entry.lease = lease or None
+            entry.expires = _expires(lease)
+            self._log({'op': 'renew', 'uri': str(uri), 'lease': entry.lease}, persist=False)
+        return True
+
+    def sweep(self, now=None):
+        """
+        Da de baja los agentes con el lease caducado
+
+        :param now: instante (time.monotonic) con el que se comparan los leases
+        :return: lista con las entradas de los agentes dados de baja
+        """
+        if now is None:
+            now = time.monotonic()
+        expired = [entry for entry in list(self.by_uri.values())
+                   if entry.expires is not None and entry.expires <= now]
+        removed = []
+        with self.lock:
+            for entry in expired:
+                # Puede haberse renovado o registrado otra vez mientras tanto
+                current = self.by_uri.get(entry.uri)
+                if current is None or current.expires is None or current.expires > now:
+                    continue
+                self._unsubscribe(entry.uri)
+                removed.append(self._remove(entry.uri)[0])
+                self._log({'op': 'deregister', 'uri': str(entry.uri)})
+        return removed
+
+    def _remove(self, uri):
+        """
+        Quita un agente de los indices y del grafo
+
+        :return: (entrada del agente, posicion entre los de su tipo), o
+            (None, None) si no estaba
+        """
+        entry = self.by_uri.pop(uri, None)
+        if entry is None:
+            return None, None
+        if self.by_name.get(entry.name) is entry:
+            del self.by_name[entry.name]
+        entries = self.by_type[entry.agent_type]
+        self.versions[entry.agent_type] = next(_versions)
+        pos = entries.index(entry)
+        remaining = entries[:pos] + entries[pos + 1:]
+        if remaining:
+            self.by_type[entry.agent_type] = remaining
+        else:
+            del self.by_type[entry.agent_type]
+        if self.graph is not None:
+            self.graph.remove((uri, None, None))
+        return entry, pos
+
+    def subscribe(self, subscriber, address, agent_type):
+        """
+        Suscribe un agente a las altas y bajas de un tipo de agente
+
+        :param subscriber: URI del agente suscrito
+        :param address: direccion a la que se envian los avisos
+        :param agent_type: tipo de agente
+        """
+        with self.lock:
+            current = self.subscriptions.get(agent_type, ())
+            self.subscriptions[agent_type] = tuple(s for s in current if s[0] != subscriber) + ((subscriber, address),)
+            self._log({'op': 'subscribe', 'subscriber': str(subscriber), 'address': str(address),
+                       'type': str(agent_type)})
+
+    def unsubscribe(self, subscriber):
+        """
+        Quita todas las suscripciones de un agente
+        """
+        with self.lock:
+            if self._unsubscribe(subscriber):
+                self._log({'op': 'unsubscribe', 'subscriber': str(subscriber)})
+
+    def _unsubscribe(self, subscriber):
+        """
+        :return: True si el agente tenia alguna suscripcion
+        """
+        found = False
+        for agent_type, current in list(self.subscriptions.items()):
+            remaining = tuple(s for s in current if s[0] != subscriber)
+            if len(remaining) != len(current):
+                found = True
+                if remaining:
+                    self.subscriptions[agent_type] = remaining
+                else:
+                    del self.subscriptions[agent_type]
+        return found
+
+    def _log(self, record, persist=True):
+        """
+        Numera un cambio y lo pasa al store, si hay. Se llama con el lock cogido
+
+        :param persist: si se pasa al store (las renovaciones y la carga solo
+            son para las replicas)
+        """
+        self.seq += 1
+        self.changes.append((self.seq, record))
+        if self.store is None or not persist:
+            return
+        self.store.append(record)
+        if self.store.should_snapshot():
+            self.store.snapshot(self)
+
+    def changes_since(self, seq):
+        """
+        Cambios posteriores a uno
+
+        :param seq: numero del ultimo cambio que se conoce
+        :return: lista de (numero, cambio), o None si ya no se tienen todos
+            los cambios desde seq (hay que pedir el estado completo)
+        """
+        with self.lock:
+            if seq > self.seq:
+                return None
+            if seq == self.seq:
+                return []
+            if not self.changes or self.changes[0][0] > seq + 1:
+                return None
+            return [change for change in self.changes if change[0] > seq]
+
+    def state(self):
+        """
+        Estado completo del registro (ver DirectoryStore.registry_state)
+
+        :return: (numero del ultimo cambio, estado)
+        """
+        with self.lock:
+            return self.seq, registry_state(self)
+
+    def clear(self):
+        """
+        Quita todos los agentes y suscripciones, sin pasarlo al store
+        """
+        with self.lock:
+            for uri in list(self.by_uri):
+                self._remove(uri)
+            self.subscriptions.clear()
+
+    def snapshot(self):
+        """
+        Escribe una foto del registro en el store, si hay
+        """
+        with self.lock:
+            if self.store is not None:
+                self.store.snapshot(self)
+
+    def subscribers(self, agent_type):
+        """
+        Agentes suscritos a un tipo de agente
+
+        :return: tupla de (URI, direccion)
+        """
+        return self.subscriptions.get(agent_type, ())
+
+    def get(self, uri):
+        """
+        Agente con una URI, o None
+        """
+        return self.by_uri.get(uri)
+
+    def find_by_name(self, name):
+        """
+        Agente con un nombre, o None
+        """
+        return self.by_name.get(name)
+
+    def of_type(self, agent_type):
+        """
+        Agentes de un tipo por orden de registro
+
+        :return: tupla de entradas (vacia si no hay ninguno)
+        """
+        return self.by_type.get(agent_type, ())
+
+    def first_of_type(self, agent_type):
+        """
+        Primer agente registrado de un tipo, o None
+        """
+        entries = self.by_type.get(agent_type)
+        return entries[0] if entries else None
+
+    def select(self, agent_type, mode=FIRST):
+        """
+        Elige uno de los agentes de un tipo
+
+        :param agent_type: tipo de agente
+        :param mode: FIRST, ROUND_ROBIN, RANDOM o LEAST_LOADED
+        :return: la entrada del agente, o None si no hay ninguno
+        """
+        entries = self.by_type.get(agent_type)
+        if not entries:
+            return None
+        if mode == ROUND_ROBIN:
+            turn = self.turns.get(agent_type)
+            if turn is None:
+                turn = self.turns.setdefault(agent_type, itertools.count())
+            return entries[next(turn) % len(entries)]
+        if mode == RANDOM:
+            return random.choice(entries)
+        if mode == LEAST_LOADED:
+            return min(entries, key=lambda e: e.load)
+        return entries[0]
+
+    def set_load(self, uri, load):
+        """
+        Guarda la carga que comunica un agente
+
+        :return: False si el agente no esta registrado
+        """
+        with self.lock:
+            entry = self.by_uri.get(uri)
+            if entry is None:
+                return False
+            entry.load = load
+            self.versions[entry.agent_type] = next(_versions)
+            self._log({'op': 'load', 'uri': str(uri), 'load': load}, persist=False)
+        return True
+
+    def version(self, agent_type):
+        """
+        Version de los agentes de un tipo, cambia con cada cambio de sus agentes
+        """
+        return self.versions.get(agent_type, 0)
+
+    def counts(self):
+        """
+        Numero de agentes registrados de cada tipo
+
+        :return: lista de (tipo de agente, numero de agentes)
+        """
+        return [(agent_type, len(entries)) for agent_type, entries in list(self.by_type.items())]
+
+    def page(self, agent_type=None, name=None, offset=0, limit=50):
+        """
+        Una pagina de los agentes registrados, por tipo y orden de registro
+
+        :param agent_type: solo los agentes de este tipo
+        :param name: solo los agentes con este texto en el nombre (sin
+            distinguir mayusculas)
+        :param offset: agentes que se saltan
+        :param limit: agentes de la pagina
+        :return: (numero de agentes que cumplen los filtros, lista de entradas)
+        """
+        if agent_type is not None:
+            groups = [self.by_type.get(agent_type, ())]
+        else:
+            groups = list(self.by_type.values())
+        if name:
+            name = name.lower()
+            entries = [entry for entries in groups for entry in entries
+                       if entry.name is not None and name in str(entry.name).lower()]
+            return len(entries), entries[offset:offset + limit]
+        # Sin filtro por nombre no hace falta recorrer los agentes de antes
+        total = sum(len(entries) for entries in groups)
+        found = []
+        for entries in groups:
+            if offset >= len(entries):
+                offset -= len(entries)
+                continue
+            found.extend(entries[offset:offset + limit - len(found)])
+            offset = 0
+            if len(found) >= limit:
+                break
+        return total, found
+
+    def types(self):
+        """
+        Tipos de agente que tienen algun agente registrado
+        """
+        return list(self.by_type)
+
+    def __len__(self):
+        return len(self.by_uri)
+
+    def __iter__(self):
+        return iter(list(self.by_uri.values()))
+
+
+def _expires(lease):
+    """
+    Instante en que caduca un lease de unos segundos, None si no caduca
+    """
+    if not lease:
+        return None
+    return time.monotonic() + float(lease)
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+filename: DirectoryStore
+
+Persistencia del registro del servicio de directorio
+
+El estado se guarda en dos ficheros:
+
+    - <prefijo>.snapshot: foto del registro completo (agentes y suscripciones)
+      en JSON
+    - <prefijo>.journal: diario con los cambios posteriores a la foto, un
+      objeto JSON por linea (register, deregister, subscribe, unsubscribe)
+
+Cada cambio del registro se añade al diario, que solo crece. Cada
+SNAPSHOT_EVERY cambios se escribe una foto nueva y se vacia el diario. Al
+arrancar se carga la foto y se aplican los cambios del diario
+
+Las renovaciones de leases y la carga de los agentes no se guardan en el
+diario (la foto si tiene la ultima carga de cada agente). Al
+recuperar el estado cada registro tiene un lease completo desde el arranque,
+mientras el directorio no funcionaba los agentes no lo podian renovar
+
+"""
+
+import json
+import logging
+import os
+import threading
+
+from rdflib import Literal, URIRef
+
+__author__ = 'javier'
+
+# Cambios en el diario a partir de los que se escribe una foto nueva
+SNAPSHOT_EVERY = int(os.environ.get('DIRECTORY_SNAPSHOT_EVERY', 500))
+
+# Si se fuerza la escritura a disco (fsync) de cada cambio del diario
+FSYNC = os.environ.get('DIRECTORY_FSYNC', '') not in ('', '0')
+
+# Logger que configuran los agentes con config_logger
+logger = logging.getLogger('log')
+
+
+class RegistryStore():
+    def __init__(self, prefix, snapshot_every=None, fsync=None):
+        """
+        :param prefix: prefijo de los ficheros de la foto y el diario
+        :param snapshot_every: cambios tras los que se escribe una foto
+        :param fsync: si se fuerza la escritura a disco de cada cambio
+        """
+        self.snapshot_path = prefix + '.snapshot'
+        self.journal_path = prefix + '.journal'
+        self.snapshot_every = SNAPSHOT_EVERY if snapshot_every is None else snapshot_every
+        self.fsync = FSYNC if fsync is None else fsync
+        self.journal = None
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def load(self, registry):
+        """
+        Recupera el registro de la foto y el diario, y a partir de entonces
+        guarda en el diario los cambios del registro
+
+        :param registry: AgentRegistry vacio
+        :return: numero de cambios del diario aplicados
+        """
+        registry.store = None
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, encoding='utf-8') as f:
+                snapshot = json.load(f)
+            load_state(registry, snapshot)
+
+        applied = 0
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'rb+') as f:
+                # Posicion del final de la ultima linea correcta
+                good = 0
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError('linea sin acabar')
+                        record = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        # Ultima linea a medio escribir si el proceso murio. Se
+                        # corta el diario ahi, si no el siguiente cambio se
+                        # escribiria pegado a ella y se perderia al recuperar
+                        logger.info('Linea del diario del directorio incompleta, se ignora')
+                        f.truncate(good)
+                        break
+                    apply_record(registry, record)
+                    applied += 1
+                    good += len(line)
+
+        self.pending = applied
+        self.journal = open(self.journal_path, 'a', encoding='utf-8')
+        registry.store = self
+        return applied
+
+    def append(self, record):
+        """
+        Añade un cambio al diario. El registro lo llama con su lock cogido
+
+        :param record: diccionario con la operacion (op) y sus datos
+        """
+        if self.journal is None:
+            return
+        with self.lock:
+            self.journal.write(json.dumps(record, separators=(',', ':')) + '\n')
+            self.journal.flush()
+            if self.fsync:
+                os.fsync(self.journal.fileno())
+            self.pending += 1
+
+    def should_snapshot(self):
+        return self.pending >= self.snapshot_every
+
+    def snapshot(self, registry):
+        """
+        Escribe una foto del registro y vacia el diario. El registro lo llama
+        con su lock cogido
+
+        :param registry: AgentRegistry
+        """
+        with self.lock:
+            snapshot = registry_state(registry)
+            tmp = self.snapshot_path + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(snapshot, f, separators=(',', ':'))
+                f.flush()
+                os.fsync(f.fileno())
+            # El cambio de nombre es atomico, si el proceso muere antes queda
+            # la foto anterior con el diario completo. Si muere antes de vaciar
+            # el diario se vuelve a aplicar sobre la foto nueva, que no cambia
+            # nada
+            os.replace(tmp, self.snapshot_path)
+            if self.journal is not None:
+                self.journal.close()
+            self.journal = open(self.journal_path, 'w', encoding='utf-8')
+            self.pending = 0
+
+    def close(self):
+        with self.lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+
+
+def registry_state(registry):
+    """
+    Estado completo del registro (lo que se guarda en la foto)
+
+    :return: diccionario con los agentes y las suscripciones
+    """
+    return {
+        # Por tipo, para mantener el orden de los agentes de cada tipo
+        'agents': [dict(entry_record(entry), load=entry.load)
+                   for entries in registry.by_type.values() for entry in entries],
+        'subscriptions': [{'subscriber': str(subscriber), 'address': str(address), 'type': str(agent_type)}
+                          for agent_type, subs in registry.subscriptions.items()
+                          for subscriber, address in subs]}
+
+
+def load_state(registry, state):
+    """
+    Añade al registro los agentes y suscripciones de un estado completo
+    (ver registry_state)
+    """
+    for record in state.get('agents', ()):
+        apply_record(registry, dict(record, op='register'))
+        if record.get('load'):
+            registry.set_load(URIRef(record['uri']), record['load'])
+    for record in state.get('subscriptions', ()):
+        apply_record(registry, dict(record, op='subscribe'))
+
+
+def entry_record(entry):
+    """
+    Cambio del diario que registra una entrada del registro
+    """
+    return {'op': 'register',
+            'uri': str(entry.uri),
+            'name': None if entry.name is None else str(entry.name),
+            'address': None if entry.address is None else str(entry.address),
+            'type': str(entry.agent_type),
+            'lease': entry.lease}
+
+
+def apply_record(registry, record):
+    """
+    Aplica un cambio del diario al registro
+    """
+    op = record['op']
+    if op == 'register':
+        registry.register(URIRef(record['uri']),
+                          None if record['name'] is None else Literal(record['name']),
+                          None if record['address'] is None else Literal(record['address']),
+                          URIRef(record['type']),
+                          record.get('lease'))
+    elif op == 'deregister':
+        registry.deregister(URIRef(record['uri']))
+    elif op == 'renew':
+        registry.renew(URIRef(record['uri']), record.get('lease'))
+    elif op == 'load':
+        registry.set_load(URIRef(record['uri']), record['load'])
+    elif op == 'subscribe':
+        registry.subscribe(URIRef(record['subscriber']), Literal(record['address']), URIRef(record['type']))
+    elif op == 'unsubscribe':
+        registry.unsubscribe(URIRef(record['subscriber']))
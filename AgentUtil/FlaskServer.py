@@ -10,7 +10,15 @@ Diferentes funciones comunes a los agentes implementados en ECSDI
 
 """
 
-from flask import request
+from flask import request, Response
+from rdflib import Graph
+from io import BytesIO
+
+from AgentUtil.ACLMessages import NotUnderstood, read_message
+from AgentUtil.WireFormats import (DEFAULT_FORMAT, BATCH, STREAMING_FORMATS, mimetype, negotiate, serialize_graph,
+                                   parse_graph, iter_triples, encode_batch, decode_batch)
+from AgentUtil.Compression import (accept_encoding_header, choose_encoding, maybe_compress, decompress,
+                                   decompress_stream)
 
 __author__ = 'bejar'
 
@@ -28,3 +36,130 @@ def shutdown_server():
     func()
 
 
+def get_message_content(req):
+    """
+    Extrae el mensaje ACL serializado de una peticion y su formato
+
+    Los agentes envian el mensaje en el cuerpo de un POST, con el formato en la
+    cabecera Content-Type y comprimido si lo indica Content-Encoding. Los clientes antiguos lo envian en RDF/XML en el
+    parametro 'content' de un GET (o de un formulario)
+
+    :param req: peticion de flask
+    :return: el mensaje tal como ha llegado y su tipo MIME
+    """
+    if req.method == 'POST':
+        if 'content' in req.form:
+            return req.form['content'], DEFAULT_FORMAT
+        data = req.get_data()
+        if req.content_encoding:
+            data = decompress(data, req.content_encoding)
+        return data, mimetype(req.content_type)
+    return req.args['content'], mimetype(req.args.get('format'))
+
+
+def get_message(req):
+    """
+    Retorna el mensaje ACL de una peticion como un grafo RDF
+
+    :param req: peticion de flask
+    :return:
+    """
+    message, fmt = get_message_content(req)
+    return parse_graph(message, fmt, Graph())
+
+
+def reply_message(gr, req):
+    """
+    Construye la respuesta HTTP a un mensaje ACL, serializando el grafo en el
+    formato que pide el emisor en la cabecera Accept (RDF/XML por defecto)
+
+    :param gr: grafo con el mensaje de respuesta
+    :param req: peticion de flask a la que se responde
+    :return:
+    """
+    fmt = negotiate(req.headers.get('Accept'))
+    return make_message_response(serialize_graph(gr, fmt), fmt, req)
+
+
+def make_message_response(body, content_type, req):
+    """
+    Construye la respuesta HTTP con un mensaje ya serializado. Se comprime si
+    el emisor lo acepta y es lo bastante grande (ver Compression), y se
+    anuncian las codificaciones que entiende el agente
+
+    :param body: mensaje serializado (bytes)
+    :param content_type: tipo MIME del mensaje
+    :param req: peticion de flask a la que se responde
+    :return:
+    """
+    body, encoding = maybe_compress(body, choose_encoding(req.headers.get('Accept-Encoding')))
+    resp = Response(body, content_type=content_type)
+    if encoding is not None:
+        resp.headers['Content-Encoding'] = encoding
+    resp.headers['Accept-Encoding'] = accept_encoding_header()
+    return resp
+
+
+def _is_form(req):
+    return req.mimetype in ('application/x-www-form-urlencoded', 'multipart/form-data')
+
+
+def _dispatch(triples, handler, performatives, actions):
+    try:
+        gm = read_message(triples, Graph(), performatives, actions)
+    except NotUnderstood as e:
+        # El handler responde not-understood con lo que se ha leido
+        gm = e.graph
+    return handler(gm)
+
+
+def serve_message(req, handler, performatives=None, actions=None):
+    """
+    Atiende una peticion de un entrypoint de comunicacion: extrae el mensaje,
+    lo procesa con el handler del agente y construye la respuesta
+
+    Los mensajes en N-Triples o binario en el cuerpo de un POST se leen
+    incrementalmente del stream de la peticion. Si se indican las performativas
+    o acciones que entiende el agente, en cuanto se ve que el mensaje no tiene
+    ninguna se deja de leer y se pasa al handler lo leido, para que responda
+    not-understood (ver ACLMessages.read_message)
+
+    Si la peticion es un sobre con varios mensajes (ver ACLMessages.send_batch)
+    el handler se llama para cada uno y las respuestas se devuelven en otro
+    sobre en el mismo orden
+
+    :param req: peticion de flask
+    :param handler: funcion que recibe el grafo de un mensaje y retorna el
+        grafo de la respuesta
+    :param performatives: performativas que entiende el agente (None todas)
+    :param actions: acciones que entiende el agente (None todas)
+    :return:
+    """
+    if req.method == 'POST' and not _is_form(req) and mimetype(req.content_type) in STREAMING_FORMATS:
+        stream = req.stream
+        if req.content_encoding:
+            stream = decompress_stream(stream, req.content_encoding)
+        try:
+            triples = iter_triples(stream, mimetype(req.content_type))
+            gr = _dispatch(triples, handler, performatives, actions)
+        finally:
+            # Guarda las estadisticas de la descompresion
+            if stream is not req.stream:
+                stream.close()
+        # Si el mensaje se ha rechazado, se descarta el resto del cuerpo sin
+        # parsearlo para que el emisor pueda leer la respuesta
+        while req.stream.read(65536):
+            pass
+        return reply_message(gr, req)
+
+    message, fmt = get_message_content(req)
+    if fmt != BATCH:
+        # Ya se tiene el mensaje entero, no hace falta filtrarlo
+        return reply_message(handler(parse_graph(message, fmt, Graph())), req)
+
+    rfmt = negotiate(req.headers.get('Accept'))
+    answers = []
+    for pfmt, part in decode_batch(message):
+        gr = _dispatch(iter_triples(BytesIO(part), pfmt), handler, performatives, actions)
+        answers.append((rfmt, serialize_graph(gr, rfmt)))
+    return make_message_response(encode_batch(answers), BATCH, req)
@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+"""
+filename: ProductCatalog
+
+Catalogo de productos residente en memoria
+
+El fichero de productos (Turtle) se carga una vez y se mantiene el grafo en
+memoria. Los productos nuevos se añaden al grafo y al final del fichero (como
+N-Triples, que tambien es Turtle valido) sin volver a escribirlo entero. Si el
+fichero cambia en disco (lo modifica otro proceso) se vuelve a cargar en la
+siguiente consulta
+
+El grafo se consulta con el catalogo como context manager, que impide que se
+modifique mientras se lee:
+
+    with catalog as graph:
+        ...
+
+Los productos (Producto_interno y Producto_externo con nombre, marca, tipo,
+precio y peso) se indexan para las busquedas (ver ProductIndex): indices hash
+por nombre, marca, tipo y clase, los precios ordenados para los rangos y los
+productos ordenados por nombre. Asi el coste de una busqueda depende del
+numero de resultados y no del tamaño del catalogo. Con PRODUCT_INDEX=0 no se
+indexa y las busquedas usan SPARQL sobre el grafo
+
+Las palabras del nombre y la marca de cada producto tambien se indexan
+(TokenIndex) para buscar por nombre con los modos de TextIndex (palabras,
+prefijo o aproximado) ademas del nombre exacto
+
+Las busquedas retornan una pagina de resultados (offset y limit) en el orden
+pedido. Si los candidatos ya estan en ese orden (todo el catalogo por nombre
+o un rango de precios por precio) se recorren hasta llenar la pagina, si no
+se eligen los primeros con heapq, sin ordenar todos los resultados
+
+"""
+
+import bisect
+import heapq
+import itertools
+import logging
+import os
+import sys
+import threading
+
+from rdflib import Graph, RDF
+
+from AgentUtil.OntoNamespaces import ECSDI
+from AgentUtil.TextIndex import EXACT, TokenIndex
+
+__author__ = 'javier'
+
+# Si se indexan los productos para las busquedas
+PRODUCT_INDEX = os.environ.get('PRODUCT_INDEX', '1') not in ('', '0')
+
+# Clases de los productos que se indexan
+PRODUCT_CLASSES = (ECSDI.Producto_interno, ECSDI.Producto_externo)
+
+# Propiedades de un producto que se indexan
+_FIELDS = (ECSDI.Nombre, ECSDI.Marca, ECSDI.Tipo, ECSDI.Precio, ECSDI.Peso)
+
+# Ordenes de los resultados de una busqueda
+SORT_NAME = 'nombre'
+SORT_PRICE = 'precio'
+SORT_PRICE_DESC = 'precio_desc'
+SORTS = (SORT_NAME, SORT_PRICE, SORT_PRICE_DESC)
+
+# Productos por pagina de una busqueda, por defecto y como maximo
+SEARCH_PAGE_SIZE = 50
+SEARCH_PAGE_MAX = 500
+# Desplazamiento maximo que se puede pedir en una busqueda
+SEARCH_OFFSET_MAX = 1000000
+
+# Logger que configuran los agentes con config_logger
+logger = logging.getLogger('log')
+
+
+def paging_value(value, default, minimum, maximum):
+    """
+    Entero de un valor de paginacion (de un mensaje o un formulario),
+    limitado a [minimum, maximum]
+
+    :param value: literal, texto o None
+    :param default: valor si no se indica ninguno
+    :return: el entero, o None si el valor no es un numero entero
+    """
+    if value is None:
+        return default
+    try:
+        number = int(str(value))
+    except ValueError:
+        return None
+    return min(max(number, minimum), maximum)
+
+
+class ProductCatalog():
+    def __init__(self, path, fmt='turtle'):
+        """
+        :param path: fichero de productos
+        :param fmt: formato del fichero
+        """
+        self.path = path
+        self.fmt = fmt
+        self.graph = None
+        self.mtime = None
+        self.index = ProductIndex() if PRODUCT_INDEX else None
+        self.lock = threading.RLock()
+
+    def _stat(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def refresh(self):
+        """
+        Carga el fichero si no se ha cargado o ha cambiado desde la ultima vez
+
+        :return: True si se ha cargado
+        """
+        mtime = self._stat()
+        if self.graph is not None and mtime == self.mtime:
+            return False
+        with self.lock:
+            mtime = self._stat()
+            if self.graph is not None and mtime == self.mtime:
+                return False
+            graph = Graph()
+            if mtime is not None:
+                with open(self.path, 'rb') as f:
+                    graph.parse(f, format=self.fmt)
+            self.graph = graph
+            self.mtime = mtime
+            if self.index is not None:
+                self.index.rebuild(graph)
+            logger.info('Catalogo de productos cargado: %d triples' % len(graph))
+        return True
+
+    def __enter__(self):
+        self.refresh()
+        self.lock.acquire()
+        return self.graph
+
+    def __exit__(self, *exc):
+        self.lock.release()
+        return False
+
+    def add(self, triples):
+        """
+        Añade triples al catalogo y al fichero
+
+        :param triples: iterable de (s, p, o)
+        """
+        triples = list(triples)
+        if not triples:
+            return
+        self.refresh()
+        with self.lock:
+            for t in triples:
+                self.graph.add(t)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write('\n' + ''.join('%s %s %s .\n' % (s.n3(), p.n3(), o.n3()) for s, p, o in triples))
+            # Es nuestro cambio, no hay que volver a cargar el fichero
+            self.mtime = self._stat()
+            if self.index is not None:
+                self.index.update(self.graph, {s for s, _, _ in triples})
+
+
+class ProductRecord():
+    """
+    Datos de un producto indexado. Los atributos tienen los mismos nombres que
+    las variables de la consulta SPARQL de busqueda
+    """
+    __slots__ = ('producto', 'classes', 'nombre', 'marca', 'tipo', 'precio', 'peso', 'key', 'price_key')
+
+    def __init__(self, producto, classes, nombre, marca, tipo, precio, peso):
+        self.producto = producto
+        self.classes = classes
+        self.nombre = nombre
+        self.marca = marca
+        self.tipo = tipo
+        self.precio = precio
+        self.peso = peso
+        # Orden de los resultados: order by asc(UCASE(str(?nombre)))
+        self.key = (str(nombre).upper(), str(producto))
+        # Orden por precio, y por nombre a igual precio
+        self.price_key = (precio, self.key)
+
+
+class ProductIndex():
+    def __init__(self):
+        self._clear()
+
+    def _clear(self):
+        self.products = {}
+        self.by_name = {}
+        self.by_brand = {}
+        self.by_type = {}
+        # Precios ordenados, la clave de orden por precio y el producto de
+        # cada precio
+        self.prices = []
+        self.price_keys = []
+        self.by_price = []
+        # Productos ordenados por nombre, y la clave de orden de cada uno
+        self.order = []
+        self.keys = []
+        # Palabras del nombre y la marca
+        self.text = TokenIndex()
+
+    def rebuild(self, graph):
+        """
+        Indexa todos los productos de un grafo
+        """
+        self._clear()
+        records = []
+        for cls in PRODUCT_CLASSES:
+            for product in graph.subjects(RDF.type, cls):
+                if product not in self.products:
+                    record = _record(graph, product)
+                    if record is not None:
+                        self.products[product] = record
+                        records.append(record)
+        for record in records:
+            self._add_hashes(record)
+        self.order = sorted(records, key=lambda r: r.key)
+        self.keys = [record.key for record in self.order]
+        by_price = sorted(records, key=lambda r: r.price_key)
+        self.prices = [record.precio for record in by_price]
+        self.price_keys = [record.price_key for record in by_price]
+        self.by_price = by_price
+
+    def update(self, graph, products):
+        """
+        Vuelve a indexar unos productos que han cambiado en el grafo
+        """
+        for product in products:
+            old = self.products.pop(product, None)
+            if old is not None:
+                self._remove(old)
+            record = _record(graph, product)
+            if record is not None:
+                self.products[product] = record
+                self._add_hashes(record)
+                pos = bisect.bisect(self.keys, record.key)
+                self.keys.insert(pos, record.key)
+                self.order.insert(pos, record)
+                pos = bisect.bisect(self.price_keys, record.price_key)
+                self.prices.insert(pos, record.precio)
+                self.price_keys.insert(pos, record.price_key)
+                self.by_price.insert(pos, record)
+
+    def _add_hashes(self, record):
+        self.text.add(record, record.nombre, record.marca)
+        for index, value in ((self.by_name, record.nombre), (self.by_brand, record.marca), (self.by_type, record.tipo)):
+            index.setdefault(str(value), []).append(record)
+
+    def _remove(self, record):
+        self.text.remove(record)
+        for index, value in ((self.by_name, record.nombre), (self.by_brand, record.marca), (self.by_type, record.tipo)):
+            records = index[str(value)]
+            records.remove(record)
+            if not records:
+                del index[str(value)]
+        pos = bisect.bisect_left(self.keys, record.key)
+        del self.keys[pos]
+        del self.order[pos]
+        pos = bisect.bisect_left(self.price_keys, record.price_key)
+        del self.by_price[pos]
+        del self.prices[pos]
+        del self.price_keys[pos]
+
+    def search(self, name=None, brand=None, prod_type=None, min_price=0.0, max_price=sys.float_info.max,
+               classes=PRODUCT_CLASSES, name_mode=EXACT, sort=SORT_NAME, offset=0, limit=None):
+        """
+        Busca los productos que cumplen todos los filtros
+
+        :param name: nombre exacto, o palabras del nombre o la marca segun
+            name_mode
+        :param brand: marca exacta
+        :param prod_type: tipo exacto
+        :param min_price: precio minimo
+        :param max_price: precio maximo
+        :param classes: clases de producto que se incluyen
+        :param name_mode: modo de busqueda del nombre (ver TextIndex)
+        :param sort: orden de los resultados (SORTS)
+        :param offset: resultados que se saltan
+        :param limit: numero maximo de resultados (None, todos)
+        :return: lista de ProductRecord en el orden pedido
+        """
+        # Productos con las palabras del nombre
+        words = None
+        if name is not None and name_mode != EXACT:
+            words = self.text.search(str(name), name_mode)
+
+        # Se parte del indice que da menos candidatos
+        candidates = words
+        for index, value in ((self.by_name, None if words is not None else name), (self.by_brand, brand),
+                             (self.by_type, prod_type)):
+            if value is not None:
+                found = index.get(str(value), ())
+                if candidates is None or len(found) < len(candidates):
+                    candidates = found
+        # Productos en el orden pedido (por precio solo los del rango)
+        lo = bisect.bisect_left(self.prices, min_price)
+        hi = bisect.bisect_right(self.prices, max_price)
+        if sort == SORT_PRICE:
+            in_order, size = (self.by_price[i] for i in range(lo, hi)), hi - lo
+        elif sort == SORT_PRICE_DESC:
+            in_order, size = (self.by_price[i] for i in range(hi - 1, lo - 1, -1)), hi - lo
+        else:
+            in_order, size = self.order, len(self.order)
+
+        # Si los candidatos se recorren en el orden pedido. Para llenar la
+        # pagina hace falta recorrer unos end * size / len(candidates), si son
+        # menos que los candidatos sale mas barato que elegir los primeros
+        end = None if limit is None else offset + limit
+        ordered = False
+        if candidates is None:
+            if sort != SORT_NAME or (lo == 0 and hi == len(self.prices)):
+                candidates = in_order
+                ordered = True
+            else:
+                candidates = self.by_price[lo:hi]
+        if not ordered and end is not None and end * size < len(candidates) ** 2:
+            candidates = in_order
+            ordered = True
+
+        classes = set(classes)
+        found = (r for r in candidates
+                 if (name is None or (r in words if words is not None else str(r.nombre) == str(name)))
+                 and (brand is None or str(r.marca) == str(brand))
+                 and (prod_type is None or str(r.tipo) == str(prod_type))
+                 and min_price <= r.precio <= max_price
+                 and not classes.isdisjoint(r.classes))
+
+        if ordered:
+            # Se deja de recorrer al llenar la pagina
+            return list(itertools.islice(found, offset, end))
+        key = _price_key if sort in (SORT_PRICE, SORT_PRICE_DESC) else _name_key
+        reverse = sort == SORT_PRICE_DESC
+        if end is None:
+            return sorted(found, key=key, reverse=reverse)[offset:]
+        # Solo los primeros end resultados, sin ordenar el resto
+        if reverse:
+            return heapq.nlargest(end, found, key=key)[offset:]
+        return heapq.nsmallest(end, found, key=key)[offset:]
+
+
+def _name_key(record):
+    return record.key
+
+
+def _price_key(record):
+    return record.price_key
+
+
+def _record(graph, product):
+    """
+    Datos de un producto del grafo, o None si le falta alguno (la consulta
+    SPARQL tampoco lo encontraria)
+    """
+    # Una sola pasada por los triples del producto
+    values = {}
+    classes = set()
+    for p, o in graph.predicate_objects(product):
+        if p == RDF.type:
+            if o in PRODUCT_CLASSES:
+                classes.add(o)
+        elif p in _FIELDS:
+            values.setdefault(p, o)
+    if not classes or len(values) < len(_FIELDS):
+        return None
+    nombre, marca, tipo, precio, peso = (values[p] for p in _FIELDS)
+    try:
+        price = float(precio)
+    except ValueError:
+        return None
+    return ProductRecord(product, frozenset(classes), nombre, marca, tipo, price, peso)
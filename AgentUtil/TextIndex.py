@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+filename: TextIndex
+
+Indice invertido de palabras para buscar por texto
+
+Los textos se separan en palabras en minusculas y sin acentos (fold), de
+manera que 'Camión' y 'camion' son la misma palabra. Cada palabra tiene el
+conjunto de objetos en cuyo texto aparece. Una busqueda retorna los objetos
+que tienen todas las palabras de la consulta, segun el modo:
+
+    - WORDS ('palabras'): la palabra exacta
+    - PREFIX ('prefijo'): una palabra que empieza por la de la consulta
+    - FUZZY ('aproximado'): una palabra a una distancia de edicion de como
+      mucho max_edits (1 para palabras de 4 a 7 letras, 2 a partir de 8)
+
+Para el modo aproximado se indexan las variantes de cada palabra con una o
+dos letras borradas (como SymSpell), limitadas a las PREFIX_LEN primeras
+letras. Las palabras candidatas son las que comparten alguna variante con la
+de la consulta, y se comprueba su distancia real. Por el limite de letras
+alguna palabra muy larga con cambios al principio se puede perder
+
+"""
+
+import bisect
+import re
+import unicodedata
+
+__author__ = 'javier'
+
+# Modos de busqueda por texto (EXACT compara el texto completo, no usa el
+# indice)
+EXACT = 'exacto'
+WORDS = 'palabras'
+PREFIX = 'prefijo'
+FUZZY = 'aproximado'
+MODES = (EXACT, WORDS, PREFIX, FUZZY)
+
+# Letras de cada palabra de las que se indexan variantes con letras borradas
+PREFIX_LEN = 8
+
+_word = re.compile(r'\w+')
+
+
+def fold(text):
+    """
+    Texto en minusculas y sin acentos
+    """
+    text = unicodedata.normalize('NFKD', str(text))
+    return ''.join(c for c in text if not unicodedata.combining(c)).casefold()
+
+
+def tokenize(text):
+    """
+    Palabras de un texto, en minusculas y sin acentos
+    """
+    return _word.findall(fold(text))
+
+
+def max_edits(word):
+    """
+    Distancia de edicion que se admite para una palabra de la consulta
+    """
+    if len(word) < 4:
+        return 0
+    if len(word) < 8:
+        return 1
+    return 2
+
+
+def edit_distance(a, b, limit):
+    """
+    Distancia de Levenshtein entre dos palabras, o limit + 1 si es mayor que
+    limit (deja de calcular en cuanto se sabe)
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+def _deletes(word, depth):
+    """
+    Variantes de una palabra con hasta depth letras borradas (de sus
+    PREFIX_LEN primeras letras), incluida la palabra
+    """
+    word = word[:PREFIX_LEN]
+    variants = {word}
+    frontier = {word}
+    for _ in range(depth):
+        frontier = {w[:i] + w[i + 1:] for w in frontier for i in range(len(w))}
+        variants |= frontier
+    return variants
+
+
+def _index_depth(word):
+    """
+    Letras borradas que se indexan de una palabra del indice. Tienen que
+    cubrir la distancia de cualquier palabra de la consulta que pueda estar
+    a max_edits de ella
+    """
+    if len(word) >= 6:
+        return 2
+    if len(word) >= 3:
+        return 1
+    return 0
+
+
+class TokenIndex():
+    def __init__(self):
+        # Palabra -> objetos que la tienen
+        self.postings = {}
+        # Palabras ordenadas, para las busquedas por prefijo
+        self.vocabulary = []
+        # Variante con letras borradas -> palabras que la tienen
+        self.deletes = {}
+        # Objeto -> sus palabras
+        self.words = {}
+
+    def add(self, obj, *texts):
+        """
+        Indexa un objeto con las palabras de unos textos
+        """
+        self.remove(obj)
+        words = set()
+        for text in texts:
+            words.update(tokenize(text))
+        self.words[obj] = words
+        for word in words:
+            posting = self.postings.get(word)
+            if posting is None:
+                posting = self.postings[word] = set()
+                bisect.insort(self.vocabulary, word)
+                for variant in _deletes(word, _index_depth(word)):
+                    self.deletes.setdefault(variant, set()).add(word)
+            posting.add(obj)
+
+    def remove(self, obj):
+        """
+        Quita un objeto del indice
+        """
+        for word in self.words.pop(obj, ()):
+            posting = self.postings[word]
+            posting.discard(obj)
+            if not posting:
+                del self.postings[word]
+                del self.vocabulary[bisect.bisect_left(self.vocabulary, word)]
+                for variant in _deletes(word, _index_depth(word)):
+                    words = self.deletes[variant]
+                    words.discard(word)
+                    if not words:
+                        del self.deletes[variant]
+
+    def _matching_words(self, word, mode):
+        """
+        Palabras del indice que corresponden a una palabra de la consulta
+        """
+        if mode == PREFIX:
+            lo = bisect.bisect_left(self.vocabulary, word)
+            hi = bisect.bisect_left(self.vocabulary, word + '\U0010ffff')
+            return self.vocabulary[lo:hi]
+        if mode == FUZZY:
+            limit = max_edits(word)
+            if limit == 0:
+                return [word] if word in self.postings else []
+            candidates = set()
+            for variant in _deletes(word, limit):
+                candidates.update(self.deletes.get(variant, ()))
+            return [w for w in candidates if edit_distance(word, w, limit) <= limit]
+        return [word] if word in self.postings else []
+
+    def search(self, text, mode=WORDS):
+        """
+        Objetos que tienen todas las palabras de un texto
+
+        :param text: texto de la consulta
+        :param mode: WORDS, PREFIX o FUZZY
+        :return: conjunto de objetos (vacio si la consulta no tiene palabras)
+        """
+        matches = []
+        for word in set(tokenize(text)):
+            found = set()
+            for w in self._matching_words(word, mode):
+                found.update(self.postings[w])
+            if not found:
+                return set()
+            matches.append(found)
+        if not matches:
+            return set()
+        matches.sort(key=len)
+        return matches[0].intersection(*matches[1:])
+
+
+def text_matches(query, texts, mode=WORDS):
+    """
+    Si unos textos tienen todas las palabras de una consulta, sin indice
+    (lo mismo que TokenIndex.search para un objeto)
+    """
+    words = set()
+    for text in texts:
+        words.update(tokenize(text))
+    query = set(tokenize(query))
+    if not query:
+        return False
+    for word in query:
+        if mode == PREFIX:
+            ok = any(w.startswith(word) for w in words)
+        elif mode == FUZZY:
+            limit = max_edits(word)
+            ok = any(edit_distance(word, w, limit) <= limit for w in words)
+        else:
+            ok = word in words
+        if not ok:
+            return False
+    return True
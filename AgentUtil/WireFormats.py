@@ -0,0 +1,566 @@
+# -*- coding: utf-8 -*-
+"""
+filename: WireFormats
+
+Formatos de serializacion de los mensajes ACL entre agentes
+
+El formato se indica con la cabecera Content-Type del mensaje y se negocia
+con la cabecera Accept. Se soportan:
+
+    application/rdf+xml       RDF/XML, el formato por defecto de los agentes
+    application/n-triples     N-Triples
+    text/turtle               Turtle
+    application/x-rdf-binary  codificacion binaria compacta de triples (ver mas abajo)
+
+Si no se indica formato o no se reconoce se usa RDF/XML
+
+Ademas un mensaje application/x-acl-batch es un sobre que lleva varios mensajes
+ACL, cada uno con su propio formato (ver encode_batch)
+
+"""
+
+from array import array
+from io import BytesIO
+from itertools import chain
+import struct
+import sys
+import threading
+from xml.sax.saxutils import escape
+
+from rdflib import Graph, URIRef, BNode, Literal
+from rdflib.namespace import RDF
+from rdflib.plugins.parsers.ntriples import W3CNTriplesParser
+
+from AgentUtil.OntoNamespaces import ACL
+
+__author__ = 'javier'
+
+RDFXML = 'application/rdf+xml'
+NTRIPLES = 'application/n-triples'
+TURTLE = 'text/turtle'
+BINARY = 'application/x-rdf-binary'
+BATCH = 'application/x-acl-batch'
+
+DEFAULT_FORMAT = RDFXML
+
+# Formato de rdflib para cada tipo MIME
+RDFLIB_FORMATS = {RDFXML: 'xml', NTRIPLES: 'nt', TURTLE: 'turtle'}
+
+# Formatos que entiende el agente, por orden de preferencia
+SUPPORTED_FORMATS = [BINARY, NTRIPLES, TURTLE, RDFXML]
+
+# Formatos que se pueden leer incrementalmente de un stream (ver iter_triples)
+STREAMING_FORMATS = {NTRIPLES, BINARY}
+
+# Tipos MIME alternativos que se aceptan al recibir
+_ALIASES = {'application/xml': RDFXML, 'text/xml': RDFXML,
+            'text/plain': NTRIPLES, 'application/x-turtle': TURTLE}
+
+
+def mimetype(content_type):
+    """
+    Normaliza una cabecera Content-Type a uno de los formatos soportados
+
+    :param content_type: valor de la cabecera (puede ser None)
+    :return: tipo MIME soportado, RDF/XML si no se reconoce
+    """
+    if not content_type:
+        return DEFAULT_FORMAT
+    mtype = content_type.split(';')[0].strip().lower()
+    mtype = _ALIASES.get(mtype, mtype)
+    if mtype in RDFLIB_FORMATS or mtype == BINARY or mtype == BATCH:
+        return mtype
+    return DEFAULT_FORMAT
+
+
+def accept_header(preferred=None):
+    """
+    Construye la cabecera Accept con los formatos soportados
+
+    :param preferred: formato que se quiere recibir preferentemente
+    :return:
+    """
+    formats = list(SUPPORTED_FORMATS)
+    if preferred is not None and preferred in formats:
+        formats.remove(preferred)
+        formats.insert(0, preferred)
+    return ', '.join('%s;q=%.1f' % (f, 1.0 - i * 0.1) for i, f in enumerate(formats))
+
+
+def negotiate(accept):
+    """
+    Elige el formato de la respuesta a partir de la cabecera Accept
+
+    :param accept: valor de la cabecera Accept (puede ser None)
+    :return: tipo MIME, RDF/XML si ningun formato aceptado esta soportado
+    """
+    if not accept:
+        return DEFAULT_FORMAT
+    best, best_q = DEFAULT_FORMAT, -1.0
+    for item in accept.split(','):
+        parts = item.split(';')
+        mtype = _ALIASES.get(parts[0].strip().lower(), parts[0].strip().lower())
+        q = 1.0
+        for param in parts[1:]:
+            param = param.strip()
+            if param.startswith('q='):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        if (mtype in RDFLIB_FORMATS or mtype == BINARY) and q > best_q:
+            best, best_q = mtype, q
+    return best
+
+
+def serialize_graph(graph, fmt=DEFAULT_FORMAT):
+    """
+    Serializa un grafo en el formato indicado
+
+    :param graph: grafo RDF
+    :param fmt: tipo MIME del formato
+    :return: bytes
+    """
+    if isinstance(graph, TemplateMessage):
+        return graph.render(fmt)
+    if fmt == BINARY:
+        return encode_binary(graph)
+    return graph.serialize(format=RDFLIB_FORMATS.get(fmt, 'xml'), encoding='utf-8')
+
+
+def parse_graph(data, fmt=DEFAULT_FORMAT, graph=None):
+    """
+    Reconstruye un grafo a partir de un mensaje serializado
+
+    :param data: mensaje (bytes o str)
+    :param fmt: tipo MIME del formato
+    :param graph: grafo donde se dejan los triples, si no se crea uno nuevo
+    :return: el grafo
+    """
+    if graph is None:
+        graph = Graph()
+    if fmt == BINARY:
+        if isinstance(data, str):
+            data = data.encode('latin-1')
+        return decode_binary(data, graph)
+    graph.parse(data=data, format=RDFLIB_FORMATS.get(fmt, 'xml'))
+    return graph
+
+
+def iter_triples(stream, fmt=DEFAULT_FORMAT):
+    """
+    Genera los triples de un mensaje a medida que se leen de un stream
+
+    N-Triples y la codificacion binaria se leen incrementalmente, sin tener
+    el mensaje entero en memoria; los demas formatos se leen enteros y se
+    parsean de golpe
+
+    :param stream: objeto con el metodo read (p.e. el cuerpo de la peticion)
+    :param fmt: tipo MIME del formato
+    :return: generador de triples
+    """
+    if fmt == BINARY:
+        return iter_binary_stream(stream)
+    if fmt == NTRIPLES:
+        return _iter_ntriples(stream)
+    return iter(parse_graph(stream.read(), fmt))
+
+
+class _TripleSink():
+    def __init__(self):
+        self.triples = []
+
+    def triple(self, s, p, o):
+        self.triples.append((s, p, o))
+
+
+# Bytes que se leen del stream la primera vez (la cabecera del mensaje va al
+# principio, ver _message_order) y las siguientes
+_NT_FIRST_CHUNK = 4096
+_NT_CHUNK = 65536
+
+
+def _iter_ntriples(stream):
+    """
+    Genera los triples de un mensaje N-Triples a medida que se leen de un
+    stream. Se lee por trozos y cada trozo de lineas completas se parsea con el
+    parse publico del parser de rdflib. Los blank nodes se comparten entre
+    trozos con el mismo bnode_context
+    """
+    sink = _TripleSink()
+    bnodes = {}
+    parser = W3CNTriplesParser(sink, bnode_context=bnodes)
+    rest = b''
+    size = _NT_FIRST_CHUNK
+    while True:
+        data = stream.read(size)
+        size = _NT_CHUNK
+        if data:
+            data = rest + data
+            cut = data.rfind(b'\n') + 1
+            lines, rest = data[:cut], data[cut:]
+        else:
+            # Ultima linea sin salto de linea
+            lines, rest = rest, b''
+        if lines:
+            parser.parse(BytesIO(lines), bnode_context=bnodes)
+            triples, sink.triples = sink.triples, []
+            yield from triples
+        if not data:
+            break
+
+
+# Codificacion binaria
+#
+# Cabecera:  'RDFB' + version (1 byte) + numero de terminos + numero de triples (uint32)
+# Terminos:  un byte por termino con su tipo (U, B, L)
+#            longitudes en bytes del valor y del extra de cada termino (uint32)
+#            los valores y extras en UTF-8 uno detras de otro
+#            El extra de un literal es su datatype, o '@' + idioma
+# Triples:   tres indices de termino por triple (uint32)
+#
+# Todos los enteros son little endian
+
+_MAGIC = b'RDFB\x01'
+_HEADER = struct.Struct('<5sII')
+
+
+def _le_array(values):
+    arr = array('I', values)
+    if sys.byteorder != 'little':
+        arr.byteswap()
+    return arr
+
+
+def _message_order(graph):
+    """
+    Triples de un grafo empezando por la cabecera del mensaje ACL y el tipo de
+    su contenido, para que quien lo lee incrementalmente pueda decidir que
+    hacer con el antes de tener el resto (ver ACLMessages.read_message)
+    """
+    head = []
+    for ms in graph.subjects(RDF.type, ACL.FipaAclMessage):
+        head.extend(graph.triples((ms, None, None)))
+        for content in graph.objects(ms, ACL.content):
+            head.extend(graph.triples((content, RDF.type, None)))
+    if not head:
+        return iter(graph)
+    first = set(head)
+    return chain(head, (triple for triple in graph if triple not in first))
+
+
+def _binary_terms(graph):
+    """
+    Tabla de terminos de un grafo para la codificacion binaria
+
+    :param graph: grafo RDF
+    :return: (tipos de los terminos, lista de (valor, extra) en UTF-8,
+        indices de los triples)
+    """
+    index = {}
+    kinds = bytearray()
+    values = []
+    triples = []
+
+    for triple in _message_order(graph):
+        for term in triple:
+            idx = index.get(term)
+            if idx is None:
+                idx = index[term] = len(kinds)
+                if isinstance(term, Literal):
+                    kinds.append(76)  # L
+                    if term.language:
+                        extra = '@' + term.language
+                    elif term.datatype is not None:
+                        extra = str(term.datatype)
+                    else:
+                        extra = ''
+                elif isinstance(term, BNode):
+                    kinds.append(66)  # B
+                    extra = ''
+                else:
+                    kinds.append(85)  # U
+                    extra = ''
+                values.append((str(term).encode('utf-8'), extra.encode('utf-8')))
+            triples.append(idx)
+    return kinds, values, triples
+
+
+def _pack_binary(kinds, values, triples, ntriples):
+    lengths = []
+    blob = []
+    for value, extra in values:
+        lengths.append(len(value))
+        lengths.append(len(extra))
+        blob.append(value)
+        blob.append(extra)
+    return b''.join([_HEADER.pack(_MAGIC, len(kinds), ntriples),
+                     bytes(kinds),
+                     _le_array(lengths).tobytes(),
+                     b''.join(blob),
+                     triples])
+
+
+def encode_binary(graph):
+    """
+    Serializa un grafo con la codificacion binaria compacta
+
+    :param graph: grafo RDF
+    :return: bytes
+    """
+    kinds, values, triples = _binary_terms(graph)
+    return _pack_binary(kinds, values, _le_array(triples).tobytes(), len(triples) // 3)
+
+
+def decode_binary(data, graph=None):
+    """
+    Reconstruye un grafo serializado con encode_binary
+
+    :param data: bytes
+    :param graph: grafo donde se dejan los triples
+    :return: el grafo
+    """
+    if graph is None:
+        graph = Graph()
+    for triple in iter_binary(data):
+        graph.add(triple)
+    return graph
+
+
+def iter_binary(data):
+    """
+    Genera los triples de un mensaje con la codificacion binaria
+
+    :param data: bytes
+    :return: generador de triples
+    """
+    magic, nterms, ntriples = _HEADER.unpack_from(data, 0)
+    if magic != _MAGIC:
+        raise ValueError('No es un mensaje RDF binario')
+    pos = _HEADER.size
+    kinds = data[pos:pos + nterms]
+    pos += nterms
+
+    lengths = array('I')
+    lengths.frombytes(data[pos:pos + 8 * nterms])
+    if sys.byteorder != 'little':
+        lengths.byteswap()
+    pos += 8 * nterms
+
+    blob_size = sum(lengths)
+    terms = _binary_table(kinds, lengths, data[pos:pos + blob_size])
+    pos += blob_size
+
+    indexes = array('I')
+    indexes.frombytes(data[pos:pos + 12 * ntriples])
+    if sys.byteorder != 'little':
+        indexes.byteswap()
+    for i in range(0, 3 * ntriples, 3):
+        yield terms[indexes[i]], terms[indexes[i + 1]], terms[indexes[i + 2]]
+
+
+def _read_exact(stream, size):
+    data = stream.read(size)
+    while len(data) < size:
+        more = stream.read(size - len(data))
+        if not more:
+            raise ValueError('Mensaje RDF binario incompleto')
+        data += more
+    return data
+
+
+def _binary_table(kinds, lengths, blob):
+    terms = []
+    pos = 0
+    for i in range(len(kinds)):
+        end = pos + lengths[2 * i]
+        value = blob[pos:end].decode('utf-8')
+        pos = end + lengths[2 * i + 1]
+        kind = kinds[i]
+        if kind == 85:
+            terms.append(URIRef(value))
+        elif kind == 66:
+            terms.append(BNode(value))
+        else:
+            extra = blob[end:pos].decode('utf-8')
+            if extra.startswith('@'):
+                terms.append(Literal(value, lang=extra[1:]))
+            elif extra:
+                terms.append(Literal(value, datatype=URIRef(extra)))
+            else:
+                terms.append(Literal(value))
+    return terms
+
+
+# Triples que se leen de golpe del stream
+_STREAM_CHUNK = 1024
+
+
+def iter_binary_stream(stream):
+    """
+    Genera los triples de un mensaje con la codificacion binaria leyendolo de
+    un stream. La tabla de terminos se lee entera, los triples de poco en poco
+
+    :param stream: objeto con el metodo read
+    :return: generador de triples
+    """
+    magic, nterms, ntriples = _HEADER.unpack(_read_exact(stream, _HEADER.size))
+    if magic != _MAGIC:
+        raise ValueError('No es un mensaje RDF binario')
+    kinds = _read_exact(stream, nterms)
+    lengths = array('I')
+    lengths.frombytes(_read_exact(stream, 8 * nterms))
+    if sys.byteorder != 'little':
+        lengths.byteswap()
+    terms = _binary_table(kinds, lengths, _read_exact(stream, sum(lengths)))
+
+    while ntriples > 0:
+        count = min(ntriples, _STREAM_CHUNK)
+        indexes = array('I')
+        indexes.frombytes(_read_exact(stream, 12 * count))
+        if sys.byteorder != 'little':
+            indexes.byteswap()
+        for i in range(0, 3 * count, 3):
+            yield terms[indexes[i]], terms[indexes[i + 1]], terms[indexes[i + 2]]
+        ntriples -= count
+
+
+# Sobre de mensajes (batch)
+#
+# Numero de mensajes (uint32) y por cada mensaje la longitud de su tipo MIME
+# (uint16), el tipo MIME, la longitud del mensaje (uint32) y el mensaje.
+# Las respuestas a un sobre van en otro sobre en el mismo orden
+
+_BATCH_COUNT = struct.Struct('<I')
+_BATCH_PART = struct.Struct('<HI')
+
+
+def encode_batch(parts):
+    """
+    Construye un sobre con varios mensajes serializados
+
+    :param parts: lista de (tipo MIME, mensaje en bytes)
+    :return: bytes
+    """
+    chunks = [_BATCH_COUNT.pack(len(parts))]
+    for fmt, body in parts:
+        fmt = fmt.encode('ascii')
+        chunks.append(_BATCH_PART.pack(len(fmt), len(body)))
+        chunks.append(fmt)
+        chunks.append(body)
+    return b''.join(chunks)
+
+
+def decode_batch(data):
+    """
+    Separa los mensajes de un sobre
+
+    :param data: bytes
+    :return: lista de (tipo MIME, mensaje en bytes)
+    """
+    count, = _BATCH_COUNT.unpack_from(data, 0)
+    pos = _BATCH_COUNT.size
+    parts = []
+    for _ in range(count):
+        flen, blen = _BATCH_PART.unpack_from(data, pos)
+        pos += _BATCH_PART.size
+        fmt = data[pos:pos + flen].decode('ascii')
+        pos += flen
+        parts.append((mimetype(fmt), data[pos:pos + blen]))
+        pos += blen
+    return parts
+
+
+# Plantillas de mensajes
+#
+# Un grafo con URIs variables (por ejemplo el id del mensaje y el receptor) se
+# serializa una sola vez por formato con una URI de marca en el lugar de cada
+# variable. Para obtener un mensaje concreto solo se sustituyen las marcas en
+# los bytes serializados, sin construir ni serializar ningun grafo
+
+_PLACEHOLDER = 'urn:x-acl-template:'
+
+
+class GraphTemplate():
+    """
+    Grafo serializado con URIs variables
+    """
+    def __init__(self, graph, variables):
+        """
+        :param graph: grafo con la marca de cada variable (ver placeholder)
+        :param variables: nombres de las variables
+        """
+        self.graph = graph
+        self.variables = list(variables)
+        self._rendered = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def placeholder(name):
+        """
+        URI de marca de una variable de la plantilla
+        """
+        return URIRef(_PLACEHOLDER + name)
+
+    def _prepare(self, fmt):
+        with self._lock:
+            rendered = self._rendered.get(fmt)
+            if rendered is None:
+                if fmt == BINARY:
+                    kinds, values, triples = _binary_terms(self.graph)
+                    slots = {}
+                    for i, (value, _) in enumerate(values):
+                        if value.startswith(_PLACEHOLDER.encode('ascii')):
+                            slots[i] = value[len(_PLACEHOLDER):].decode('ascii')
+                    rendered = (kinds, values, slots, _le_array(triples).tobytes(), len(triples) // 3)
+                else:
+                    rendered = self.graph.serialize(format=RDFLIB_FORMATS.get(fmt, 'xml'), encoding='utf-8')
+                self._rendered[fmt] = rendered
+        return rendered
+
+    def render(self, fmt, values):
+        """
+        Serializa la plantilla con el valor de cada variable
+
+        :param fmt: tipo MIME del formato
+        :param values: diccionario nombre de variable -> URI
+        :return: bytes
+        """
+        rendered = self._rendered.get(fmt) or self._prepare(fmt)
+        if fmt == BINARY:
+            kinds, terms, slots, triples, ntriples = rendered
+            terms = list(terms)
+            for i, name in slots.items():
+                terms[i] = (str(values[name]).encode('utf-8'), b'')
+            return _pack_binary(kinds, terms, triples, ntriples)
+        for name in self.variables:
+            value = str(values[name])
+            if fmt not in (NTRIPLES, TURTLE):
+                value = escape(value, {'"': '&quot;'})
+            rendered = rendered.replace(self.placeholder(name).encode('ascii'), value.encode('utf-8'))
+        return rendered
+
+    def bind(self, **values):
+        """
+        Mensaje concreto de la plantilla, se serializa con serialize_graph
+        """
+        return TemplateMessage(self, values)
+
+
+class TemplateMessage():
+    """
+    Mensaje obtenido de una plantilla, se puede responder o serializar como si
+    fuera un grafo
+    """
+    def __init__(self, template, values):
+        self.template = template
+        self.values = values
+
+    def render(self, fmt=DEFAULT_FORMAT):
+        return self.template.render(fmt, self.values)
+
+    def to_graph(self):
+        """
+        Construye el grafo del mensaje
+        """
+        return parse_graph(self.render(NTRIPLES), NTRIPLES)
@@ -15,9 +15,10 @@ from flask import Flask, request
 from rdflib import Namespace, Graph, Literal, XSD, URIRef
 from rdflib.namespace import FOAF, RDF, RDFS
 
-from AgentUtil.ACLMessages import build_message, send_message, get_message_properties
+from AgentUtil.ACLMessages import build_message, canned_message, send_message, get_message_properties
 from AgentUtil.Agent import Agent
-from AgentUtil.FlaskServer import shutdown_server
+from AgentUtil.DirectoryClient import DirectoryResolver, keep_registered
+from AgentUtil.FlaskServer import shutdown_server, serve_message
 from AgentUtil.Logging import config_logger
 from AgentUtil.OntoNamespaces import ACL, DSO, ECSDI
 
@@ -65,6 +66,11 @@ agn = Namespace("http://www.agentes.org#")
 # Contador de mensajes
 mss_cnt = 0
 
+# Performativas y acciones que entiende el agente, los demas mensajes se
+# rechazan sin acabar de leerlos (ver serve_message)
+PERFORMATIVAS = {ACL.request}
+ACCIONES = {ECSDI.Pedir_Acuerdo_Tienda, ECSDI.Registrar_Producto_Externo}
+
 # Information about this agent (must be reviewed)
 ExternalSellerAgent = Agent('ExternalSellerAgent',
                        agn.ExternalSellerAgent,
@@ -77,6 +83,9 @@ DirectoryAgent = Agent('DirectoryAgent',
                        'http://%s:9000/Register' % hostname,
                        'http://%s:9000/Stop' % hostname)
 
+# Busquedas en el directorio con cache (ver AgentUtil.DirectoryClient)
+resolver = DirectoryResolver(ExternalSellerAgent, DirectoryAgent)
+
 
 # Global triplestore graph
 dsgraph = Graph()
@@ -110,6 +119,7 @@ def register_message():
     gmess.add((reg_obj, FOAF.name, Literal(ExternalSellerAgent.name)))
     gmess.add((reg_obj, DSO.Address, Literal(ExternalSellerAgent.address)))
     gmess.add((reg_obj, DSO.AgentType, agn.ExternalSellerAgent)) 
+    gmess.add((reg_obj, DSO.Lease, Literal(float(resolver.lease))))
 
     # Lo metemos en un envoltorio FIPA-ACL y lo enviamos
     gr = send_message(
@@ -172,41 +182,6 @@ def register_external_seller(gm, content):
 
     new_seller.serialize(destination='../Data/external_sellers', format='turtle')
 
-def get_agent_info(type):
-    """
-    Busca en el servicio de registro mandando un
-    mensaje de request con una accion Search del servicio de directorio
-    :param type:
-    :return:
-    """
-    global mss_cnt
-    logger.info('Buscamos en el servicio de registro')
-
-    gmess = Graph()
-
-    gmess.bind('foaf', FOAF)
-    gmess.bind('dso', DSO)
-    reg_obj = agn[ExternalSellerAgent.name + '-search']
-    gmess.add((reg_obj, RDF.type, DSO.Search))
-    gmess.add((reg_obj, DSO.AgentType, type))
-
-    msg = build_message(gmess, perf=ACL.request,
-                        sender=ExternalSellerAgent.uri,
-                        receiver=DirectoryAgent.uri,
-                        content=reg_obj,
-                        msgcnt=mss_cnt)
-    gr = send_message(msg, DirectoryAgent.address)
-    mss_cnt += 1
-    logger.info('Recibimos informacion del agente')
-
-    dic = get_message_properties(gr)
-    content = dic['content']
-    address = gr.value(subject=content, predicate=DSO.Address)
-    url = gr.value(subject=content, predicate=DSO.Uri)
-    name = gr.value(subject=content, predicate=FOAF.name)
-
-    return Agent(name, url, address, None)
-
 def send_message_to_agent(gmess, ragn, contentRes):
     """
     Envia una accion a un agente de informacion
@@ -225,34 +200,38 @@ def send_message_to_agent(gmess, ragn, contentRes):
 
     return gr
     
-@app.route("/comm")
+@app.route("/comm", methods=['GET', 'POST'])
 def comunicacion():
     """
     Entrypoint de comunicacion
     """
+    return serve_message(request, procesar_mensaje, PERFORMATIVAS, ACCIONES)
+
+
+def procesar_mensaje(gm):
+    """
+    Procesa un mensaje recibido por el entrypoint de comunicacion
+    :param gm: grafo con el mensaje
+    :return: grafo con la respuesta
+    """
     global dsgraph
     global mss_cnt
 
     logger.info('Peticion de informacion recibida')
 
-    # Extraemos el mensaje y creamos un grafo con el
-    message = request.args['content']
-    gm = Graph()
-    gm.parse(data=message)
-
     msgdic = get_message_properties(gm)
 
     # Comprobamos que sea un mensaje FIPA ACL
     if msgdic is None:
         # Si no es, respondemos que no hemos entendido el mensaje
-        gr = build_message(Graph(), ACL['not-understood'], sender=ExternalSellerAgent.uri, msgcnt=mss_cnt)
+        gr = canned_message(ACL['not-understood'], sender=ExternalSellerAgent.uri, msgcnt=mss_cnt)
     else:
         # Obtenemos la performativa
         perf = msgdic['performative']
 
         if perf != ACL.request:
             # Si no es un request, respondemos que no hemos entendido el mensaje
-            gr = build_message(Graph(), ACL['not-understood'], sender=ExternalSellerAgent.uri, msgcnt=mss_cnt)
+            gr = canned_message(ACL['not-understood'], sender=ExternalSellerAgent.uri, msgcnt=mss_cnt)
         else:
             # Extraemos el objeto del contenido que ha de ser una accion de la ontologia de acciones del agente
             # de registro
@@ -354,32 +333,44 @@ def comunicacion():
 
                         logger.info("Vamos a registrar el producto al procesador de compras.")
 
-                        venedor = get_agent_info(agn.SalesProcessorAgent)
-                        respuesta = send_message_to_agent(g,venedor,content)
-
-                        g = Graph()
-                        g.add((content, RDF.type, ECSDI.Producto_Registrado))
-                        g.add((content, ECSDI.Estado_registro, Literal("Se ha registrado el nuevo producto externo", datatype=XSD.string)))
-
-                        gr = build_message(g,
-                        ACL['agree'],
-                        sender=ExternalSellerAgent.uri,
-                        msgcnt=mss_cnt,
-                        receiver=msgdic['sender'])
+                        venedor = resolver.resolve(agn.SalesProcessorAgent)
+                        if venedor is None:
+                            logger.info('No hay ningun procesador de compras registrado')
+                            g = Graph()
+                            g.add((content, RDF.type, ECSDI.Producto_Registrado))
+                            g.add((content, ECSDI.Estado_registro, Literal("No se ha podido registrar el producto, vuelve a intentarlo mas tarde.", datatype=XSD.string)))
+
+                            gr = build_message(g,
+                            ACL.failure,
+                            sender=ExternalSellerAgent.uri,
+                            msgcnt=mss_cnt,
+                            receiver=msgdic['sender'])
+                        else:
+                            respuesta = send_message_to_agent(g,venedor,content)
+
+                            g = Graph()
+                            g.add((content, RDF.type, ECSDI.Producto_Registrado))
+                            g.add((content, ECSDI.Estado_registro, Literal("Se ha registrado el nuevo producto externo", datatype=XSD.string)))
+
+                            gr = build_message(g,
+                            ACL['agree'],
+                            sender=ExternalSellerAgent.uri,
+                            msgcnt=mss_cnt,
+                            receiver=msgdic['sender'])
 
                     else:
                         g = Graph()
                         g.add((content, RDF.type, ECSDI.Producto_Registrado))
                         g.add((content, ECSDI.Estado_registro, Literal("El vendedor no tiene permisos para registrar productos.", datatype=XSD.string)))
 
-                        gr = build_message(Graph(),
+                        gr = canned_message(
                         ACL['refuse'],
                         sender=ExternalSellerAgent.uri,
                         msgcnt=mss_cnt,
                         receiver=msgdic['sender'])
 
                 else:
-                    gr = build_message(Graph(),
+                    gr = canned_message(
                         ACL['not-understood'],
                         sender=ExternalSellerAgent.uri,
                         msgcnt=mss_cnt,
@@ -388,7 +379,7 @@ def comunicacion():
 
     logger.info('Respondemos a la peticion')
 
-    return gr.serialize(format='xml')
+    return gr
 
 
 @app.route("/Stop")
@@ -418,6 +409,9 @@ def agentbehavior1(cola):
     #Registramos el agente
     gr = register_message()
 
+    # Renovamos el registro hasta que el agente pare
+    keep_registered(register_message, resolver, cola)
+
 '''def get_agent_info(type_, directory_agent, sender, msgcnt):
     gmess = Graph()
     # Construimos el mensaje de registro
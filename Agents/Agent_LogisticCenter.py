@@ -18,9 +18,11 @@ import random
 import sys
 
 from AgentUtil.OntoNamespaces import ACL, DSO, ECSDI
-from AgentUtil.FlaskServer import shutdown_server
-from AgentUtil.ACLMessages import build_message, send_message, get_message_properties
+from AgentUtil.FlaskServer import shutdown_server, serve_message
+from AgentUtil.ACLMessages import build_message, canned_message, send_message, send_messages,\
+    get_message_properties
 from AgentUtil.Agent import Agent
+from AgentUtil.DirectoryClient import DirectoryResolver, keep_registered
 from AgentUtil.Logging import config_logger
 
 __author__ = 'javier'
@@ -69,6 +71,9 @@ agn = Namespace("http://www.agentes.org#")
 # Contador de mensajes
 mss_cnt = 0
 
+# Segundos que se espera la respuesta de cada transportista
+TRANSPORT_TIMEOUT = 10
+
 # Datos del Agente Centro Logistico
 LogisticCenterAgent = Agent('LogisticCenterAgent',
                        agn.LogisticCenterAgent,
@@ -81,6 +86,9 @@ DirectoryAgent = Agent('DirectoryAgent',
                        'http://%s:%d/Register' % (dhostname, dport),
                        'http://%s:%d/Stop' % (dhostname, dport))
 
+# Busquedas en el directorio con cache (ver AgentUtil.DirectoryClient)
+resolver = DirectoryResolver(LogisticCenterAgent, DirectoryAgent)
+
 # Global dsgraph triplestore
 dsgraph = Graph()
 
@@ -111,6 +119,7 @@ def register_message():
     gmess.add((reg_obj, FOAF.name, Literal(LogisticCenterAgent.name)))
     gmess.add((reg_obj, DSO.Address, Literal(LogisticCenterAgent.address)))
     gmess.add((reg_obj, DSO.AgentType, agn.LogisticCenterAgent))
+    gmess.add((reg_obj, DSO.Lease, Literal(float(resolver.lease))))
 
     # Lo metemos en un envoltorio FIPA-ACL y lo enviamos
     gr = send_message(
@@ -138,28 +147,32 @@ def stop():
     return "Parando Servidor"
 
 
-@app.route("/comm")
+@app.route("/comm", methods=['GET', 'POST'])
 def comunicacion():
     """
         Entrypoint de comunicacion del agente
         Busqueda de un Centro Logitico disponible
     """
+    return serve_message(request, procesar_mensaje)
+
+
+def procesar_mensaje(gm):
+    """
+    Procesa un mensaje recibido por el entrypoint de comunicacion
+    :param gm: grafo con el mensaje
+    :return: grafo con la respuesta
+    """
     global dsgraph 
     global mss_cnt
 
     logger.info('Peticion de informacion recibida')
 
-    #Extraemos el mensaje y creamos un grafo con el
-    message = request.args['content']
-    gm = Graph()
-    gm.parse(data=message)
-
     msgdic = get_message_properties(gm)
 
     #Comprobamos que el mensaje sera FIPA ACL
     if msgdic is None:
         # Si no es, respondemos que no hemos entendido el mensaje
-        gr = build_message(Graph(), ACL['not-understood'], sender=LogisticCenterAgent.uri, msgcnt=mss_cnt)
+        gr = canned_message(ACL['not-understood'], sender=LogisticCenterAgent.uri, msgcnt=mss_cnt)
     else:
         
         perf = msgdic['performative']
@@ -179,16 +192,26 @@ def comunicacion():
 
                 # Enviamos
                 createSend()
-            gr =build_message(Graph(), 
+            gr = canned_message(
                     perf = ACL['inform-done'], 
                     sender = LogisticCenterAgent.uri, 
                     receiver = msgdic['sender'],
                     msgcnt = mss_cnt)
+
+        # Avisos del directorio de altas y bajas de transportistas
+        elif perf == ACL.inform and resolver.process_event(gm, msgdic.get('content')):
+            gr = canned_message(
+                    perf = ACL['inform-done'],
+                    sender = LogisticCenterAgent.uri,
+                    receiver = msgdic['sender'],
+                    msgcnt = mss_cnt)
+        else:
+            gr = canned_message(ACL['not-understood'], sender=LogisticCenterAgent.uri, msgcnt=mss_cnt)
     mss_cnt += 1
 
     logger.info('Respondemos a la peticion')
     
-    return gr.serialize(format='xml')
+    return gr
 
 def tidyup():
     """
@@ -211,6 +234,9 @@ def agentbehavior1(queue):
     # Registramos el Agente Centro Logistico
     gr = register_message()
 
+    # Renovamos el registro hasta que el agente pare
+    keep_registered(register_message, resolver, queue)
+
     # Escuchando la cola hasta que llegue un 0
     """
     fin = False
@@ -299,69 +325,45 @@ def createSend():
             lotes.add((subjectT, RDF.type, ECSDI.Transportista))
             lotes.add((lote, ECSDI.Lote_Asignado_Transportista, URIRef(subjectT)))
 
-            # Pedimos transporte
-            requestTransport(gr, subjectTransport, pedido)
-
-            # Eliminamos Lote enviado
-            removeLote(lote)
-
-def getTransportAgents():
-    logger.info('Buscamos en el servicio de registro')
-
-    global mss_cnt
-    gmess = Graph()
-
-    gmess.bind('foaf', FOAF)
-    gmess.bind('dso', DSO)
-    reg_obj = agn[LogisticCenterAgent.name + '-Search']
-    gmess.add((reg_obj, RDF.type, ECSDI.Transport))
-    gmess.add((reg_obj, DSO.AgentType, agn.ExternalTransportAgent))
-
-    msg = build_message(gmess, perf=ACL.request,
-                        sender=LogisticCenterAgent.uri,
-                        receiver=DirectoryAgent.uri,
-                        content=reg_obj,
-                        msgcnt=mss_cnt)
-
-    gr = send_message(msg, DirectoryAgent.address)
-    mss_cnt += 1
-    logger.info('Recibimos informacion de los agentes de Transporte.')
-
-    dic = get_message_properties(gr)
-    content = dic['content']
-    transportistas = []
-
-    for (s,p,o) in gr.triples((content, None, None)):
-        if str(p).startswith("http://www.w3.org/1999/02/22-rdf-syntax-ns#_"):
-            address = gr.value(subject=o, predicate=DSO.Address)
-            url = gr.value(subject=o, predicate=DSO.Uri)
-            name = gr.value(subject=o, predicate=FOAF.name)
-            transportist = Agent(name, url, address, None)
-            transportistas += [transportist]
-    
-    return transportistas
+            # Pedimos transporte, si nadie lo ofrece el lote queda pendiente
+            if requestTransport(gr, subjectTransport, pedido):
+                # Eliminamos Lote enviado
+                removeLote(lote)
 
 def requestTransport(gr, content, pedido):
+    """
+    Pide ofertas a los transportistas, elige la mas barata y le asigna el envio
 
+    :return: False si ningun transportista ha hecho una oferta
+    """
     global mss_cnt
     
     logger.info('Pedimos transporte a los Agentes Externos de Transporte')
 
-    #TransportAg = get_agent_info(agn.ExternalTransportAgent)
-    agentes_transporte = getTransportAgents()
+    # La lista de transportistas se mantiene con los avisos del directorio
+    agentes_transporte = resolver.agents(agn.ExternalTransportAgent)
     TransportAg = None
     mejor_precio = float("inf")
 
+    # Pedimos oferta a todos los transportistas a la vez
+    mensajes = []
     for Transport in agentes_transporte:
         logger.info("Mandamos una peticion de oferta de envio a un agente de Transporte" + str(Transport.name))
-        gr_res = send_message(
-            build_message(gr, 
-            perf = ACL['call-for-proposal'], 
-            sender = LogisticCenterAgent.uri, 
+        gcfp = Graph()
+        gcfp += gr
+        mensajes.append((build_message(gcfp,
+            perf = ACL['call-for-proposal'],
+            sender = LogisticCenterAgent.uri,
             receiver = Transport.uri,
             msgcnt = mss_cnt,
-            content = content), Transport.address)
-        
+            content = content), Transport.address))
+
+    respuestas = send_messages(mensajes, timeout=TRANSPORT_TIMEOUT)
+
+    for Transport, gr_res in zip(agentes_transporte, respuestas):
+        if isinstance(gr_res, Exception):
+            logger.info("El transportista " + str(Transport.name) + " no ha respondido a tiempo.")
+            continue
 
         msgdic  = get_message_properties(gr_res)
         performativa = msgdic['performative']
@@ -378,14 +380,24 @@ def requestTransport(gr, content, pedido):
                 mejor_precio = precio
                 TransportAg = Transport
 
+    if TransportAg is None:
+        logger.info('Ningun transportista ha hecho una oferta para el pedido ' + str(pedido))
+        return False
+
+    rechazos = []
     for trans in agentes_transporte:
         if trans != TransportAg:
             logger.info("Informamos al agente " + str(trans.name) + " que no ha sido elegido.")
-            gr = send_message(build_message(Graph(), 
-                perf = ACL['reject-proposal'], 
-                sender = LogisticCenterAgent.uri, 
-                receiver = msgdic['sender'],
-                msgcnt = mss_cnt), trans.address)
+            rechazos.append((build_message(Graph(),
+                perf = ACL['reject-proposal'],
+                sender = LogisticCenterAgent.uri,
+                receiver = trans.uri,
+                msgcnt = mss_cnt), trans.address))
+    # Cada transportista tiene su direccion, se envian en paralelo sin sobre
+    send_messages(rechazos, timeout=TRANSPORT_TIMEOUT)
+
+    # La contra oferta parte del precio del transportista elegido
+    precio = mejor_precio
 
     # Contra oferta sobre el precio propuesto por el transportista
     logger.info('El Centro Logístico hace una contra oferta al transportista elegido.')
@@ -402,7 +414,7 @@ def requestTransport(gr, content, pedido):
     gr = send_message(build_message(g, 
         perf = ACL.request, 
         sender = LogisticCenterAgent.uri, 
-        receiver = msgdic['sender'],
+        receiver = TransportAg.uri,
         msgcnt = mss_cnt,
         content = subjectGr), TransportAg.address)
 
@@ -444,7 +456,11 @@ def requestTransport(gr, content, pedido):
     graph.add((sub, RDF.type, ECSDI.Listo_para_pagar))
     graph.add((sub, ECSDI.Pedido_enviado, Literal(pedido, datatype=XSD.string)))
 
-    SalesProcessorAg = get_agent_info(agn.SalesProcessorAgent)
+    SalesProcessorAg = resolver.resolve(agn.SalesProcessorAgent)
+    if SalesProcessorAg is None:
+        # El lote ya esta enviado, solo queda sin avisar para el cobro
+        logger.info('No hay ningun procesador de compras registrado, el pedido ' + str(pedido) + ' queda sin cobrar')
+        return True
 
     gr = send_message(build_message(graph, 
             perf = ACL.request, 
@@ -453,6 +469,8 @@ def requestTransport(gr, content, pedido):
             msgcnt = mss_cnt,
             content = sub), SalesProcessorAg.address)      
 
+    return True
+
             
 
 def removeLote(url):
@@ -470,37 +488,6 @@ def removeLote(url):
 
 
 
-def get_agent_info(type):
-
-    global mss_cnt
-    logger.info('Buscamos en el servicio de registro')
-
-    gmess = Graph()
-
-    gmess.bind('foaf', FOAF)
-    gmess.bind('dso', DSO)
-    reg_obj = agn[LogisticCenterAgent.name + '-Search']
-    gmess.add((reg_obj, RDF.type, DSO.Search))
-    gmess.add((reg_obj, DSO.AgentType, type))
-
-    msg = build_message(gmess, perf=ACL.request,
-                        sender=LogisticCenterAgent.uri,
-                        receiver=DirectoryAgent.uri,
-                        content=reg_obj,
-                        msgcnt=mss_cnt)
-
-    gr = send_message(msg, DirectoryAgent.address)
-    mss_cnt += 1
-    logger.info('Recibimos informacion del agente')
-
-    dic = get_message_properties(gr)
-    content = dic['content']
-    address = gr.value(subject=content, predicate=DSO.Address)
-    url = gr.value(subject=content, predicate=DSO.Uri)
-    name = gr.value(subject=content, predicate=FOAF.name)
-
-    return Agent(name, url, address, None)
-
     
 
 if __name__ == '__main__':
@@ -13,12 +13,17 @@ import sys
 from flask import Flask, request
 from rdflib import Namespace, Graph, Literal, URIRef, XSD
 from rdflib.namespace import FOAF, RDF, RDFS
+from rdflib.plugins.sparql import prepareQuery
 
-from AgentUtil.ACLMessages import build_message, send_message, get_message_properties
+from AgentUtil.ACLMessages import build_message, canned_message, send_message, get_message_properties
 from AgentUtil.Agent import Agent
-from AgentUtil.FlaskServer import shutdown_server
+from AgentUtil.DirectoryClient import DirectoryResolver, LoadReporter, keep_registered
+from AgentUtil.FlaskServer import shutdown_server, serve_message
 from AgentUtil.Logging import config_logger
 from AgentUtil.OntoNamespaces import ACL, DSO, ECSDI
+from AgentUtil.ProductCatalog import ProductCatalog, SORTS, SORT_NAME, SORT_PRICE, SORT_PRICE_DESC, \
+    SEARCH_PAGE_SIZE, SEARCH_PAGE_MAX, SEARCH_OFFSET_MAX, paging_value
+from AgentUtil.TextIndex import EXACT, MODES, text_matches
 
 __author__ = 'javier'
 
@@ -64,9 +69,17 @@ agn = Namespace("http://www.agentes.org#")
 # Contador de mensajes
 mss_cnt = 0
 
-# Information about this agent (must be reviewed)
+# Performativas y acciones que entiende el agente, los demas mensajes se
+# rechazan sin acabar de leerlos (ver serve_message)
+PERFORMATIVAS = {ACL.request}
+ACCIONES = {ECSDI.Buscar_productos, ECSDI.Procesar_Compra, ECSDI.Devolver_Producto,
+            ECSDI.Nuevo_Producto, ECSDI.Listo_para_pagar}
+
+# Information about this agent (must be reviewed). Cada instancia tiene su
+# URI (con su host y puerto) para que el directorio las guarde todas, el tipo
+# de agente (agn.SalesProcessorAgent) es el mismo para todas
 SalesProcessorAgent = Agent('SalesProcessorAgent',
-                       agn.SalesProcessorAgent,
+                       agn['SalesProcessorAgent-%s-%d' % (hostname, port)],
                        'http://%s:%d/comm' % (hostname, port),
                        'http://%s:%d/Stop' % (hostname, port))
 
@@ -76,10 +89,27 @@ DirectoryAgent = Agent('DirectoryAgent',
                        'http://%s:9000/Register' % hostname,
                        'http://%s:9000/Stop' % hostname)
 
+# Busquedas en el directorio con cache (ver AgentUtil.DirectoryClient). El
+# centro logistico y el tesorero se buscan juntos en un solo mensaje
+resolver = DirectoryResolver(SalesProcessorAgent, DirectoryAgent,
+                             related=[agn.LogisticCenterAgent, agn.TreasurerAgent])
+
+# Carga del agente que se comunica al directorio para repartir las peticiones
+# entre las instancias del agente
+carga = LoadReporter(resolver)
+
 
 # Global triplestore graph
 dsgraph = Graph()
 
+# Catalogo de productos, se carga una vez y se mantiene en memoria (ver
+# AgentUtil.ProductCatalog)
+catalog = ProductCatalog('../Data/products')
+
+# Consultas SPARQL preparadas de la busqueda de productos, por combinacion de
+# filtros (ver searchProductsQuery)
+search_queries = {}
+
 cola1 = Queue()
 
 # Flask stuff
@@ -110,6 +140,7 @@ def register_message():
     gmess.add((reg_obj, FOAF.name, Literal(SalesProcessorAgent.name)))
     gmess.add((reg_obj, DSO.Address, Literal(SalesProcessorAgent.address)))
     gmess.add((reg_obj, DSO.AgentType, agn.SalesProcessorAgent)) # Això s'hauria de revisar. Si deixem el tipus a ECSDI.Procesador_Compras caldria afegir-ho a la ontologia.
+    gmess.add((reg_obj, DSO.Lease, Literal(float(resolver.lease))))
 
     # Lo metemos en un envoltorio FIPA-ACL y lo enviamos
     gr = send_message(
@@ -123,34 +154,39 @@ def register_message():
 
     return gr
 
-@app.route("/comm")
+@app.route("/comm", methods=['GET', 'POST'])
 def comunicacion():
     """
     Entrypoint de comunicacion
     """
+    with carga:
+        return serve_message(request, procesar_mensaje, PERFORMATIVAS, ACCIONES)
+
+
+def procesar_mensaje(gm):
+    """
+    Procesa un mensaje recibido por el entrypoint de comunicacion
+    :param gm: grafo con el mensaje
+    :return: grafo con la respuesta
+    """
     global dsgraph
     global mss_cnt
 
     logger.info('Peticion de informacion recibida')
 
-    # Extraemos el mensaje y creamos un grafo con el
-    message = request.args['content']
-    gm = Graph()
-    gm.parse(data=message)
-
     msgdic = get_message_properties(gm)
 
     # Comprobamos que sea un mensaje FIPA ACL
     if msgdic is None:
         # Si no es, respondemos que no hemos entendido el mensaje
-        gr = build_message(Graph(), ACL['not-understood'], sender=SalesProcessorAgent.uri, msgcnt=mss_cnt)
+        gr = canned_message(ACL['not-understood'], sender=SalesProcessorAgent.uri, msgcnt=mss_cnt)
     else:
         # Obtenemos la performativa
         perf = msgdic['performative']
 
         if perf != ACL.request:
             # Si no es un request, respondemos que no hemos entendido el mensaje
-            gr = build_message(Graph(), ACL['not-understood'], sender=SalesProcessorAgent.uri, msgcnt=mss_cnt)
+            gr = canned_message(ACL['not-understood'], sender=SalesProcessorAgent.uri, msgcnt=mss_cnt)
         else:
             # Extraemos el objeto del contenido que ha de ser una accion de la ontologia de acciones del agente
             # de registro
@@ -169,6 +205,11 @@ def comunicacion():
                             name = gm.value(subject=aFilter, predicate=ECSDI.Nombre)
                             logger.info('Nombre: ' + name)
                             searchFilters_dict['name'] = name
+                            # Modo de busqueda del nombre (exacto si no hay)
+                            name_mode = gm.value(subject=aFilter, predicate=ECSDI.Modo_busqueda)
+                            if name_mode is not None and str(name_mode) in MODES:
+                                logger.info('Modo de busqueda: ' + name_mode)
+                                searchFilters_dict['name_mode'] = str(name_mode)
                         elif gm.value(subject=aFilter, predicate=RDF.type) == ECSDI.Filtrar_marca:
                             brand = gm.value(subject=aFilter, predicate=ECSDI.Marca)
                             logger.info('Marca: ' + brand)
@@ -196,40 +237,70 @@ def comunicacion():
                                 logger.info('Se incluyen productos internos')
                                 searchFilters_dict['include_internal_prod'] = True
 
-                    gr = build_message(searchProducts(**searchFilters_dict),
-                        ACL['inform-result'],
-                        sender=SalesProcessorAgent.uri,
-                        msgcnt=mss_cnt,
-                        receiver=msgdic['sender'])
+                    # Pagina y orden de los resultados
+                    page_size = paging_value(gm.value(subject=content, predicate=ECSDI.Tamano_pagina),
+                                             SEARCH_PAGE_SIZE, 1, SEARCH_PAGE_MAX)
+                    offset = paging_value(gm.value(subject=content, predicate=ECSDI.Desplazamiento),
+                                          0, 0, SEARCH_OFFSET_MAX)
+                    sort = gm.value(subject=content, predicate=ECSDI.Ordenar_por)
+                    if sort is not None and str(sort) in SORTS:
+                        searchFilters_dict['sort'] = str(sort)
+
+                    if page_size is None or offset is None:
+                        # La pagina no es un numero entero
+                        logger.info('Paginacion incorrecta en la busqueda')
+                        gr = canned_message(
+                            ACL['not-understood'],
+                            sender=SalesProcessorAgent.uri,
+                            msgcnt=mss_cnt,
+                            receiver=msgdic['sender'])
+                    else:
+                        searchFilters_dict['limit'] = page_size
+                        searchFilters_dict['offset'] = offset
+                        gr = build_message(searchProducts(**searchFilters_dict),
+                            ACL['inform-result'],
+                            sender=SalesProcessorAgent.uri,
+                            msgcnt=mss_cnt,
+                            receiver=msgdic['sender'])
                 
                 # Buy products action
                 elif accion == ECSDI.Procesar_Compra:
                     logger.info('Recibida peticion compra')
-                    gOrder = recordNewOrder(gm)
-                    logger.info('Asignamos envio a centro logistico')
-                    assignToLogisticCenter(gOrder)
-
-                    compra_realizada = ECSDI['compra_realizada' + str(mss_cnt)]
-                    gOrder.add((compra_realizada, RDF.type, ECSDI.Compra_Realizada))
-
-                    subjectsFound = gOrder.subjects(predicate=RDF.type, object=ECSDI.Pedido)
-                    for s in subjectsFound:
-                        order = s
-                    gOrder.add((compra_realizada, ECSDI.Pedido_Procesado, order))
-
-                    date = gOrder.value(subject=order, predicate=ECSDI.Fecha_Pedido)
-                    priority = gOrder.value(subject=order, predicate=ECSDI.Prioridad_Entrega)
-                    if str(priority) == 'maxima':
-                        delivery_date = date.toPython() + timedelta(days=2)
+                    logistic = resolver.resolve(agn.LogisticCenterAgent)
+                    if logistic is None:
+                        # Sin centro logistico el pedido no se puede enviar, no se registra
+                        logger.info('No hay ningun centro logistico registrado')
+                        gr = canned_message(
+                            ACL.failure,
+                            sender=SalesProcessorAgent.uri,
+                            msgcnt=mss_cnt,
+                            receiver=msgdic['sender'])
                     else:
-                        delivery_date = date.toPython() + timedelta(days=6)
-                    gOrder.add((compra_realizada, ECSDI.Fecha_Entrega, Literal(delivery_date, datatype=XSD.dateTime)))
-
-                    gr = build_message(gOrder,
-                        ACL['inform-result'],
-                        sender=SalesProcessorAgent.uri,
-                        msgcnt=mss_cnt,
-                        receiver=msgdic['sender'])
+                        gOrder = recordNewOrder(gm)
+                        logger.info('Asignamos envio a centro logistico')
+                        assignToLogisticCenter(gOrder, logistic)
+
+                        compra_realizada = ECSDI['compra_realizada' + str(mss_cnt)]
+                        gOrder.add((compra_realizada, RDF.type, ECSDI.Compra_Realizada))
+
+                        subjectsFound = gOrder.subjects(predicate=RDF.type, object=ECSDI.Pedido)
+                        for s in subjectsFound:
+                            order = s
+                        gOrder.add((compra_realizada, ECSDI.Pedido_Procesado, order))
+
+                        date = gOrder.value(subject=order, predicate=ECSDI.Fecha_Pedido)
+                        priority = gOrder.value(subject=order, predicate=ECSDI.Prioridad_Entrega)
+                        if str(priority) == 'maxima':
+                            delivery_date = date.toPython() + timedelta(days=2)
+                        else:
+                            delivery_date = date.toPython() + timedelta(days=6)
+                        gOrder.add((compra_realizada, ECSDI.Fecha_Entrega, Literal(delivery_date, datatype=XSD.dateTime)))
+
+                        gr = build_message(gOrder,
+                            ACL['inform-result'],
+                            sender=SalesProcessorAgent.uri,
+                            msgcnt=mss_cnt,
+                            receiver=msgdic['sender'])
 
                 # Return product action
                 elif accion == ECSDI.Devolver_Producto:
@@ -256,16 +327,13 @@ def comunicacion():
                         gr.add((action, RDF.type, ECSDI.Devolver_importe))
                         gr.add((action, ECSDI.Producto_a_Devolver, product))
 
-                        productsFile = open('../Data/products')
-                        productsGraph = Graph()
-                        productsGraph.parse(productsFile, format='turtle')
-
-                        for s,p,o in productsGraph.triples((product, None, None)):
-                            gr.add((s, p, o))
-                            if p == ECSDI.Vendido_por:
-                                logger.info('El producto es externo. Añadiendo datos vendedor.')
-                                for s1, p1, o1 in productsGraph.triples((o, None, None)):
-                                    gr.add((s1, p1, o1))
+                        with catalog as productsGraph:
+                            for s,p,o in productsGraph.triples((product, None, None)):
+                                gr.add((s, p, o))
+                                if p == ECSDI.Vendido_por:
+                                    logger.info('El producto es externo. Añadiendo datos vendedor.')
+                                    for s1, p1, o1 in productsGraph.triples((o, None, None)):
+                                        gr.add((s1, p1, o1))
 
                         ordersFile = open('../Data/orders')
                         ordersGraph = Graph()
@@ -274,13 +342,18 @@ def comunicacion():
                         payment = str(ordersGraph.value(URIRef(orderURI), ECSDI.Informacion_Pago))
                         gr.add((action, ECSDI.Forma_pago, Literal(payment, datatype=XSD.string)))
 
-                        sendToTreasurer(gr, action, mss_cnt)
-
-                        gr = build_message(graph_res,
-                        ACL['accept-proposal'],
-                        sender=SalesProcessorAgent.uri,
-                        msgcnt=mss_cnt,
-                        receiver=msgdic['sender'])
+                        if not sendToTreasurer(gr, action, mss_cnt):
+                            gr = canned_message(
+                                ACL.failure,
+                                sender=SalesProcessorAgent.uri,
+                                msgcnt=mss_cnt,
+                                receiver=msgdic['sender'])
+                        else:
+                            gr = build_message(graph_res,
+                            ACL['accept-proposal'],
+                            sender=SalesProcessorAgent.uri,
+                            msgcnt=mss_cnt,
+                            receiver=msgdic['sender'])
                     else:
                         estado_dev = ECSDI['estado_devolucion' + str(mss_cnt)]
                         graph_res.add((estado_dev, RDF.type, ECSDI.Estado_Devolucion))
@@ -300,21 +373,19 @@ def comunicacion():
                     for newProduct in result:
                         product = newProduct
                     
-                    productsFile = open('../Data/products')
-                    productsGraph = Graph()
-                    productsGraph.parse(productsFile, format='turtle')
-
+                    newTriples = []
                     productData = gm.triples((product, None, None))
                     for s,p,o in productData:
-                        productsGraph.add((s,p,o))
+                        newTriples.append((s,p,o))
                         if (p == ECSDI.Vendido_por):
                             ext_seller = gm.triples((o, None, None))
                             for s1, p1, o1 in ext_seller:
-                                productsGraph.add((s1, p1, o1))
-                    
-                    productsGraph.serialize(destination='../Data/products', format='turtle')
+                                newTriples.append((s1, p1, o1))
+
+                    # Se añade al catalogo residente y al final del fichero
+                    catalog.add(newTriples)
 
-                    gr = build_message(Graph(),
+                    gr = canned_message(
                         ACL['inform-done'],
                         sender=SalesProcessorAgent.uri,
                         msgcnt=mss_cnt,
@@ -328,10 +399,6 @@ def comunicacion():
                     ordersGraph = Graph()
                     ordersGraph.parse(ordersFile, format='turtle')
 
-                    productsFile = open('../Data/products')
-                    productsGraph = Graph()
-                    productsGraph.parse(productsFile, format='turtle')
-
                     gr = Graph()
                     action = ECSDI['pedido_a_cobrar'+str(mss_cnt)]
                     gr.add((action, RDF.type, ECSDI.Cobrar_pedido))
@@ -342,26 +409,32 @@ def comunicacion():
                     for s,p,o in ordersGraph.triples((order_recieved, None, None)):
                         gr.add((s, p, o))
                     
-                    for prod in ordersGraph.objects(order_recieved, ECSDI.Productos_Pedido):
-                        # Add product info
-                        for s,p,o in productsGraph.triples((prod, None, None)):
-                            gr.add((s, p, o))
-                            # Add seller info if product is external (has Vendido_por object property)
-                            if p == ECSDI.Vendido_por:
-                                logger.info('Un producto externo. Añadiendo datos vendedor.')
-                                for s1, p1, o1 in productsGraph.triples((o, None, None)):
-                                    gr.add((s1, p1, o1))
-
-                    sendToTreasurer(gr, action, mss_cnt)
-
-                    gr = build_message(Graph(),
-                        ACL['inform-done'],
-                        sender=SalesProcessorAgent.uri,
-                        msgcnt=mss_cnt,
-                        receiver=msgdic['sender'])
+                    with catalog as productsGraph:
+                        for prod in ordersGraph.objects(order_recieved, ECSDI.Productos_Pedido):
+                            # Add product info
+                            for s,p,o in productsGraph.triples((prod, None, None)):
+                                gr.add((s, p, o))
+                                # Add seller info if product is external (has Vendido_por object property)
+                                if p == ECSDI.Vendido_por:
+                                    logger.info('Un producto externo. Añadiendo datos vendedor.')
+                                    for s1, p1, o1 in productsGraph.triples((o, None, None)):
+                                        gr.add((s1, p1, o1))
+
+                    if not sendToTreasurer(gr, action, mss_cnt):
+                        gr = canned_message(
+                            ACL.failure,
+                            sender=SalesProcessorAgent.uri,
+                            msgcnt=mss_cnt,
+                            receiver=msgdic['sender'])
+                    else:
+                        gr = canned_message(
+                            ACL['inform-done'],
+                            sender=SalesProcessorAgent.uri,
+                            msgcnt=mss_cnt,
+                            receiver=msgdic['sender'])
 
                 else:
-                    gr = build_message(Graph(),
+                    gr = canned_message(
                         ACL['not-understood'],
                         sender=SalesProcessorAgent.uri,
                         msgcnt=mss_cnt,
@@ -371,7 +444,7 @@ def comunicacion():
 
     logger.info('Respondemos a la peticion')
 
-    return gr.serialize(format='xml')
+    return gr
 
 
 @app.route("/Stop")
@@ -401,70 +474,58 @@ def agentbehavior1(cola):
     #Registramos el agente
     gr = register_message()
 
-def searchProducts(name=None, brand=None, prod_type=None, min_price=0.0, max_price=sys.float_info.max, include_external_prod=False, include_internal_prod=False):
+    # Renovamos el registro hasta que el agente pare
+    keep_registered(register_message, resolver, cola)
+
+def searchProducts(name=None, brand=None, prod_type=None, min_price=0.0, max_price=sys.float_info.max, include_external_prod=False, include_internal_prod=False, name_mode=EXACT, sort=SORT_NAME, offset=0, limit=SEARCH_PAGE_SIZE):
+    """
+    Busca los productos que cumplen los filtros y retorna una pagina de
+    resultados (limit productos a partir de offset en el orden sort)
+    """
     if not include_external_prod and not include_internal_prod:
         return Graph()
 
-    graph = Graph()
-    ontologyFile = open('../Data/products')
-    graph.parse(ontologyFile, format='turtle')
-
-    first_filter = first_prod_class = 0
-    query = """
-        prefix rdf:<http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-        prefix xsd:<http://www.w3.org/2001/XMLSchema#>
-        prefix ecsdi:<http://www.semanticweb.org/joan/ontologies/2020/3/practicaECSDI#>
-        prefix owl:<http://www.w3.org/2002/07/owl#>
-        SELECT DISTINCT ?producto ?nombre ?marca ?tipo ?precio ?peso
-        where {
-        """
-
+    classes = []
     if include_external_prod:
-        query += """{ ?producto rdf:type ecsdi:Producto_externo }"""
-        first_prod_class = 1
+        classes.append(ECSDI.Producto_externo)
     if include_internal_prod:
-        if first_prod_class == 1:
-            query += """ UNION """
-        query += """{ ?producto rdf:type ecsdi:Producto_interno }"""
-
-    query += """ .
-            ?producto ecsdi:Nombre ?nombre .
-            ?producto ecsdi:Marca ?marca .
-            ?producto ecsdi:Tipo ?tipo .
-            ?producto ecsdi:Precio ?precio .
-            ?producto ecsdi:Peso ?peso .
-            FILTER("""
-
-    if name is not None:
-        query += """str(?nombre) = '""" + name + """'"""
-        first_filter = 1
-
-    if brand is not None:
-        if first_filter == 1:
-            query += """ && """
+        classes.append(ECSDI.Producto_interno)
+
+    # Catalogo residente, no se vuelve a leer el fichero en cada busqueda
+    with catalog as graph:
+        if catalog.index is not None:
+            # Indices del catalogo, el coste depende del numero de resultados.
+            # Se pide uno mas para saber si hay mas paginas
+            graph_query = catalog.index.search(name, brand, prod_type, min_price, max_price, classes, name_mode,
+                                               sort, offset, limit + 1)
+        elif name is not None and name_mode != EXACT:
+            # Sin indice de palabras se filtra el nombre sobre los resultados
+            query, bindings = searchProductsQuery(None, brand, prod_type, min_price, max_price,
+                                                  include_external_prod, include_internal_prod)
+            graph_query = [row for row in graph.query(query, initBindings=bindings)
+                           if text_matches(name, (row.nombre, row.marca), name_mode)]
         else:
-            first_filter = 1
-        query += """str(?marca) = '""" + brand + """'"""
+            query, bindings = searchProductsQuery(name, brand, prod_type, min_price, max_price,
+                                                  include_external_prod, include_internal_prod)
+            graph_query = list(graph.query(query, initBindings=bindings))
+        if catalog.index is None:
+            # La consulta ordena por nombre
+            if sort in (SORT_PRICE, SORT_PRICE_DESC):
+                graph_query.sort(key=lambda row: (float(row.precio), str(row.nombre).upper(), str(row.producto)),
+                                 reverse=sort == SORT_PRICE_DESC)
+            graph_query = graph_query[offset:offset + limit + 1]
+    more = len(graph_query) > limit
+    graph_query = graph_query[:limit]
 
-    if prod_type is not None:
-        if first_filter == 1:
-            query += """ && """
-        else:
-            first_filter = 1
-        query += """str(?tipo) = '""" + prod_type + """'"""
-    
-    if first_filter == 1:
-        query += """ && """
-    query += """?precio >= """ + str(min_price) + """ &&
-                ?precio <= """ + str(max_price) + """  )}
-                order by asc(UCASE(str(?nombre)))"""
-    
-    graph_query = graph.query(query)
     result = Graph()
     result.bind('ECSDI', ECSDI)
 
     productos_encontrados = ECSDI['productos_encontrados' + str(mss_cnt)]
     result.add((productos_encontrados, RDF.type, ECSDI.Productos_encontrados))
+    result.add((productos_encontrados, ECSDI.Ordenar_por, Literal(sort, datatype=XSD.string)))
+    result.add((productos_encontrados, ECSDI.Desplazamiento, Literal(offset, datatype=XSD.integer)))
+    result.add((productos_encontrados, ECSDI.Tamano_pagina, Literal(limit, datatype=XSD.integer)))
+    result.add((productos_encontrados, ECSDI.Hay_mas, Literal(more, datatype=XSD.boolean)))
 
     product_count = 0
     for row in graph_query:
@@ -482,9 +543,61 @@ def searchProducts(name=None, brand=None, prod_type=None, min_price=0.0, max_pri
         result.add((subject, ECSDI.Tipo, Literal(prod_type, datatype=XSD.string)))
         result.add((subject, ECSDI.Precio, Literal(price, datatype=XSD.float)))
         result.add((subject, ECSDI.Peso, Literal(weight, datatype=XSD.integer)))
+        # Posicion en los resultados, el grafo no tiene orden
+        result.add((subject, ECSDI.Posicion, Literal(offset + product_count - 1, datatype=XSD.integer)))
         result.add((productos_encontrados, ECSDI.Contiene_producto, subject))
     return result
 
+def searchProductsQuery(name, brand, prod_type, min_price, max_price, include_external_prod, include_internal_prod):
+    """
+    Consulta SPARQL de la busqueda de productos, si el catalogo no tiene indices
+
+    Hay una consulta preparada (prepareQuery) por cada combinacion de filtros
+    y clases de producto, que se analiza una sola vez. Los valores de los
+    filtros no forman parte de la consulta, se pasan con initBindings
+
+    :return: consulta preparada y los valores de sus variables
+    """
+    shape = (name is not None, brand is not None, prod_type is not None, include_external_prod, include_internal_prod)
+    query = search_queries.get(shape)
+    if query is None:
+        classes = []
+        if include_external_prod:
+            classes.append("""{ ?producto rdf:type ecsdi:Producto_externo }""")
+        if include_internal_prod:
+            classes.append("""{ ?producto rdf:type ecsdi:Producto_interno }""")
+
+        filters = []
+        if name is not None:
+            filters.append("""str(?nombre) = ?filtro_nombre""")
+        if brand is not None:
+            filters.append("""str(?marca) = ?filtro_marca""")
+        if prod_type is not None:
+            filters.append("""str(?tipo) = ?filtro_tipo""")
+        filters.append("""?precio >= ?precio_minimo && ?precio <= ?precio_maximo""")
+
+        query = prepareQuery("""
+            SELECT DISTINCT ?producto ?nombre ?marca ?tipo ?precio ?peso
+            where {
+            """ + """ UNION """.join(classes) + """ .
+                ?producto ecsdi:Nombre ?nombre .
+                ?producto ecsdi:Marca ?marca .
+                ?producto ecsdi:Tipo ?tipo .
+                ?producto ecsdi:Precio ?precio .
+                ?producto ecsdi:Peso ?peso .
+                FILTER(""" + """ && """.join(filters) + """)}
+                order by asc(UCASE(str(?nombre)))""", initNs={'rdf': RDF, 'ecsdi': ECSDI})
+        search_queries[shape] = query
+
+    bindings = {'precio_minimo': Literal(float(min_price)), 'precio_maximo': Literal(float(max_price))}
+    if name is not None:
+        bindings['filtro_nombre'] = Literal(str(name))
+    if brand is not None:
+        bindings['filtro_marca'] = Literal(str(brand))
+    if prod_type is not None:
+        bindings['filtro_tipo'] = Literal(str(prod_type))
+    return query, bindings
+
 def recordNewOrder(gm):
     global mss_cnt
 
@@ -533,7 +646,7 @@ def recordNewOrder(gm):
 
     return gNewOrder
 
-def assignToLogisticCenter(gr):
+def assignToLogisticCenter(gr, logistic):
     global mss_cnt
 
     content = ECSDI['enviar_pedido' + str(mss_cnt)]
@@ -546,8 +659,6 @@ def assignToLogisticCenter(gr):
         
     gr.add((content, ECSDI.Pedido_A_Enviar, order))
 
-    logistic = get_agent_info(agn.LogisticCenterAgent, DirectoryAgent, SalesProcessorAgent, mss_cnt)
-
     gr = send_message(
         build_message(gr, perf=ACL.request, sender=SalesProcessorAgent.uri, receiver=logistic.uri, msgcnt=mss_cnt, content=content),
         logistic.address
@@ -578,36 +689,22 @@ def analyzeReturnRequest(gm, motivo, product, orderURI):
     return False
 
 def sendToTreasurer(gr, content, mss_cnt):
+    """
+    Pide al tesorero la accion de content
+
+    :return: False si no hay ningun tesorero registrado
+    """
     logger.info('Pedimos al Tesorero que realice el cobro')
-    treasurer = get_agent_info(agn.TreasurerAgent, DirectoryAgent, SalesProcessorAgent, mss_cnt)
+    treasurer = resolver.resolve(agn.TreasurerAgent)
+    if treasurer is None:
+        logger.info('No hay ningun tesorero registrado')
+        return False
 
     gr = send_message(
         build_message(gr, perf=ACL.request, sender=SalesProcessorAgent.uri, receiver=treasurer.uri, msgcnt=mss_cnt, content=content),
         treasurer.address
     )
-
-def get_agent_info(type_, directory_agent, sender, msgcnt):
-    gmess = Graph()
-    # Construimos el mensaje de registro
-    gmess.bind('foaf', FOAF)
-    gmess.bind('dso', DSO)
-    ask_obj = agn[sender.name + '-Search']
-
-    gmess.add((ask_obj, RDF.type, DSO.Search))
-    gmess.add((ask_obj, DSO.AgentType, type_))
-    gr = send_message(
-        build_message(gmess, perf=ACL.request, sender=sender.uri, receiver=directory_agent.uri, msgcnt=msgcnt,
-                      content=ask_obj),
-        directory_agent.address
-    )
-    dic = get_message_properties(gr)
-    content = dic['content']
-
-    address = gr.value(subject=content, predicate=DSO.Address)
-    url = gr.value(subject=content, predicate=DSO.Uri)
-    name = gr.value(subject=content, predicate=FOAF.name)
-
-    return Agent(name, url, address, None)
+    return True
 
 
 if __name__ == '__main__':
@@ -615,6 +712,9 @@ if __name__ == '__main__':
     ab1 = Process(target=agentbehavior1, args=(cola1,))
     ab1.start()
 
+    # Cargamos el catalogo antes de atender peticiones
+    catalog.refresh()
+
     # Ponemos en marcha el servidor
     app.run(host=hostname, port=port)
 
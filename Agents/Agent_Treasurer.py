@@ -14,9 +14,10 @@ from rdflib import Graph, Namespace, Literal
 from rdflib.namespace import FOAF, RDF, XSD
 
 from AgentUtil.OntoNamespaces import ACL, DSO, ECSDI
-from AgentUtil.FlaskServer import shutdown_server
-from AgentUtil.ACLMessages import build_message, send_message, get_message_properties
+from AgentUtil.FlaskServer import shutdown_server, serve_message
+from AgentUtil.ACLMessages import build_message, canned_message, send_message, send_batch, get_message_properties
 from AgentUtil.Agent import Agent
+from AgentUtil.DirectoryClient import DirectoryResolver, LoadReporter, keep_registered
 from AgentUtil.Logging import config_logger
 
 __author__ = 'javier'
@@ -65,9 +66,19 @@ agn = Namespace("http://www.agentes.org#")
 # Contador de mensajes
 mss_cnt = 0
 
-# Datos del Agente
+# Performativas y acciones que entiende el agente, los demas mensajes se
+# rechazan sin acabar de leerlos (ver serve_message)
+PERFORMATIVAS = {ACL.request}
+ACCIONES = {ECSDI.Cobrar_pedido, ECSDI.Devolver_importe}
+
+# Segundos que se espera la respuesta del banco a cada transferencia
+BANK_TIMEOUT = 10
+
+# Datos del Agente. Cada instancia tiene su URI (con su host y puerto) para
+# que el directorio las guarde todas, el tipo de agente (agn.TreasurerAgent) es
+# el mismo para todas
 TreasurerAgent = Agent('TreasurerAgent',
-                  agn.TreasurerAgent,
+                  agn['TreasurerAgent-%s-%d' % (hostname, port)],
                   'http://%s:%d/comm' % (hostname, port),
                   'http://%s:%d/Stop' % (hostname, port))
 
@@ -77,6 +88,13 @@ DirectoryAgent = Agent('DirectoryAgent',
                        'http://%s:%d/Register' % (dhostname, dport),
                        'http://%s:%d/Stop' % (dhostname, dport))
 
+# Busquedas en el directorio con cache (ver AgentUtil.DirectoryClient)
+resolver = DirectoryResolver(TreasurerAgent, DirectoryAgent)
+
+# Carga del agente que se comunica al directorio para repartir las peticiones
+# entre las instancias del agente
+carga = LoadReporter(resolver)
+
 # Global dsgraph triplestore
 dsgraph = Graph()
 
@@ -108,6 +126,7 @@ def register_message():
     gmess.add((reg_obj, FOAF.name, Literal(TreasurerAgent.name)))
     gmess.add((reg_obj, DSO.Address, Literal(TreasurerAgent.address)))
     gmess.add((reg_obj, DSO.AgentType, agn.TreasurerAgent))
+    gmess.add((reg_obj, DSO.Lease, Literal(float(resolver.lease))))
 
     # Lo metemos en un envoltorio FIPA-ACL y lo enviamos
     gr = send_message(
@@ -122,41 +141,6 @@ def register_message():
     return gr
 
 
-def get_agent_info(type):
-    """
-    Busca en el servicio de registro mandando un
-    mensaje de request con una accion Search del servicio de directorio
-    :param type:
-    :return:
-    """
-    global mss_cnt
-    logger.info('Buscamos en el servicio de registro')
-
-    gmess = Graph()
-
-    gmess.bind('foaf', FOAF)
-    gmess.bind('dso', DSO)
-    reg_obj = agn[TreasurerAgent.name + '-search']
-    gmess.add((reg_obj, RDF.type, DSO.Search))
-    gmess.add((reg_obj, DSO.AgentType, type))
-
-    msg = build_message(gmess, perf=ACL.request,
-                        sender=TreasurerAgent.uri,
-                        receiver=DirectoryAgent.uri,
-                        content=reg_obj,
-                        msgcnt=mss_cnt)
-    gr = send_message(msg, DirectoryAgent.address)
-    mss_cnt += 1
-    logger.info('Recibimos informacion del agente')
-
-    dic = get_message_properties(gr)
-    content = dic['content']
-    address = gr.value(subject=content, predicate=DSO.Address)
-    url = gr.value(subject=content, predicate=DSO.Uri)
-    name = gr.value(subject=content, predicate=FOAF.name)
-
-    return Agent(name, url, address, None)
-
 
 def send_message_to_agent(gmess, ragn, contentRes):
     """
@@ -176,34 +160,62 @@ def send_message_to_agent(gmess, ragn, contentRes):
 
     return gr
 
-@app.route("/comm")
+def send_messages_to_agent(acciones, ragn):
+    """
+    Envia varias acciones a un agente en un solo sobre de mensajes
+    :param acciones: lista de (grafo, contenido)
+    :return: lista de respuestas en el mismo orden
+    """
+    global mss_cnt
+    logger.info('Hacemos ' + str(len(acciones)) + ' peticiones al servicio de informacion')
+
+    mensajes = []
+    for gmess, contentRes in acciones:
+        msg = build_message(gmess, perf=ACL.request,
+                            sender=TreasurerAgent.uri,
+                            receiver=ragn.uri,
+                            msgcnt=mss_cnt,
+                            content=contentRes)
+        mensajes.append((msg, ragn.address))
+        mss_cnt += 1
+    res = send_batch(mensajes, timeout=BANK_TIMEOUT)
+    logger.info('Recibimos respuesta a las peticiones al servicio de informacion')
+
+    return res
+
+@app.route("/comm", methods=['GET', 'POST'])
 def comunicacion():
     """
     Entrypoint de comunicacion del agente
     """
+    with carga:
+        return serve_message(request, procesar_mensaje, PERFORMATIVAS, ACCIONES)
+
+
+def procesar_mensaje(gm):
+    """
+    Procesa un mensaje recibido por el entrypoint de comunicacion
+    :param gm: grafo con el mensaje
+    :return: grafo con la respuesta
+    """
     global dsgraph
     global mss_cnt
 
     logger.info('Peticion de cobro recibida')
 
-    # Extraemos el mensaje y creamos un grafo con el
-    message = request.args['content']
-    gm = Graph()
-    gm.parse(data=message)
-
     msgdic = get_message_properties(gm)
 
     # Comprobamos que sea un mensaje FIPA ACL
     if msgdic is None:
         # Si no es, respondemos que no hemos entendido el mensaje
-        gr = build_message(Graph(), ACL['not-understood'], sender=TreasurerAgent.uri, msgcnt=mss_cnt)
+        gr = canned_message(ACL['not-understood'], sender=TreasurerAgent.uri, msgcnt=mss_cnt)
     else:
         # Obtenemos la performativa
         perf = msgdic['performative']
 
         if perf != ACL.request:
             # Si no es un request, respondemos que no hemos entendido el mensaje
-            gr = build_message(Graph(), ACL['not-understood'], sender=TreasurerAgent.uri, msgcnt=mss_cnt)
+            gr = canned_message(ACL['not-understood'], sender=TreasurerAgent.uri, msgcnt=mss_cnt)
         else:
             # Extraemos el objeto del contenido que ha de ser una accion de la ontologia de acciones del agente
             # de registro
@@ -213,11 +225,20 @@ def comunicacion():
                 content = msgdic['content']
                 accion = gm.value(subject=content, predicate=RDF.type)
 
-                banco = get_agent_info(agn.BankAgent)
+                banco = resolver.resolve(agn.BankAgent)
                 g = Graph()
 
+                if banco is None and accion in ACCIONES:
+                    # Sin banco no se puede cobrar ni devolver nada
+                    logger.info('No hay ningun banco registrado')
+                    gr = canned_message(
+                        ACL.failure,
+                        sender=TreasurerAgent.uri,
+                        msgcnt=mss_cnt,
+                        receiver=msgdic['sender'], )
+
                 # Cobrar el importe de un pedido
-                if accion == ECSDI.Cobrar_pedido:
+                elif accion == ECSDI.Cobrar_pedido:
                     logger.info("Se ha pedido cobrar un pedido.")
                     import_tot = 0.0
                     # en el caso que haya más de un producto externo, lo guardamos en una lista
@@ -262,7 +283,9 @@ def comunicacion():
                     # si se han encontrado productos externos, procedemos a cobrar el importe para cada vendedor externo
                     if info_ext:
                         logger.info("Se cobran los importes de productos externos.")
-                        # por cada vendedor externo diferente le cobramos lo correspondido
+                        # por cada vendedor externo diferente le cobramos lo correspondido,
+                        # todas las transferencias se piden al banco en un solo mensaje
+                        transferencias = []
                         for item in info_ext:
                             ga = Graph()
                             subject_trans = ECSDI["Realizar_transferencia_" + str(mss_cnt)]
@@ -270,14 +293,28 @@ def comunicacion():
                             ga.add((subject_trans, ECSDI.Cuenta_origen, Literal("MiTienda000", datatype=XSD.string)))
                             ga.add((subject_trans, ECSDI.Cuenta_destino, Literal(item['cuenta'], datatype=XSD.string)))
                             ga.add((subject_trans, ECSDI.Importe, Literal(item['importe'], datatype=XSD.float)))
-                            res = send_message_to_agent(ga, banco, subject_trans)
-
-                    # una vez cobrados los importes necesarios, respondemos con un ACK
-                    gr = build_message(Graph(),
-                        ACL['inform-done'],
-                        sender=TreasurerAgent.uri,
-                        msgcnt=mss_cnt,
-                        receiver=msgdic['sender'], )
+                            transferencias.append((ga, subject_trans))
+                        res = send_messages_to_agent(transferencias, banco)
+                        # Las transferencias que fallan tienen la excepcion como respuesta
+                        fallidas = [r for r in res if isinstance(r, Exception)]
+                    else:
+                        fallidas = []
+
+                    if fallidas:
+                        # Si alguna transferencia no se ha hecho el pedido no esta cobrado
+                        logger.info('Han fallado ' + str(len(fallidas)) + ' transferencias: ' + str(fallidas[0]))
+                        gr = canned_message(
+                            ACL.failure,
+                            sender=TreasurerAgent.uri,
+                            msgcnt=mss_cnt,
+                            receiver=msgdic['sender'], )
+                    else:
+                        # una vez cobrados los importes necesarios, respondemos con un ACK
+                        gr = canned_message(
+                            ACL['inform-done'],
+                            sender=TreasurerAgent.uri,
+                            msgcnt=mss_cnt,
+                            receiver=msgdic['sender'], )
 
                 elif accion == ECSDI.Devolver_importe:
                     logger.info("Se ha pedido devolver un importe.")
@@ -316,14 +353,14 @@ def comunicacion():
                         res = send_message_to_agent(g, banco, subject_trans)
 
                     # una vez se ha realizado la transferencia, respondemos con un ACK
-                    gr = build_message(Graph(),
+                    gr = canned_message(
                         ACL['inform-done'],
                         sender=TreasurerAgent.uri,
                         msgcnt=mss_cnt,
                         receiver=msgdic['sender'], )
 
                 else:
-                    gr = build_message(Graph(),
+                    gr = canned_message(
                         ACL['not-understood'],
                         sender=TreasurerAgent.uri,
                         msgcnt=mss_cnt,
@@ -333,7 +370,7 @@ def comunicacion():
 
     logger.info('Respondemos a la peticion')
 
-    return gr.serialize(format='xml')
+    return gr
 
 
 @app.route("/Stop")
@@ -363,6 +400,9 @@ def agentbehavior1(cola):
     # Registramos el agente
     gr = register_message()
 
+    # Renovamos el registro hasta que el agente pare
+    keep_registered(register_message, resolver, cola)
+
 
 if __name__ == '__main__':
     # Ponemos en marcha los behaviors
@@ -14,9 +14,10 @@ from rdflib import Graph, Namespace, Literal
 from rdflib.namespace import FOAF, RDF
 
 from AgentUtil.OntoNamespaces import ACL, DSO, ECSDI
-from AgentUtil.FlaskServer import shutdown_server
-from AgentUtil.ACLMessages import build_message, send_message, get_message_properties
+from AgentUtil.FlaskServer import shutdown_server, serve_message
+from AgentUtil.ACLMessages import canned_message, send_message, get_message_properties
 from AgentUtil.Agent import Agent
+from AgentUtil.DirectoryClient import DirectoryResolver, keep_registered
 from AgentUtil.Logging import config_logger
 
 __author__ = 'javier'
@@ -65,6 +66,11 @@ agn = Namespace("http://www.agentes.org#")
 # Contador de mensajes
 mss_cnt = 0
 
+# Performativas y acciones que entiende el agente, los demas mensajes se
+# rechazan sin acabar de leerlos (ver serve_message)
+PERFORMATIVAS = {ACL.request}
+ACCIONES = {ECSDI.Realizar_transferencia}
+
 # Datos del Agente
 BankAgent = Agent('BankAgent',
                   agn.BankAgent,
@@ -77,6 +83,9 @@ DirectoryAgent = Agent('DirectoryAgent',
                        'http://%s:%d/Register' % (dhostname, dport),
                        'http://%s:%d/Stop' % (dhostname, dport))
 
+# Servicio de directorio (ver AgentUtil.DirectoryClient)
+resolver = DirectoryResolver(BankAgent, DirectoryAgent)
+
 # Global dsgraph triplestore
 dsgraph = Graph()
 
@@ -108,6 +117,7 @@ def register_message():
     gmess.add((reg_obj, FOAF.name, Literal(BankAgent.name)))
     gmess.add((reg_obj, DSO.Address, Literal(BankAgent.address)))
     gmess.add((reg_obj, DSO.AgentType, agn.BankAgent))
+    gmess.add((reg_obj, DSO.Lease, Literal(float(resolver.lease))))
 
     # Lo metemos en un envoltorio FIPA-ACL y lo enviamos
     gr = send_message(
@@ -122,7 +132,7 @@ def register_message():
     return gr
 
 
-@app.route("/comm")
+@app.route("/comm", methods=['GET', 'POST'])
 def comunicacion():
     """
     Entrypoint de comunicacion del agente
@@ -133,29 +143,33 @@ def comunicacion():
     Las acciones se mandan siempre con un Request
     Prodriamos resolver las busquedas usando una performativa de Query-ref
     """
+    return serve_message(request, procesar_mensaje, PERFORMATIVAS, ACCIONES)
+
+
+def procesar_mensaje(gm):
+    """
+    Procesa un mensaje recibido por el entrypoint de comunicacion
+    :param gm: grafo con el mensaje
+    :return: grafo con la respuesta
+    """
     global dsgraph
     global mss_cnt
 
     logger.info('Peticion de informacion recibida')
 
-    # Extraemos el mensaje y creamos un grafo con el
-    message = request.args['content']
-    gm = Graph()
-    gm.parse(data=message)
-
     msgdic = get_message_properties(gm)
 
     # Comprobamos que sea un mensaje FIPA ACL
     if msgdic is None:
         # Si no es, respondemos que no hemos entendido el mensaje
-        gr = build_message(Graph(), ACL['not-understood'], sender=BankAgent.uri, msgcnt=mss_cnt)
+        gr = canned_message(ACL['not-understood'], sender=BankAgent.uri, msgcnt=mss_cnt)
     else:
         # Obtenemos la performativa
         perf = msgdic['performative']
 
         if perf != ACL.request:
             # Si no es un request, respondemos que no hemos entendido el mensaje
-            gr = build_message(Graph(), ACL['not-understood'], sender=BankAgent.uri, msgcnt=mss_cnt)
+            gr = canned_message(ACL['not-understood'], sender=BankAgent.uri, msgcnt=mss_cnt)
         else:
             # Extraemos el objeto del contenido que ha de ser una accion de la ontologia de acciones del agente
             # de registro
@@ -177,14 +191,14 @@ def comunicacion():
                     logger.info("Se ha realizado una transferencia de " + str(origen) + " a " + str(destino) + " de un total de " + str(importe) + " euros.")
                     logger.info("----------------------------------\n")
 
-                    gr = build_message(Graph(),
+                    gr = canned_message(
                         ACL['inform-done'],
                         sender=BankAgent.uri,
                         msgcnt=mss_cnt,
                         receiver=msgdic['sender'], )
 
                 else:
-                  gr = build_message(Graph(),
+                  gr = canned_message(
                     ACL['not-understood'],
                     sender=BankAgent.uri,
                     msgcnt=mss_cnt,
@@ -193,7 +207,7 @@ def comunicacion():
 
     logger.info('Respondemos a la peticion')
 
-    return gr.serialize(format='xml')
+    return gr
 
 
 @app.route("/Stop")
@@ -223,6 +237,9 @@ def agentbehavior1(cola):
     # Registramos el agente
     gr = register_message()
 
+    # Renovamos el registro hasta que el agente pare
+    keep_registered(register_message, resolver, cola)
+
 
 if __name__ == '__main__':
     # Ponemos en marcha los behaviors
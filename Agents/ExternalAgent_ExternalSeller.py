@@ -5,7 +5,7 @@ Agente implementa la interacción con un vendedor externo.
 
 """
 
-from multiprocessing import Process
+from multiprocessing import Process, Queue
 import socket
 import argparse
 import datetime
@@ -21,6 +21,7 @@ from AgentUtil.OntoNamespaces import ACL, DSO, ECSDI
 from AgentUtil.FlaskServer import shutdown_server
 from AgentUtil.ACLMessages import build_message, send_message, get_message_properties
 from AgentUtil.Agent import Agent
+from AgentUtil.DirectoryClient import DirectoryResolver, keep_registered
 from AgentUtil.Logging import config_logger
 
 # For random numbers
@@ -88,6 +89,12 @@ DirectoryAgent = Agent('DirectoryAgent',
                        'http://%s:%d/Register' % (dhostname, dport),
                        'http://%s:%d/Stop' % (dhostname, dport))
 
+# Busquedas en el directorio con cache (ver AgentUtil.DirectoryClient)
+resolver = DirectoryResolver(ExternalAgentOfExternalSeller, DirectoryAgent)
+
+# Cola de comunicacion entre procesos
+cola1 = Queue()
+
 # Global dsgraph triplestore
 dsgraph = Graph()
 
@@ -116,6 +123,7 @@ def register_message():
     gmess.add((reg_obj, FOAF.name, Literal(ExternalAgentOfExternalSeller.name)))
     gmess.add((reg_obj, DSO.Address, Literal(ExternalAgentOfExternalSeller.address)))
     gmess.add((reg_obj, DSO.AgentType, ECSDI.Vendedor_externo))
+    gmess.add((reg_obj, DSO.Lease, Literal(float(resolver.lease))))
 
     # Lo metemos en un envoltorio FIPA-ACL y lo enviamos
     gr = send_message(
@@ -129,41 +137,6 @@ def register_message():
 
     return gr
 
-def get_agent_info(type):
-    """
-    Busca en el servicio de registro mandando un
-    mensaje de request con una accion Search del servicio de directorio
-    :param type:
-    :return:
-    """
-    global mss_cnt
-    logger.info('Buscamos en el servicio de registro')
-
-    gmess = Graph()
-
-    gmess.bind('foaf', FOAF)
-    gmess.bind('dso', DSO)
-    reg_obj = agn[ExternalAgentOfExternalSeller.name + '-search']
-    gmess.add((reg_obj, RDF.type, DSO.Search))
-    gmess.add((reg_obj, DSO.AgentType, type))
-
-    msg = build_message(gmess, perf=ACL.request,
-                        sender=ExternalAgentOfExternalSeller.uri,
-                        receiver=DirectoryAgent.uri,
-                        content=reg_obj,
-                        msgcnt=mss_cnt)
-    gr = send_message(msg, DirectoryAgent.address)
-    mss_cnt += 1
-    logger.info('Recibimos informacion del agente')
-
-    dic = get_message_properties(gr)
-    content = dic['content']
-    address = gr.value(subject=content, predicate=DSO.Address)
-    url = gr.value(subject=content, predicate=DSO.Uri)
-    name = gr.value(subject=content, predicate=FOAF.name)
-
-    return Agent(name, url, address, None)
-
 def send_message_to_agent(gmess, ragn, contentRes):
     """
     Envia una accion a un agente de informacion
@@ -224,7 +197,11 @@ def browser_register_product():
             gr.add((content, ECSDI.Vendedor_A_Registrar, URIRef(subject)))
 
             # Obtenemos el Agente (interno) Vendedor Externo
-            seller = get_agent_info(agn.ExternalSellerAgent)
+            seller = resolver.resolve(agn.ExternalSellerAgent)
+            if seller is None:
+                logger.info('No hay ningun agente vendedor externo registrado')
+                return render_template('register_product.html',
+                                       response='No se ha podido hacer el acuerdo, vuelve a intentarlo mas tarde')
 
             # Enviamos el Vendedor Externo para que sea registrado
             deal_responseGr = send_message_to_agent(gr, seller, content)
@@ -273,19 +250,25 @@ def browser_register_product():
             gr.add((subjectProd, ECSDI.Vendido_por, URIRef(subjectVendedor)))
 
             # Obtenemos el Agente (interno) Vendedor Externo
-            seller = get_agent_info(agn.ExternalSellerAgent)
+            seller = resolver.resolve(agn.ExternalSellerAgent)
+
+            res = {'marca': brand, 'nom': name, 'model': tipo, 'preu':price, 'peso': weight}
+            if seller is None:
+                logger.info('No hay ningun agente vendedor externo registrado')
+                return render_template('end_register_product.html',
+                                       message='No se ha podido registrar el producto, vuelve a intentarlo mas tarde',
+                                       product=res)
 
             # Enviamos el producto para que sea registrado
             messageGr = send_message_to_agent(gr, seller, content)
 
-             # Obtenemos la respuesta
+             # Obtenemos la respuesta (si el vendedor responde sin estado no se ha registrado)
+            respuesta = 'No se ha podido registrar el producto, vuelve a intentarlo mas tarde'
             subjectGraph = messageGr.subjects(RDF.type, ECSDI.Producto_Registrado)
             for s in subjectGraph:
                 
                 respuesta = str(messageGr.value(subject=s, predicate=ECSDI.Estado_registro))
 
-            res = {'marca': brand, 'nom': name, 'model': tipo, 'preu':price, 'peso': weight}
-
             return render_template('end_register_product.html', message=respuesta, product=res)
 
 @app.route("/Stop")
@@ -300,7 +283,7 @@ def stop():
     return "Parando Servidor"
 
 
-@app.route("/comm")
+@app.route("/comm", methods=['GET', 'POST'])
 def comunicacion():
     """
     Entrypoint de comunicacion del agente
@@ -312,10 +295,11 @@ def tidyup():
     Acciones previas a parar el agente
 
     """
-    pass
+    global cola1
+    cola1.put(0)
 
 
-def agentbehavior1():
+def agentbehavior1(cola):
     """
     Un comportamiento del agente
 
@@ -325,10 +309,13 @@ def agentbehavior1():
     # Registramos el agente
     gr = register_message()
 
+    # Renovamos el registro hasta que el agente pare
+    keep_registered(register_message, resolver, cola)
+
 
 if __name__ == '__main__':
     # Ponemos en marcha los behaviors
-    ab1 = Process(target=agentbehavior1)
+    ab1 = Process(target=agentbehavior1, args=(cola1,))
     ab1.start()
 
     # Ponemos en marcha el servidor
@@ -5,7 +5,7 @@ Envia ofertas de precios de transportes y acepta o no una petición de transport
 
 """
 
-from multiprocessing import Process
+from multiprocessing import Process, Queue
 import socket
 import argparse
 import datetime
@@ -16,9 +16,10 @@ from rdflib.namespace import FOAF, RDF
 import requests
 
 from AgentUtil.OntoNamespaces import ACL, DSO, ECSDI
-from AgentUtil.FlaskServer import shutdown_server
-from AgentUtil.ACLMessages import build_message, send_message, get_message_properties
+from AgentUtil.FlaskServer import shutdown_server, serve_message
+from AgentUtil.ACLMessages import build_message, canned_message, send_message, get_message_properties
 from AgentUtil.Agent import Agent
+from AgentUtil.DirectoryClient import DirectoryResolver, keep_registered
 from AgentUtil.Logging import config_logger
 
 # For random numbers
@@ -70,6 +71,11 @@ agn = Namespace("http://www.agentes.org#")
 # Contador de mensajes
 mss_cnt = 0
 
+# Performativas y acciones que entiende el agente, los demas mensajes se
+# rechazan sin acabar de leerlos (ver serve_message)
+PERFORMATIVAS = {ACL['call-for-proposal'], ACL['accept-proposal'], ACL['reject-proposal'],
+                 ACL.request, ACL.inform}
+
 # Datos del Agente
 ExternalTransportAgent_CORREOS = Agent('ExternalTransportAgent_CORREOS',
                        agn.ExternalTransportAgent_CORREOS,
@@ -82,6 +88,12 @@ DirectoryAgent = Agent('DirectoryAgent',
                        'http://%s:%d/Register' % (dhostname, dport),
                        'http://%s:%d/Stop' % (dhostname, dport))
 
+# Servicio de directorio (ver AgentUtil.DirectoryClient)
+resolver = DirectoryResolver(ExternalTransportAgent_CORREOS, DirectoryAgent)
+
+# Cola de comunicacion entre procesos
+cola1 = Queue()
+
 # Global dsgraph triplestore
 dsgraph = Graph()
 
@@ -110,6 +122,7 @@ def register_message():
     gmess.add((reg_obj, FOAF.name, Literal(ExternalTransportAgent_CORREOS.name)))
     gmess.add((reg_obj, DSO.Address, Literal(ExternalTransportAgent_CORREOS.address)))
     gmess.add((reg_obj, DSO.AgentType, agn.ExternalTransportAgent))
+    gmess.add((reg_obj, DSO.Lease, Literal(float(resolver.lease))))
 
     # Lo metemos en un envoltorio FIPA-ACL y lo enviamos
     gr = send_message(
@@ -183,7 +196,7 @@ def stop():
     return "Parando Servidor"
 
 
-@app.route("/comm")
+@app.route("/comm", methods=['GET', 'POST'])
 def comunicacion():
     """
     Entrypoint de comunicacion del agente
@@ -194,22 +207,26 @@ def comunicacion():
     Las acciones se mandan siempre con un Request
     Prodriamos resolver las busquedas usando una performativa de Query-ref
     """
+    return serve_message(request, procesar_mensaje, PERFORMATIVAS)
+
+
+def procesar_mensaje(gm):
+    """
+    Procesa un mensaje recibido por el entrypoint de comunicacion
+    :param gm: grafo con el mensaje
+    :return: grafo con la respuesta
+    """
     global dsgraph
     global mss_cnt
 
     logger.info('Peticion de informacion recibida al transportsita SEUR.')
 
-    # Extraemos el mensaje y creamos un grafo con el
-    message = request.args['content']
-    gm = Graph()
-    gm.parse(data=message)
-
     msgdic = get_message_properties(gm)
 
     # Comprobamos que sea un mensaje FIPA ACL
     if msgdic is None:
         # Si no es, respondemos que no hemos entendido el mensaje
-        gr = build_message(Graph(), ACL['not-understood'], sender=ExternalTransportAgent_CORREOS.uri, msgcnt=mss_cnt)
+        gr = canned_message(ACL['not-understood'], sender=ExternalTransportAgent_CORREOS.uri, msgcnt=mss_cnt)
     else:
         # Obtenemos la performativa
         perf = msgdic['performative']
@@ -222,7 +239,7 @@ def comunicacion():
         # Si se accepta la propuesta del transportista, entonces se debe enviar el pedidio.
         elif perf == ACL['accept-proposal']:
             logger.info("La proposicón ha sido ACEPTADA por el centro logístico.")
-            gr = build_message(Graph(),
+            gr = canned_message(
                 ACL['inform'],
                 sender=ExternalTransportAgent_CORREOS.uri,
                 msgcnt=mss_cnt,
@@ -230,7 +247,7 @@ def comunicacion():
 
         elif perf == ACL['reject-proposal']:
             logger.info("La proposicion NO ha sido ACEPTADA por el centro logística.")
-            gr = build_message(Graph(),
+            gr = canned_message(
                 ACL['inform'],
                 sender=ExternalTransportAgent_CORREOS.uri,
                 msgcnt=mss_cnt,
@@ -255,7 +272,7 @@ def comunicacion():
 
                     if descuento < 6:
                         logger.info("Se ACCEPTA la contra oferta.")
-                        gr = build_message(Graph(),
+                        gr = canned_message(
                             ACL['accept'],
                             sender=ExternalTransportAgent_CORREOS.uri,
                             msgcnt=mss_cnt,
@@ -266,13 +283,13 @@ def comunicacion():
                         gr = make_counter_offer(precio_inicial, msgdic['sender'], descuento)
                     elif descuento > 10:
                         logger.info("Se RECHAZA la contra oferta proporcionada por el centro logístico.")
-                        gr = build_message(Graph(),
+                        gr = canned_message(
                             ACL['reject'],
                             sender=ExternalTransportAgent_CORREOS.uri,
                             msgcnt=mss_cnt,
                             receiver=msgdic['sender'])
         elif perf == ACL['inform']:
-            gr = build_message(Graph(),
+            gr = canned_message(
                 ACL['inform'],
                 sender=ExternalTransportAgent_CORREOS.uri,
                 msgcnt=mss_cnt,
@@ -282,7 +299,7 @@ def comunicacion():
 
     logger.info('Respondemos a la peticion')
 
-    return gr.serialize(format='xml')
+    return gr
 
 
 
@@ -291,10 +308,16 @@ def tidyup():
     Acciones previas a parar el agente
 
     """
-    pass
+    # Paramos la renovacion del registro y nos damos de baja para que el
+    # centro logistico deje de pedirnos ofertas
+    cola1.put(0)
+    try:
+        resolver.deregister()
+    except Exception:
+        logger.info('No se ha podido dar de baja el agente en el directorio')
 
 
-def agentbehavior1():
+def agentbehavior1(cola):
     """
     Un comportamiento del agente
 
@@ -304,9 +327,12 @@ def agentbehavior1():
     # Registramos el agente
     gr = register_message()
 
+    # Renovamos el registro hasta que el agente pare
+    keep_registered(register_message, resolver, cola)
+
 if __name__ == '__main__':
     # Ponemos en marcha los behaviors
-    ab1 = Process(target=agentbehavior1)
+    ab1 = Process(target=agentbehavior1, args=(cola1,))
     ab1.start()
 
     # Ponemos en marcha el servidor
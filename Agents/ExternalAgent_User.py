@@ -18,6 +18,8 @@ from AgentUtil.OntoNamespaces import ACL, DSO, ECSDI
 from AgentUtil.FlaskServer import shutdown_server
 from AgentUtil.ACLMessages import build_message, send_message, get_message_properties
 from AgentUtil.Agent import Agent
+from AgentUtil.DirectoryClient import DirectoryResolver
+from AgentUtil.ProductCatalog import SEARCH_PAGE_MAX, SEARCH_OFFSET_MAX, paging_value
 from AgentUtil.Logging import config_logger
 import datetime
 
@@ -70,6 +72,11 @@ mss_cnt = 0
 # Productos encontrados
 products_list = []
 
+# Filtros de la ultima busqueda y pagina que se muestra (desplazamiento,
+# tamaño y si hay mas productos)
+search_form = {}
+search_page = {'offset': 0, 'size': 20, 'more': False}
+
 # Productos seleccionados
 products_selected = []
 
@@ -94,45 +101,13 @@ DirectoryAgent = Agent('DirectoryAgent',
                        'http://%s:%d/Register' % (dhostname, dport),
                        'http://%s:%d/Stop' % (dhostname, dport))
 
+# Busquedas en el directorio con cache (ver AgentUtil.DirectoryClient)
+resolver = DirectoryResolver(ExternalUserAgent, DirectoryAgent)
+
 # Global dsgraph triplestore
 dsgraph = Graph()
 
 
-def get_agent_info(type):
-    """
-    Busca en el servicio de registro mandando un
-    mensaje de request con una accion Search del servicio de directorio
-    :param type:
-    :return:
-    """
-    global mss_cnt
-    logger.info('Buscamos en el servicio de registro')
-
-    gmess = Graph()
-
-    gmess.bind('foaf', FOAF)
-    gmess.bind('dso', DSO)
-    reg_obj = agn[ExternalUserAgent.name + '-search']
-    gmess.add((reg_obj, RDF.type, DSO.Search))
-    gmess.add((reg_obj, DSO.AgentType, type))
-
-    msg = build_message(gmess, perf=ACL.request,
-                        sender=ExternalUserAgent.uri,
-                        receiver=DirectoryAgent.uri,
-                        content=reg_obj,
-                        msgcnt=mss_cnt)
-    gr = send_message(msg, DirectoryAgent.address)
-    mss_cnt += 1
-    logger.info('Recibimos informacion del agente')
-
-    dic = get_message_properties(gr)
-    content = dic['content']
-    address = gr.value(subject=content, predicate=DSO.Address)
-    url = gr.value(subject=content, predicate=DSO.Uri)
-    name = gr.value(subject=content, predicate=FOAF.name)
-
-    return Agent(name, url, address, None)
-
 
 def send_message_to_agent(gmess, ragn, contentRes):
     """
@@ -152,6 +127,14 @@ def send_message_to_agent(gmess, ragn, contentRes):
 
     return gr
 
+def unavailable(motivo):
+    """
+    Respuesta de la interfaz cuando no se puede atender la peticion porque un
+    agente no esta registrado o ha respondido failure
+    """
+    logger.info(motivo)
+    return motivo + ', vuelve a intentarlo mas tarde', 503
+
 # Interface for user. Can choose between Search product and Return Product
 @app.route("/")
 def browser_uhome():
@@ -169,82 +152,25 @@ def browser_search():
     global numProdCarrito
     global products_selected
     global total_price
+    global search_form
     if request.method == 'GET':
-        return render_template('search.html', products=None, numCarrito=numProdCarrito)
+        return render_template('search.html', products=None, numCarrito=numProdCarrito, page=None)
     elif request.method == 'POST':
         # ------------------------- BUSQUEDA --------------------------------
         if request.form['submit'] == 'search':
-            logger.info("Enviando peticion de busqueda.")
+            search_form = request.form.to_dict()
+            return search_products(0)
 
-            # content of message
-            content = ECSDI['Buscar_productos_' + str(mss_cnt)] 
+        # Pagina anterior o siguiente de la ultima busqueda (si no se ha
+        # buscado nada se muestra el formulario de busqueda)
+        elif request.form['submit'] in ('prev', 'next') and not search_form:
+            return render_template('search.html', products=None, numCarrito=numProdCarrito, page=None)
 
-            # Graph creation
-            gr = Graph()
-            gr.add((content, RDF.type, ECSDI.Buscar_productos))
-
-            # Add filters
-            name = request.form['name']
-            if name:
-                subject_nombre = ECSDI['Filtrar_nombre'+ str(mss_cnt)]
-                gr.add((subject_nombre, RDF.type, ECSDI.Filtrar_nombre))
-                gr.add((subject_nombre, ECSDI.Nombre, Literal(name, datatype=XSD.string)))
-                gr.add((content, ECSDI.Usa_filtro, URIRef(subject_nombre)))
-
-            marca = request.form['brand']
-            if marca:
-                subject_marca = ECSDI['Filtrar_marca'+ str(mss_cnt)]
-                gr.add((subject_marca, RDF.type, ECSDI.Filtrar_marca))
-                gr.add((subject_marca, ECSDI.Marca, Literal(marca, datatype=XSD.string)))
-                gr.add((content, ECSDI.Usa_filtro, URIRef(subject_marca)))
-
-            precio_min = request.form['price_min']
-            precio_max = request.form['price_max']
-            if precio_min or precio_max:
-                subject_precio = ECSDI['Filtrar_precio'+ str(mss_cnt)]
-                gr.add((subject_precio, RDF.type, ECSDI.Filtrar_precio))
-                if precio_min:
-                    gr.add((subject_precio, ECSDI.Precio_minimo, Literal(precio_min, datatype=XSD.float)))
-                if precio_max:
-                    gr.add((subject_precio, ECSDI.Precio_maximo, Literal(precio_max, datatype=XSD.float)))
-                gr.add((content, ECSDI.Usa_filtro, URIRef(subject_precio)))
-
-            tipo = request.form['type']
-            if tipo:
-                subject_tipo = ECSDI['Filtrar_tipo'+ str(mss_cnt)]
-                gr.add((subject_tipo, RDF.type, ECSDI.Filtrar_tipo))
-                gr.add((subject_tipo, ECSDI.Tipo, Literal(tipo, datatype=XSD.string)))
-                gr.add((content, ECSDI.Usa_filtro, URIRef(subject_tipo)))
-
-            vend_externo = request.form.get('externalSeller')
-            vend_tienda = request.form.get('internalSeller')
-            if vend_externo or vend_tienda:
-                subject_vend_ext = ECSDI['Filtrar_vendedores_externos'+ str(mss_cnt)]
-                gr.add((subject_vend_ext, RDF.type, ECSDI.Filtrar_vendedores_externos))
-                if vend_externo:
-                    gr.add((subject_vend_ext, ECSDI.Incluir_productos_externos, Literal(True, datatype=XSD.boolean)))
-                if vend_tienda:
-                    gr.add((subject_vend_ext, ECSDI.Incluir_productos_tienda, Literal(True, datatype=XSD.boolean)))
-                gr.add((content, ECSDI.Usa_filtro, URIRef(subject_vend_ext)))
-            
-            logger.info("Se han aplicado los filtros")
-
-            # Buscar a l'agent Processar Compra i demanar buscar productes, assignar els productes a la products_list
-            venedor = get_agent_info(agn.SalesProcessorAgent)
-            ProductsGr = send_message_to_agent(gr, venedor, content)
-
-            products_list = []
-            for product in ProductsGr.subjects(RDF.type, ECSDI.Producto):
-                prod  = {}
-                prod['url'] = product
-                prod['nombre'] = str(ProductsGr.value(subject=product, predicate=ECSDI.Nombre))
-                prod['marca'] = str(ProductsGr.value(subject=product, predicate=ECSDI.Marca))
-                prod['tipo'] = str(ProductsGr.value(subject=product, predicate=ECSDI.Tipo))
-                prod['precio'] = float(ProductsGr.value(subject=product, predicate=ECSDI.Precio))
-                prod['peso'] = int(ProductsGr.value(subject=product, predicate=ECSDI.Peso))
-                products_list.append(prod)
-            
-            return render_template('search.html', products=products_list, numCarrito=numProdCarrito)
+        elif request.form['submit'] == 'prev':
+            return search_products(max(search_page['offset'] - search_page['size'], 0))
+
+        elif request.form['submit'] == 'next':
+            return search_products(search_page['offset'] + search_page['size'])
 
         # -------------------------- COMPRA --------------------------------
 
@@ -268,7 +194,120 @@ def browser_search():
 
             numProdCarrito += 1
             
-            return render_template('search.html', products=products_list, numCarrito=numProdCarrito)
+            return render_search()
+
+def search_products(offset):
+    """
+    Pide al procesador de compras una pagina de productos con los filtros de
+    la ultima busqueda (search_form)
+
+    :param offset: productos que se saltan
+    """
+    global mss_cnt
+    global products_list
+    global search_page
+
+    # content of message
+    content = ECSDI['Buscar_productos_' + str(mss_cnt)] 
+
+    # Graph creation
+    gr = Graph()
+    gr.add((content, RDF.type, ECSDI.Buscar_productos))
+
+    # Add filters
+    name = search_form['name']
+    if name:
+        subject_nombre = ECSDI['Filtrar_nombre'+ str(mss_cnt)]
+        gr.add((subject_nombre, RDF.type, ECSDI.Filtrar_nombre))
+        gr.add((subject_nombre, ECSDI.Nombre, Literal(name, datatype=XSD.string)))
+        name_mode = search_form.get('name_mode')
+        if name_mode:
+            gr.add((subject_nombre, ECSDI.Modo_busqueda, Literal(name_mode, datatype=XSD.string)))
+        gr.add((content, ECSDI.Usa_filtro, URIRef(subject_nombre)))
+
+    marca = search_form['brand']
+    if marca:
+        subject_marca = ECSDI['Filtrar_marca'+ str(mss_cnt)]
+        gr.add((subject_marca, RDF.type, ECSDI.Filtrar_marca))
+        gr.add((subject_marca, ECSDI.Marca, Literal(marca, datatype=XSD.string)))
+        gr.add((content, ECSDI.Usa_filtro, URIRef(subject_marca)))
+
+    precio_min = search_form['price_min']
+    precio_max = search_form['price_max']
+    if precio_min or precio_max:
+        subject_precio = ECSDI['Filtrar_precio'+ str(mss_cnt)]
+        gr.add((subject_precio, RDF.type, ECSDI.Filtrar_precio))
+        if precio_min:
+            gr.add((subject_precio, ECSDI.Precio_minimo, Literal(precio_min, datatype=XSD.float)))
+        if precio_max:
+            gr.add((subject_precio, ECSDI.Precio_maximo, Literal(precio_max, datatype=XSD.float)))
+        gr.add((content, ECSDI.Usa_filtro, URIRef(subject_precio)))
+
+    tipo = search_form['type']
+    if tipo:
+        subject_tipo = ECSDI['Filtrar_tipo'+ str(mss_cnt)]
+        gr.add((subject_tipo, RDF.type, ECSDI.Filtrar_tipo))
+        gr.add((subject_tipo, ECSDI.Tipo, Literal(tipo, datatype=XSD.string)))
+        gr.add((content, ECSDI.Usa_filtro, URIRef(subject_tipo)))
+
+    vend_externo = search_form.get('externalSeller')
+    vend_tienda = search_form.get('internalSeller')
+    if vend_externo or vend_tienda:
+        subject_vend_ext = ECSDI['Filtrar_vendedores_externos'+ str(mss_cnt)]
+        gr.add((subject_vend_ext, RDF.type, ECSDI.Filtrar_vendedores_externos))
+        if vend_externo:
+            gr.add((subject_vend_ext, ECSDI.Incluir_productos_externos, Literal(True, datatype=XSD.boolean)))
+        if vend_tienda:
+            gr.add((subject_vend_ext, ECSDI.Incluir_productos_tienda, Literal(True, datatype=XSD.boolean)))
+        gr.add((content, ECSDI.Usa_filtro, URIRef(subject_vend_ext)))
+
+    # Pagina y orden de los resultados (un tamaño incorrecto en el formulario
+    # se cambia por el de la ultima pagina)
+    size = paging_value(search_form.get('page_size') or None, search_page['size'], 1, SEARCH_PAGE_MAX)
+    if size is None:
+        size = search_page['size']
+    offset = paging_value(offset, 0, 0, SEARCH_OFFSET_MAX)
+    gr.add((content, ECSDI.Tamano_pagina, Literal(size, datatype=XSD.integer)))
+    gr.add((content, ECSDI.Desplazamiento, Literal(offset, datatype=XSD.integer)))
+    if search_form.get('sort'):
+        gr.add((content, ECSDI.Ordenar_por, Literal(search_form['sort'], datatype=XSD.string)))
+
+    logger.info("Se han aplicado los filtros")
+
+    # Buscar a l'agent Processar Compra i demanar buscar productes, assignar els productes a la products_list
+    venedor = resolver.resolve(agn.SalesProcessorAgent)
+    if venedor is None:
+        return unavailable('No hay ningun procesador de compras registrado')
+    ProductsGr = send_message_to_agent(gr, venedor, content)
+
+    products_list = []
+    for product in ProductsGr.subjects(RDF.type, ECSDI.Producto):
+        prod  = {}
+        prod['posicion'] = int(ProductsGr.value(subject=product, predicate=ECSDI.Posicion))
+        prod['url'] = product
+        prod['nombre'] = str(ProductsGr.value(subject=product, predicate=ECSDI.Nombre))
+        prod['marca'] = str(ProductsGr.value(subject=product, predicate=ECSDI.Marca))
+        prod['tipo'] = str(ProductsGr.value(subject=product, predicate=ECSDI.Tipo))
+        prod['precio'] = float(ProductsGr.value(subject=product, predicate=ECSDI.Precio))
+        prod['peso'] = int(ProductsGr.value(subject=product, predicate=ECSDI.Peso))
+        products_list.append(prod)
+    # El grafo no tiene orden, la posicion de cada producto lo da
+    products_list.sort(key=lambda prod: prod['posicion'])
+
+    encontrados = ProductsGr.value(predicate=RDF.type, object=ECSDI.Productos_encontrados)
+    more = None
+    if encontrados is not None:
+        more = ProductsGr.value(subject=encontrados, predicate=ECSDI.Hay_mas)
+    search_page = {'offset': offset, 'size': size, 'more': more is not None and more.toPython()}
+
+    return render_search()
+
+
+def render_search():
+    """
+    Pagina de busqueda con los productos encontrados
+    """
+    return render_template('search.html', products=products_list, numCarrito=numProdCarrito, page=search_page)
 
 # Interface to show the producst selected to buy to the user. 
 # 2 cases:
@@ -314,9 +353,14 @@ def browser_buy():
                 gr.add((content, ECSDI.Lista_Productos_ProcesarCompra, URIRef(subject_product)))
 
             # buscar agente Procesar Compra y enviarle mensaje
-            venedor = get_agent_info(agn.SalesProcessorAgent)
+            venedor = resolver.resolve(agn.SalesProcessorAgent)
+            if venedor is None:
+                return unavailable('No hay ningun procesador de compras registrado')
 
             Respuesta = send_message_to_agent(gr, venedor, content)
+            if Respuesta.value(predicate=RDF.type, object=ECSDI.Compra_Realizada) is None:
+                # El procesador de compras ha respondido failure
+                return unavailable('No se ha podido realizar la compra')
 
             # Guardamos la compra en nuestra bbdd, para que asi saber que productos puede el usuario devolver
             saveNewOrder(Respuesta)
@@ -384,10 +428,17 @@ def browser_return():
         gr.add((content, ECSDI.Producto_a_Devolver, URIRef(subject_product)))
 
         # Buscar l'agent Procesar Compra i enviar peticio de devolucion
-        venedor = get_agent_info(agn.SalesProcessorAgent)
+        venedor = resolver.resolve(agn.SalesProcessorAgent)
+        if venedor is None:
+            logger.info('No hay ningun procesador de compras registrado')
+            return render_template('return.html', products=products_comprados, returnCompleted=False,
+                                   msg='No se ha podido tramitar la devolucion, vuelve a intentarlo mas tarde')
         respuesta = send_message_to_agent(gr, venedor, content)
 
         # agafar la informacio de si ha estat acceptada la devolucio i missatge de devolucio
+        # (si el procesador de compras responde failure no hay estado)
+        estado_devolucion = False
+        mensaje = 'No se ha podido tramitar la devolucion, vuelve a intentarlo mas tarde'
         subject_dev = respuesta.subjects(RDF.type, ECSDI.Estado_Devolucion)
         for s in subject_dev:
             estado_devolucion = bool(respuesta.value(subject=s, predicate=ECSDI.Devolucion_Aceptada))        
@@ -411,7 +462,7 @@ def stop():
     return "Parando Servidor"
 
 
-@app.route("/comm")
+@app.route("/comm", methods=['GET', 'POST'])
 def comunicacion():
     """
     Entrypoint de comunicacion del agente
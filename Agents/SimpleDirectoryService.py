@@ -6,9 +6,46 @@ Antes de ejecutar hay que añadir la raiz del proyecto a la variable PYTHONPATH
 
 Agente que lleva un registro de otros agentes
 
-Utiliza un registro simple que guarda en un grafo RDF
-
-El registro no es persistente y se mantiene mientras el agente funciona
+Utiliza un registro indexado por URI, nombre y tipo de agente (ver
+AgentUtil.DirectoryRegistry) que mantiene tambien la vista en un grafo RDF
+
+El registro se guarda en disco (foto y diario de cambios, ver
+AgentUtil.DirectoryStore) con el prefijo --state, y se recupera al arrancar.
+Asi al reiniciar el directorio no hace falta que los agentes se vuelvan a
+registrar
+
+Si hay varias instancias de un tipo de agente, la busqueda (accion Search)
+puede indicar con SearchMode que se quieren todas ('all') o como se elige una:
+'round-robin', 'random' o 'least-loaded' segun la carga que comunican los
+agentes con la accion UpdateLoad. Sin SearchMode se retorna la primera
+
+La accion MultiSearch busca todos los agentes de varios tipos (los valores de
+AgentType, o todos los tipos si no hay ninguno) en un solo mensaje. La
+respuesta tiene un Result por tipo con su AgentType y la lista de agentes
+
+Las respuestas de las busquedas se guardan ya serializadas (ver
+cached_response) hasta que cambian los agentes del tipo buscado, para cada
+busqueda solo se sustituye el id del mensaje
+
+Los agentes se pueden suscribir (accion Subscribe) a un tipo de agente. Cada
+vez que se registra o se da de baja (accion Deregister) un agente de ese tipo
+se envia un inform a los suscritos con el contenido de tipo Register o
+Deregister y los datos del agente
+
+Los registros tienen un lease de LEASE_TTL segundos (el agente puede pedir
+otro con DSO.Lease en el Register). Los agentes lo renuevan con la accion
+Renew, o comunicando su carga con UpdateLoad; si el agente no esta registrado
+se responde con un failure y el agente se tiene que volver a registrar. Un
+thread da de baja los registros caducados y avisa a los suscritos como si el
+agente se hubiera dado de baja
+
+Con --leader el directorio es una replica de solo lectura del directorio
+que funciona en esa direccion: le pide periodicamente los cambios del
+registro (entrada /Journal) y los aplica. Responde las busquedas (Search y
+Transport) y a las demas acciones responde con un failure, los agentes se
+registran en el directorio principal. Los agentes pueden repartir sus
+busquedas entre las replicas (ver DIRECTORY_REPLICAS en
+AgentUtil.DirectoryClient)
 
 Las acciones que se pueden usar estan definidas en la ontología
 directory-service-ontology.owl
@@ -16,17 +53,26 @@ directory-service-ontology.owl
 """
 
 from multiprocessing import Process, Queue
+import queue
 import socket
 import argparse
+import os
+import threading
+import time
+import uuid
 
-from flask import Flask, request, render_template
-from rdflib import Graph, RDF, Namespace, RDFS, BNode, URIRef
+from flask import Flask, request, render_template, jsonify
+from rdflib import Graph, RDF, Namespace, RDFS, BNode, URIRef, Literal
 from rdflib.namespace import FOAF
+import requests
 
 from AgentUtil.OntoNamespaces import ACL, DSO, ECSDI
-from AgentUtil.FlaskServer import shutdown_server
+from AgentUtil.FlaskServer import shutdown_server, serve_message
 from AgentUtil.Agent import Agent
-from AgentUtil.ACLMessages import build_message, get_message_properties
+from AgentUtil.ACLMessages import build_message, canned_message, get_message_properties, send_batch, \
+    message_template, template_message
+from AgentUtil.DirectoryRegistry import AgentRegistry, ALL, FIRST, SELECTION_MODES
+from AgentUtil.DirectoryStore import RegistryStore, apply_record, load_state
 from AgentUtil.Logging import config_logger
 
 __author__ = 'javier'
@@ -36,6 +82,9 @@ parser = argparse.ArgumentParser()
 parser.add_argument('--open', help="Define si el servidor est abierto al exterior o no", action='store_true',
                     default=False)
 parser.add_argument('--port', type=int, help="Puerto de comunicacion del agente")
+parser.add_argument('--state', default='../Data/directory',
+                    help="Prefijo de los ficheros donde se guarda el registro ('' no lo guarda)")
+parser.add_argument('--leader', help="Direccion (http://host:puerto) del directorio del que este es una replica")
 
 # Logging
 logger = config_logger(level=1)
@@ -54,15 +103,28 @@ if args.open:
 else:
     hostname = socket.gethostname()
 
-# Directory Service Graph
-dsgraph = Graph()
+# Servidor flask en modo debug (con el reloader de werkzeug)
+DEBUG = True
+
+
+def new_registry():
+    """
+    Registro de agentes vacio, con el grafo del directorio que mantiene
+    """
+    graph = Graph()
+
+    # Vinculamos todos los espacios de nombre a utilizar
+    graph.bind('acl', ACL)
+    graph.bind('rdf', RDF)
+    graph.bind('rdfs', RDFS)
+    graph.bind('foaf', FOAF)
+    graph.bind('dso', DSO)
+    return AgentRegistry(graph)
 
-# Vinculamos todos los espacios de nombre a utilizar
-dsgraph.bind('acl', ACL)
-dsgraph.bind('rdf', RDF)
-dsgraph.bind('rdfs', RDFS)
-dsgraph.bind('foaf', FOAF)
-dsgraph.bind('dso', DSO)
+
+# Registro de agentes y Directory Service Graph que mantiene
+registry = new_registry()
+dsgraph = registry.graph
 
 agn = Namespace("http://www.agentes.org#")
 DirectoryAgent = Agent('DirectoryAgent',
@@ -72,10 +134,235 @@ DirectoryAgent = Agent('DirectoryAgent',
 app = Flask(__name__, template_folder="../Templates")
 mss_cnt = 0
 
+# Performativas y acciones que entiende el agente, los demas mensajes se
+# rechazan sin acabar de leerlos (ver serve_message)
+PERFORMATIVAS = {ACL.request}
+ACCIONES = {DSO.Register, DSO.Deregister, DSO.Renew, DSO.Search, DSO.MultiSearch, DSO.Subscribe, DSO.UpdateLoad,
+            ECSDI.Transport}
+
 cola1 = Queue()  # Cola de comunicacion entre procesos
 
+# Avisos pendientes de enviar a los suscritos, los envia un thread aparte
+# para no retrasar la respuesta al registro
+avisos = queue.Queue()
+notificador = None
+notificador_lock = threading.Lock()
+
+# Respuestas de las busquedas ya serializadas: clave de la busqueda ->
+# (version de los tipos de agente de los que depende, plantilla)
+respuestas = {}
+
+# Numero maximo de respuestas guardadas
+RESPUESTAS_MAX = 1024
+
+# Agentes por pagina en /Info, por defecto y como maximo
+INFO_PAGE_SIZE = 50
+INFO_PAGE_MAX = 500
+
+# Segundos maximos para entregar un aviso a un suscrito
+NOTIFY_TIMEOUT = 5
+
+# Segundos que dura un registro si el agente no lo renueva (0 no caduca)
+LEASE_TTL = float(os.environ.get('DIRECTORY_LEASE', 30))
+
+# Segundos entre las comprobaciones de leases caducados
+SWEEP_INTERVAL = float(os.environ.get('DIRECTORY_SWEEP', 5))
+
+# Thread que da de baja los registros caducados
+barrendero = None
+
+# Acciones que cambian el registro, una replica no las acepta
+ESCRITURAS = {DSO.Register, DSO.Deregister, DSO.Renew, DSO.Subscribe, DSO.UpdateLoad}
+
+# Identifica esta ejecucion del directorio, si cambia las replicas piden el
+# estado completo porque la numeracion de los cambios vuelve a empezar
+EPOCH = uuid.uuid4().hex
+
+# Segundos entre las peticiones de cambios de una replica al directorio
+REPLICATION_INTERVAL = float(os.environ.get('DIRECTORY_REPLICATION_INTERVAL', 1))
+
+
+def agent_list(entries, gr=None, prefix='Directory-response'):
+    """
+    Grafo con una lista (Bag) con los datos de unos agentes registrados
+
+    :param entries: entradas del registro
+    :param gr: grafo al que se añade la lista, por defecto uno nuevo
+    :param prefix: prefijo de los nodos de los agentes de la lista
+    :return: (grafo, nodo de la lista)
+    """
+    if gr is None:
+        gr = Graph()
+        gr.bind('dso', DSO)
+
+    all_agents = BNode()
+    gr.add((all_agents, RDF.type, RDF.Bag))
+    for i, entry in enumerate(entries):
+        rsp_obj = agn[prefix + str(i)]
+        gr.add((rsp_obj, DSO.Address, entry.address))
+        gr.add((rsp_obj, DSO.Uri, entry.uri))
+        gr.add((rsp_obj, FOAF.name, entry.name))
+        gr.add((rsp_obj, DSO.Load, Literal(entry.load)))
+        gr.add((all_agents, URIRef('http://www.w3.org/1999/02/22-rdf-syntax-ns#_'+ str(i)), rsp_obj))
+    return gr, all_agents
+
+
+def cached_response(key, version, build):
+    """
+    Respuesta de una busqueda a partir de su plantilla ya serializada. Si ha
+    cambiado la version de la que depende se construye otra vez
+
+    :param key: clave de la busqueda
+    :param version: version de los agentes de la respuesta (ver
+        AgentRegistry.version), se tiene que obtener antes de construirla
+    :param build: funcion que construye la plantilla (ver message_template)
+    :return: mensaje de respuesta
+    """
+    cached = respuestas.get(key)
+    if cached is None or cached[0] != version:
+        if len(respuestas) >= RESPUESTAS_MAX:
+            respuestas.clear()
+        cached = respuestas[key] = (version, build())
+    return template_message(cached[1], sender=DirectoryAgent.uri, msgcnt=mss_cnt)
+
+
+def notify(event, entry):
+    """
+    Pone en cola el aviso de un alta o baja para los suscritos a su tipo
+
+    :param event: DSO.Register o DSO.Deregister
+    :param entry: entrada del registro del agente
+    """
+    global notificador
+
+    if not registry.subscribers(entry.agent_type):
+        return
+    with notificador_lock:
+        if notificador is None:
+            notificador = threading.Thread(target=send_notifications, daemon=True)
+            notificador.start()
+    avisos.put((event, entry))
+
+
+def start_sweeper():
+    """
+    Pone en marcha el thread que da de baja los registros caducados, si no
+    estaba en marcha
+    """
+    global barrendero
+
+    with notificador_lock:
+        if barrendero is None:
+            barrendero = threading.Thread(target=sweep_leases, daemon=True)
+            barrendero.start()
+
+
+def restore_registry():
+    """
+    Recupera el registro guardado en disco y a partir de entonces guarda sus
+    cambios
+    """
+    if not args.state:
+        return
+    t0 = time.perf_counter()
+    applied = RegistryStore(args.state).load(registry)
+    logger.info('Registro recuperado: %d agentes, %d cambios del diario en %.1f ms'
+                % (len(registry), applied, (time.perf_counter() - t0) * 1000))
+    if any(entry.expires is not None for entry in registry):
+        start_sweeper()
+
+
+def replicate():
+    """
+    Thread de una replica que aplica los cambios del directorio principal
+    """
+    global registry, dsgraph
+
+    epoch, seq = None, 0
+    while True:
+        try:
+            resp = requests.get(args.leader.rstrip('/') + '/Journal',
+                                params={'since': seq, 'epoch': epoch or ''},
+                                timeout=NOTIFY_TIMEOUT)
+            resp.raise_for_status()
+            data = resp.json()
+            if 'state' in data:
+                # Estado completo: se monta un registro nuevo y se sustituye,
+                # asi las busquedas no ven el registro a medio cargar
+                nuevo = new_registry()
+                load_state(nuevo, data['state'])
+                registry, dsgraph = nuevo, nuevo.graph
+                logger.info('Replica: estado completo del directorio, %d agentes' % len(nuevo))
+            else:
+                for record in data['changes']:
+                    apply_record(registry, record)
+            epoch, seq = data['epoch'], data['seq']
+        except (requests.RequestException, ValueError, KeyError):
+            logger.info('Replica: no se pueden leer los cambios de ' + args.leader)
+        time.sleep(REPLICATION_INTERVAL)
+
+
+def sweep_leases():
+    """
+    Thread que da de baja los registros con el lease caducado
+    """
+    while True:
+        time.sleep(SWEEP_INTERVAL)
+        for entry in registry.sweep():
+            logger.info('Lease caducado, damos de baja ' + str(entry.uri))
+            notify(DSO.Deregister, entry)
+
+
+def lease_of(gm, content, default=LEASE_TTL):
+    """
+    Segundos de lease que pide un mensaje, o default si no pide ninguno
+    """
+    lease = gm.value(subject=content, predicate=DSO.Lease)
+    return float(lease) if lease is not None else default
+
+
+def renewed_lease(gm, content, agn_uri):
+    """
+    Segundos de lease de una renovacion. Si el mensaje no pide ninguno se
+    mantiene el que tiene el agente, no el de por defecto
+    """
+    entry = registry.get(agn_uri)
+    return lease_of(gm, content, entry.lease if entry is not None else LEASE_TTL)
 
-@app.route("/Register")
+
+def send_notifications():
+    """
+    Thread que envia los avisos de la cola a los suscritos
+    """
+    global mss_cnt
+
+    while True:
+        event, entry = avisos.get()
+        mensajes = []
+        for subscriber, address in registry.subscribers(entry.agent_type):
+            if subscriber == entry.uri:
+                continue
+            gr = Graph()
+            gr.bind('dso', DSO)
+            ev_obj = agn['Directory-event-' + str(mss_cnt)]
+            gr.add((ev_obj, RDF.type, event))
+            gr.add((ev_obj, DSO.Uri, entry.uri))
+            gr.add((ev_obj, FOAF.name, entry.name))
+            gr.add((ev_obj, DSO.Address, entry.address))
+            gr.add((ev_obj, DSO.AgentType, entry.agent_type))
+            mensajes.append((build_message(gr,
+                                           ACL.inform,
+                                           sender=DirectoryAgent.uri,
+                                           receiver=subscriber,
+                                           msgcnt=mss_cnt,
+                                           content=ev_obj), str(address)))
+            mss_cnt += 1
+        for (_, address), res in zip(mensajes, send_batch(mensajes, timeout=NOTIFY_TIMEOUT)):
+            if isinstance(res, Exception):
+                logger.info('No se ha podido avisar a ' + address)
+
+
+@app.route("/Register", methods=['GET', 'POST'])
 def register():
     """
     Entry point del agente que recibe los mensajes de registro
@@ -87,6 +374,15 @@ def register():
 
     :return:
     """
+    return serve_message(request, procesar_mensaje, PERFORMATIVAS, ACCIONES)
+
+
+def procesar_mensaje(gm):
+    """
+    Procesa un mensaje recibido por el entrypoint de registro
+    :param gm: grafo con el mensaje
+    :return: grafo con la respuesta
+    """
 
     def process_register():
         # Si la hay extraemos el nombre del agente (FOAF.name), el URI del agente
@@ -99,15 +395,16 @@ def register():
         agn_uri = gm.value(subject=content, predicate=DSO.Uri)
         agn_type = gm.value(subject=content, predicate=DSO.AgentType)
 
-        # Añadimos la informacion en el grafo de registro vinculandola a la URI
-        # del agente y registrandola como tipo FOAF.Agent
-        dsgraph.add((agn_uri, RDF.type, FOAF.Agent))
-        dsgraph.add((agn_uri, FOAF.name, agn_name))
-        dsgraph.add((agn_uri, DSO.Address, agn_add))
-        dsgraph.add((agn_uri, DSO.AgentType, agn_type))
+        # Añadimos la informacion al registro, que la añade al grafo de
+        # registro vinculandola a la URI del agente y registrandola como tipo
+        # FOAF.Agent
+        entry = registry.register(agn_uri, agn_name, agn_add, agn_type, lease_of(gm, content))
+        if entry.expires is not None:
+            start_sweeper()
+        notify(DSO.Register, entry)
 
         # Generamos un mensaje de respuesta
-        return build_message(Graph(),
+        return canned_message(
             ACL.confirm,
             sender=DirectoryAgent.uri,
             receiver=agn_uri,
@@ -122,34 +419,70 @@ def register():
 
         # Solo consideramos cuando Search indica el tipo de agente
         # Buscamos una coincidencia exacta
-        # Retornamos el primero de la lista de posibilidades
+        # Segun el modo de busqueda retornamos todos los agentes del tipo o
+        # uno elegido entre ellos (por defecto el primero)
 
         logger.info('Peticion de busqueda')
 
         agn_type = gm.value(subject=content, predicate=DSO.AgentType)
-        rsearch = dsgraph.triples((None, DSO.AgentType, agn_type))
-        print(rsearch)
-        if rsearch is not None:
-            agn_uri = next(rsearch)[0]
-            agn_add = dsgraph.value(subject=agn_uri, predicate=DSO.Address)
-            gr = Graph()
-            gr.bind('dso', DSO)
-            rsp_obj = agn['Directory-response']
-            gr.add((rsp_obj, DSO.Address, agn_add))
-            gr.add((rsp_obj, DSO.Uri, agn_uri))
-            return build_message(gr,
-                                 ACL.inform,
-                                 sender=DirectoryAgent.uri,
-                                 msgcnt=mss_cnt,
-                                 receiver=agn_uri,
-                                 content=rsp_obj)
+        mode = gm.value(subject=content, predicate=DSO.SearchMode)
+        mode = str(mode) if mode is not None else None
+        version = registry.version(agn_type)
+        if mode == ALL:
+            def build_all():
+                gr, all_agents = agent_list(registry.of_type(agn_type))
+                return message_template(gr,
+                                        ACL.inform,
+                                        sender=DirectoryAgent.uri,
+                                        content=all_agents)
+            return cached_response((ALL, agn_type), version, build_all)
+        if mode not in SELECTION_MODES:
+            mode = FIRST
+        entry = registry.select(agn_type, mode)
+        if entry is not None:
+            def build_one():
+                gr = Graph()
+                gr.bind('dso', DSO)
+                rsp_obj = agn['Directory-response']
+                gr.add((rsp_obj, DSO.Address, entry.address))
+                gr.add((rsp_obj, DSO.Uri, entry.uri))
+                return message_template(gr,
+                                        ACL.inform,
+                                        sender=DirectoryAgent.uri,
+                                        receiver=entry.uri,
+                                        content=rsp_obj)
+            return cached_response((entry.uri, agn_type), version, build_one)
         else:
             # Si no encontramos nada retornamos un inform sin contenido
-            return build_message(Graph(),
+            return canned_message(
                 ACL.inform,
                 sender=DirectoryAgent.uri,
                 msgcnt=mss_cnt)
 
+    def process_multi_search():
+        # Busqueda de todos los agentes de varios tipos, o de todos los tipos
+        # si no se indica ninguno. Cada tipo tiene su lista aunque este vacia
+
+        logger.info('Peticion de busqueda de varios tipos')
+
+        agn_types = tuple(gm.objects(subject=content, predicate=DSO.AgentType)) or tuple(registry.types())
+        version = tuple(registry.version(agn_type) for agn_type in agn_types)
+
+        def build():
+            gr = Graph()
+            gr.bind('dso', DSO)
+            results = agn['Directory-results']
+            gr.add((results, RDF.type, DSO.SearchResults))
+            for i, agn_type in enumerate(agn_types):
+                gr, all_agents = agent_list(registry.of_type(agn_type), gr, 'Directory-response%d-' % i)
+                gr.add((all_agents, DSO.AgentType, agn_type))
+                gr.add((results, DSO.Result, all_agents))
+            return message_template(gr,
+                                    ACL.inform,
+                                    sender=DirectoryAgent.uri,
+                                    content=results)
+        return cached_response((DSO.MultiSearch, agn_types), version, build)
+
     def process_search_transport():
         # Asumimos que hay una accion de busqueda que puede tener
         # diferentes parametros en funcion de si se busca un tipo de agente
@@ -164,67 +497,99 @@ def register():
         logger.info('Peticion de busqueda')
 
         agn_type = gm.value(subject=content, predicate=DSO.AgentType)
-        rsearch = dsgraph.triples((None, DSO.AgentType, agn_type))
-        print(rsearch)
-
-        # Debemos buscar todos los transportistas registrados y devolver sus datos.
-        gr = Graph()
-        gr.bind('dso', DSO)
 
-        all_transp = BNode()
-        gr.add((all_transp, RDF.type, RDF.Bag))
-        i = 0
-        for agn_uri in rsearch:
-            logger.info("Añadiendo un nuevo agente de transporte.")
-            
-            agn_name = dsgraph.value(subject=agn_uri[0], predicate=FOAF.name)
-            logger.info("Obteniendo Nombre del Agente." + str(agn_name))
-            logger.info("Obteniendo URI del agente.")
-            agn_add = dsgraph.value(subject=agn_uri[0], predicate=DSO.Address)
-            
-            logger.info("Añadiendo parametros al grafo.")
-            rsp_obj = agn['Directory-response' + str(i)]
-            logger.info("Añadiendo Direccion del agente al grafo.")
-            gr.add((rsp_obj, DSO.Address, agn_add))
-            logger.info("Añadiendo URI del Agente al grafo.")
-            gr.add((rsp_obj, DSO.Uri, agn_uri[0]))
-            logger.info("Agadiendo Nombre del agente al Grafo")
-            gr.add((rsp_obj, FOAF.name, agn_name))
-            logger.info("Añadiendo Bag del agente al Grafo")
-            gr.add((all_transp, URIRef('http://www.w3.org/1999/02/22-rdf-syntax-ns#_'+ str(i)), rsp_obj))
-            
-            logger.info("Siguiente Agente")
-            i += 1
-
-        logger.info("Salimos del bucle")
-        if rsearch is not None:
+        def build():
+            # Debemos buscar todos los transportistas registrados y devolver sus datos.
+            # Aunque no haya ninguno se retorna la lista vacia
+            gr, all_transp = agent_list(registry.of_type(agn_type))
             logger.info("Montamos el mensaje.")
-            return build_message(gr,
-                                 ACL.inform,
-                                 sender=DirectoryAgent.uri,
-                                 msgcnt=mss_cnt,
-                                 content=all_transp)
-        else:
-            # Si no encontramos nada retornamos un inform sin contenido
-            logger.info("Montamos un mensaje sin contenido.")
-            return build_message(Graph(),
-                ACL.inform,
+            return message_template(gr,
+                                    ACL.inform,
+                                    sender=DirectoryAgent.uri,
+                                    content=all_transp)
+        return cached_response((ECSDI.Transport, agn_type), registry.version(agn_type), build)
+
+    def process_deregister():
+        # Damos de baja el agente y sus suscripciones
+
+        logger.info('Peticion de baja')
+
+        agn_uri = gm.value(subject=content, predicate=DSO.Uri)
+        entry = registry.deregister(agn_uri)
+        if entry is not None:
+            notify(DSO.Deregister, entry)
+
+        return canned_message(
+            ACL.confirm,
+            sender=DirectoryAgent.uri,
+            receiver=agn_uri,
+            msgcnt=mss_cnt)
+
+    def process_renew():
+        # El agente renueva su lease. Si ya no estaba registrado (el lease
+        # habia caducado) respondemos failure para que se vuelva a registrar
+
+        agn_uri = gm.value(subject=content, predicate=DSO.Uri)
+        if not registry.renew(agn_uri, renewed_lease(gm, content, agn_uri)):
+            logger.info('Renovacion de un agente no registrado: ' + str(agn_uri))
+            return canned_message(
+                ACL.failure,
                 sender=DirectoryAgent.uri,
+                receiver=agn_uri,
                 msgcnt=mss_cnt)
+        return canned_message(
+            ACL.confirm,
+            sender=DirectoryAgent.uri,
+            receiver=agn_uri,
+            msgcnt=mss_cnt)
+
+    def process_update_load():
+        # Un agente registrado comunica su carga, que tambien renueva su lease
+
+        agn_uri = gm.value(subject=content, predicate=DSO.Uri)
+        load = gm.value(subject=content, predicate=DSO.Load)
+        if load is None or not registry.set_load(agn_uri, float(load)) \
+                or not registry.renew(agn_uri, renewed_lease(gm, content, agn_uri)):
+            return canned_message(
+                ACL.failure,
+                sender=DirectoryAgent.uri,
+                receiver=agn_uri,
+                msgcnt=mss_cnt)
+        return canned_message(
+            ACL.confirm,
+            sender=DirectoryAgent.uri,
+            receiver=agn_uri,
+            msgcnt=mss_cnt)
+
+    def process_subscribe():
+        # El agente que se suscribe indica su URI, la direccion donde quiere
+        # recibir los avisos y el tipo de agente. Se le responde con la lista
+        # de los agentes de ese tipo que hay registrados
+
+        logger.info('Peticion de suscripcion')
+
+        agn_uri = gm.value(subject=content, predicate=DSO.Uri)
+        agn_add = gm.value(subject=content, predicate=DSO.Address)
+        agn_type = gm.value(subject=content, predicate=DSO.AgentType)
+        registry.subscribe(agn_uri, agn_add, agn_type)
+
+        gr, all_agents = agent_list(registry.of_type(agn_type))
+        return build_message(gr,
+                             ACL.inform,
+                             sender=DirectoryAgent.uri,
+                             receiver=agn_uri,
+                             msgcnt=mss_cnt,
+                             content=all_agents)
 
     global dsgraph
     global mss_cnt
-    # Extraemos el mensaje y creamos un grafo con él
-    message = request.args['content']
-    gm = Graph()
-    gm.parse(data=message)
 
     msgdic = get_message_properties(gm)
 
     # Comprobamos que sea un mensaje FIPA ACL
     if not msgdic:
         # Si no es, respondemos que no hemos entendido el mensaje
-        gr = build_message(Graph(),
+        gr = canned_message(
             ACL['not-understood'],
             sender=DirectoryAgent.uri,
             msgcnt=mss_cnt)
@@ -232,7 +597,7 @@ def register():
         # Obtenemos la performativa
         if msgdic['performative'] != ACL.request:
             # Si no es un request, respondemos que no hemos entendido el mensaje
-            gr = build_message(Graph(),
+            gr = canned_message(
                 ACL['not-understood'],
                 sender=DirectoryAgent.uri,
                 msgcnt=mss_cnt)
@@ -243,22 +608,38 @@ def register():
             # Averiguamos el tipo de la accion
             accion = gm.value(subject=content, predicate=RDF.type)
 
+            # Una replica solo responde busquedas
+            if args.leader and accion in ESCRITURAS:
+                gr = canned_message(
+                        ACL.failure,
+                        sender=DirectoryAgent.uri,
+                        msgcnt=mss_cnt)
             # Accion de registro
-            if accion == DSO.Register:
+            elif accion == DSO.Register:
                 gr = process_register()
+            elif accion == DSO.Deregister:
+                gr = process_deregister()
+            elif accion == DSO.Renew:
+                gr = process_renew()
+            elif accion == DSO.Subscribe:
+                gr = process_subscribe()
+            elif accion == DSO.UpdateLoad:
+                gr = process_update_load()
             # Accion de busqueda
             elif accion == DSO.Search:
                 gr = process_search()
+            elif accion == DSO.MultiSearch:
+                gr = process_multi_search()
             # No habia ninguna accion en el mensaje
             elif accion == ECSDI.Transport:
                 gr = process_search_transport()
             else:
-                gr = build_message(Graph(),
+                gr = canned_message(
                         ACL['not-understood'],
                         sender=DirectoryAgent.uri,
                         msgcnt=mss_cnt)
     mss_cnt += 1
-    return gr.serialize(format='xml')
+    return gr
 
 
 @app.route('/Info')
@@ -266,10 +647,52 @@ def info():
     """
     Entrada que da informacion sobre el agente a traves de una pagina web
     """
-    global dsgraph
     global mss_cnt
 
-    return render_template('info.html', nmess=mss_cnt, graph=dsgraph.serialize(format='turtle'))
+    # La pagina se obtiene de los indices del registro, sin recorrer el grafo
+    agn_type = request.args.get('type') or None
+    name = request.args.get('name') or None
+    size = min(max(request.args.get('size', default=INFO_PAGE_SIZE, type=int), 1), INFO_PAGE_MAX)
+    page = max(request.args.get('page', default=1, type=int), 1)
+    total, entries = registry.page(URIRef(agn_type) if agn_type else None, name, (page - 1) * size, size)
+    now = time.monotonic()
+    agents = [{'name': entry.name,
+               'uri': entry.uri,
+               'address': entry.address,
+               'type': entry.agent_type,
+               'load': entry.load,
+               'lease': None if entry.expires is None else max(entry.expires - now, 0.0)}
+              for entry in entries]
+    return render_template('info.html',
+                           nmess=mss_cnt,
+                           counts=sorted(registry.counts()),
+                           total=total,
+                           agents=agents,
+                           agent_type=agn_type or '',
+                           name=name or '',
+                           page=page,
+                           size=size,
+                           pages=max((total + size - 1) // size, 1),
+                           replica=args.leader)
+
+
+@app.route('/Journal')
+def journal():
+    """
+    Entrada de la que las replicas leen los cambios del registro posteriores
+    al numero since. Si no son de esta ejecucion del directorio (epoch) o ya
+    no se tienen todos se retorna el estado completo
+    """
+    since = request.args.get('since', default=0, type=int)
+    changes = None
+    if request.args.get('epoch') == EPOCH:
+        changes = registry.changes_since(since)
+    if changes is None:
+        seq, state = registry.state()
+        return jsonify(epoch=EPOCH, seq=seq, state=state)
+    return jsonify(epoch=EPOCH,
+                   seq=changes[-1][0] if changes else since,
+                   changes=[record for _, record in changes])
 
 
 @app.route("/Stop")
@@ -289,6 +712,8 @@ def tidyup():
     """
     global cola1
     cola1.put(0)
+    # Foto del registro para que al arrancar no haya que aplicar el diario
+    registry.snapshot()
 
 
 def agentbehavior1(cola):
@@ -316,8 +741,18 @@ if __name__ == '__main__':
     ab1 = Process(target=agentbehavior1, args=(cola1,))
     ab1.start()
 
+    # Con el reloader (DEBUG) Flask vuelve a ejecutar el agente en un proceso
+    # hijo, que es el que atiende las peticiones. Solo ese recupera y guarda
+    # el registro, o lo replica si es una replica. Sin reloader lo hace este
+    if not DEBUG or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        if args.leader:
+            logger.info('Replicando el directorio ' + args.leader)
+            threading.Thread(target=replicate, daemon=True).start()
+        else:
+            restore_registry()
+
     # Ponemos en marcha el servidor Flask
-    app.run(host=hostname, port=port, debug=True)
+    app.run(host=hostname, port=port, debug=DEBUG)
 
     ab1.join()
     logger.info('The End')
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark de los formatos de serializacion de mensajes ACL
+
+Mide el tiempo de CPU que gasta el procesador de compras en serializar sus
+respuestas a una busqueda de productos y a una compra, y el que gasta el
+receptor en volver a construir el grafo, para cada formato de WireFormats
+
+Se ejecuta desde la raiz del proyecto:
+
+    python -m Benchmarks.wire_formats --products 500 --repeat 50
+
+"""
+
+from datetime import datetime
+import argparse
+import time
+
+from rdflib import Graph, Literal, XSD, Namespace
+from rdflib.namespace import RDF
+
+from AgentUtil.ACLMessages import build_message
+from AgentUtil.OntoNamespaces import ACL, ECSDI
+from AgentUtil.WireFormats import SUPPORTED_FORMATS, serialize_graph, parse_graph
+
+__author__ = 'javier'
+
+agn = Namespace("http://www.agentes.org#")
+
+
+def load_products(n):
+    """
+    Carga el catalogo de Data/products y lo replica hasta tener n productos
+    """
+    catalog = Graph()
+    catalog.parse('Data/products', format='turtle')
+    base = []
+    for prod in catalog.subjects(RDF.type, ECSDI.Producto_interno):
+        base.append({'nombre': catalog.value(prod, ECSDI.Nombre),
+                     'marca': catalog.value(prod, ECSDI.Marca),
+                     'tipo': catalog.value(prod, ECSDI.Tipo),
+                     'precio': catalog.value(prod, ECSDI.Precio),
+                     'peso': catalog.value(prod, ECSDI.Peso)})
+    products = []
+    for i in range(n):
+        prod = dict(base[i % len(base)])
+        prod['uri'] = ECSDI['Producto_interno_bench_' + str(i)]
+        products.append(prod)
+    return products
+
+
+def search_response(products):
+    """
+    Respuesta a un Buscar_productos, igual que la construye searchProducts
+    """
+    result = Graph()
+    found = ECSDI['productos_encontrados0']
+    result.add((found, RDF.type, ECSDI.Productos_encontrados))
+    for prod in products:
+        subject = prod['uri']
+        result.add((subject, RDF.type, ECSDI.Producto))
+        result.add((subject, ECSDI.Nombre, Literal(prod['nombre'], datatype=XSD.string)))
+        result.add((subject, ECSDI.Marca, Literal(prod['marca'], datatype=XSD.string)))
+        result.add((subject, ECSDI.Tipo, Literal(prod['tipo'], datatype=XSD.string)))
+        result.add((subject, ECSDI.Precio, Literal(prod['precio'], datatype=XSD.float)))
+        result.add((subject, ECSDI.Peso, Literal(prod['peso'], datatype=XSD.integer)))
+        result.add((found, ECSDI.Contiene_producto, subject))
+    return build_message(result, ACL['inform-result'], sender=agn.SalesProcessorAgent,
+                         receiver=agn.ExternalUserAgent)
+
+
+def purchase_response(products):
+    """
+    Respuesta a un Procesar_Compra, igual que la construye el procesador de compras
+    """
+    gr = Graph()
+    order = ECSDI['pedido0']
+    gr.add((order, RDF.type, ECSDI.Pedido))
+    gr.add((order, ECSDI.Ciudad_Destino, Literal('Barcelona', datatype=XSD.string)))
+    gr.add((order, ECSDI.Fecha_Pedido, Literal(datetime.now(), datatype=XSD.dateTime)))
+    gr.add((order, ECSDI.Informacion_Pago, Literal('1234567890', datatype=XSD.string)))
+    gr.add((order, ECSDI.Prioridad_Entrega, Literal('normal', datatype=XSD.string)))
+    for prod in products:
+        subject = prod['uri']
+        gr.add((subject, RDF.type, ECSDI.Producto))
+        gr.add((subject, ECSDI.Nombre, Literal(prod['nombre'], datatype=XSD.string)))
+        gr.add((subject, ECSDI.Marca, Literal(prod['marca'], datatype=XSD.string)))
+        gr.add((subject, ECSDI.Tipo, Literal(prod['tipo'], datatype=XSD.string)))
+        gr.add((subject, ECSDI.Precio, Literal(prod['precio'], datatype=XSD.float)))
+        gr.add((subject, ECSDI.Peso, Literal(prod['peso'], datatype=XSD.integer)))
+        gr.add((order, ECSDI.Productos_Pedido, subject))
+    done = ECSDI['compra_realizada0']
+    gr.add((done, RDF.type, ECSDI.Compra_Realizada))
+    gr.add((done, ECSDI.Pedido_Procesado, order))
+    return build_message(gr, ACL['inform-result'], sender=agn.SalesProcessorAgent,
+                         receiver=agn.ExternalUserAgent)
+
+
+def bench(graph, fmt, repeat):
+    """
+    Tiempo de CPU medio (ms) de serializar y de parsear un mensaje, y su tamaño
+    """
+    t0 = time.process_time()
+    for _ in range(repeat):
+        data = serialize_graph(graph, fmt)
+    t1 = time.process_time()
+    for _ in range(repeat):
+        parsed = parse_graph(data, fmt)
+    t2 = time.process_time()
+    assert len(parsed) == len(graph)
+    return (t1 - t0) * 1000 / repeat, (t2 - t1) * 1000 / repeat, len(data)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--products', type=int, default=200, help="Productos en la respuesta")
+    parser.add_argument('--repeat', type=int, default=20, help="Repeticiones de cada medida")
+    args = parser.parse_args()
+
+    products = load_products(args.products)
+    for title, graph in (('Busqueda de productos', search_response(products)),
+                         ('Compra', purchase_response(products[:max(1, args.products // 10)]))):
+        print('%s (%d triples)' % (title, len(graph)))
+        print('  %-26s %12s %12s %12s %10s' % ('formato', 'emitir ms', 'parsear ms', 'total ms', 'bytes'))
+        base = None
+        for fmt in reversed(SUPPORTED_FORMATS):
+            ser, par, size = bench(graph, fmt, args.repeat)
+            if base is None:
+                base = ser + par
+            print('  %-26s %12.2f %12.2f %12.2f %10d  (%.1fx)' % (fmt, ser, par, ser + par, size,
+                                                                base / (ser + par)))
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Varias instancias de un mismo tipo de agente en el registro del directorio
+(DirectoryRegistry.AgentRegistry)
+
+Se ejecuta desde la raiz del proyecto:
+
+    python -m pytest -q tests
+
+"""
+
+import unittest
+
+from rdflib import Namespace, Literal
+
+from AgentUtil.DirectoryRegistry import AgentRegistry, ROUND_ROBIN, LEAST_LOADED
+
+__author__ = 'javier'
+
+agn = Namespace("http://www.agentes.org#")
+
+
+def _register(registry, host, port):
+    """
+    Registra una instancia del procesador de compras como lo hace el agente:
+    la URI lleva su host y puerto y el tipo es el comun
+    """
+    uri = agn['SalesProcessorAgent-%s-%d' % (host, port)]
+    registry.register(uri, Literal('SalesProcessorAgent'),
+                      Literal('http://%s:%d/comm' % (host, port)), agn.SalesProcessorAgent)
+    return uri
+
+
+class InstancesTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = AgentRegistry()
+        self.first = _register(self.registry, 'host1', 9004)
+        self.second = _register(self.registry, 'host2', 9004)
+
+    def test_both_registered(self):
+        entries = self.registry.of_type(agn.SalesProcessorAgent)
+        self.assertEqual([e.uri for e in entries], [self.first, self.second])
+
+    def test_round_robin(self):
+        chosen = {self.registry.select(agn.SalesProcessorAgent, ROUND_ROBIN).uri for _ in range(4)}
+        self.assertEqual(chosen, {self.first, self.second})
+
+    def test_least_loaded(self):
+        # La carga de cada instancia se guarda por separado
+        self.registry.set_load(self.first, 5.0)
+        self.registry.set_load(self.second, 1.0)
+        self.assertEqual(self.registry.select(agn.SalesProcessorAgent, LEAST_LOADED).uri, self.second)
+        self.registry.set_load(self.second, 9.0)
+        self.assertEqual(self.registry.select(agn.SalesProcessorAgent, LEAST_LOADED).uri, self.first)
+
+    def test_register_again(self):
+        # Volver a registrar una instancia no quita la otra
+        _register(self.registry, 'host1', 9004)
+        self.assertEqual(len(self.registry.of_type(agn.SalesProcessorAgent)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Lectura incremental de N-Triples (WireFormats.iter_triples)
+
+Se ejecuta desde la raiz del proyecto:
+
+    python -m pytest -q tests
+
+"""
+
+from io import BytesIO
+import unittest
+
+from rdflib import Graph, URIRef, BNode, Literal
+from rdflib.compare import isomorphic
+
+from AgentUtil import WireFormats
+from AgentUtil.WireFormats import NTRIPLES, iter_triples
+
+__author__ = 'javier'
+
+
+class _SmallReads():
+    """
+    Stream que retorna como mucho unos pocos bytes en cada read, para que las
+    lineas queden partidas entre lecturas
+    """
+    def __init__(self, data, size):
+        self.data = BytesIO(data)
+        self.size = size
+
+    def read(self, size=-1):
+        return self.data.read(self.size if size < 0 else min(size, self.size))
+
+
+def _sample_graph(n=500):
+    g = Graph()
+    shared = BNode()
+    for i in range(n):
+        s = URIRef('http://example.org/s%d' % i)
+        g.add((s, URIRef('http://example.org/nombre'), Literal('Camión "%d"\n\tñ €' % i)))
+        g.add((s, URIRef('http://example.org/idioma'), Literal('hola', lang='es')))
+        g.add((s, URIRef('http://example.org/precio'), Literal(i * 1.5)))
+        g.add((s, URIRef('http://example.org/nodo'), shared))
+        g.add((shared, URIRef('http://example.org/de'), s))
+    return g
+
+
+class IterNTriplesTest(unittest.TestCase):
+    def test_same_graph_as_rdflib(self):
+        g = _sample_graph()
+        data = g.serialize(format='nt', encoding='utf-8')
+        expected = Graph().parse(data=data, format='nt')
+        for size in (7, 100, 1 << 20):
+            result = Graph()
+            for triple in iter_triples(_SmallReads(data, size), NTRIPLES):
+                result.add(triple)
+            self.assertEqual(len(result), len(expected))
+            self.assertTrue(isomorphic(result, expected))
+
+    def test_blank_nodes_across_chunks(self):
+        # El mismo blank node en trozos distintos es el mismo nodo
+        data = _sample_graph().serialize(format='nt', encoding='utf-8')
+        self.assertGreater(len(data), WireFormats._NT_FIRST_CHUNK)
+        bnodes = set()
+        for triple in iter_triples(BytesIO(data), NTRIPLES):
+            bnodes.update(term for term in triple if isinstance(term, BNode))
+        self.assertEqual(len(bnodes), 1)
+
+    def test_last_line_without_newline(self):
+        data = b'<http://a> <http://b> "c" .\n<http://a> <http://b> "d" .'
+        objects = {str(o) for _, _, o in iter_triples(BytesIO(data), NTRIPLES)}
+        self.assertEqual(objects, {'c', 'd'})
+
+    def test_lazy(self):
+        # El primer triple sale sin leer el resto del mensaje
+        g = _sample_graph(5000)
+        stream = BytesIO(g.serialize(format='nt', encoding='utf-8'))
+        next(iter_triples(stream, NTRIPLES))
+        self.assertLess(stream.tell(), len(stream.getvalue()))
+
+
+if __name__ == '__main__':
+    unittest.main()